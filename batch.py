@@ -0,0 +1,156 @@
+# =====================================================================
+# BATCH: TRỘN ĐỀ HÀNG LOẠT NGOẠI TUYẾN (DÙNG HẾT CÁC NHÂN CPU)
+# =====================================================================
+# Chạy:  python batch.py thu_muc_de_goc --config config.json --out ket_qua
+#        python batch.py thu_muc_de_goc --config config.json --out ket_qua --jobs 8
+# config.json giống trường "config" của /api/mix-docx; có thể ghi đè theo từng file:
+#   {"soDe": 4, "maDeList": ["101", "102", "103", "104"], "files": {"Toan_12.docx": {"soDe": 8}}}
+# Mỗi đề ghi thẳng ra đĩa: ket_qua/<tên file>/De_Ma_101.docx ...; đủ đề thì ghi đáp án (xlsx + DapAn.json).
+# Bị ngắt giữa chừng: chạy lại đúng lệnh cũ, các đề đã xong được bỏ qua (file gốc đổi nội dung thì làm lại).
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import main as arena
+
+KEYS_DIR = ".keys"
+
+# =====================================================================
+# 1. GHI FILE AN TOÀN (GHI TẠM RỒI ĐỔI TÊN -> KHÔNG BAO GIỜ CÓ FILE DỞ DANG)
+# =====================================================================
+
+def write_atomic(path, data):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(data.encode("utf-8") if isinstance(data, str) else data)
+    os.replace(tmp, path)
+
+def variant_codes(config_data):
+    so_de = int(config_data.get("soDe", 1))
+    ma_de_list = config_data.get("maDeList", ["101"])
+    return [ma_de_list[i] if i < len(ma_de_list) else str(100 + i) for i in range(so_de)]
+
+# =====================================================================
+# 2. TIẾN TRÌNH CON: 1 ĐƠN VỊ VIỆC = 1 ĐỀ CỦA 1 FILE
+# =====================================================================
+
+_prepared = {}  # path -> (nội dung đã chuẩn hoá, answer_records) trong tiến trình con hiện tại
+
+def _prepare(path, config_data):
+    cached = _prepared.get(path)
+    if cached is None:
+        with open(path, "rb") as f:
+            content, _ = arena.prepare_source(f.read(), arena.COMPACT_SOURCE,
+                                              arena.OPTIMIZE_MEDIA and config_data.get("toiUuAnh", True))
+        if len(_prepared) >= 4: _prepared.pop(next(iter(_prepared)))
+        cached = _prepared[path] = (content, {})
+    return cached
+
+def run_variant(path, out_dir, config_data, ma_de):
+    content, answer_records = _prepare(path, config_data)
+    docx, ans_key, errors, _ = arena.render_variant(content, config_data, ma_de, answer_records)
+    if errors: return ma_de, errors
+    write_atomic(os.path.join(out_dir, f"De_Ma_{ma_de}.docx"), docx)
+    # File đáp án ghi SAU file đề: có đáp án nghĩa là đề đã ghi xong
+    write_atomic(os.path.join(out_dir, KEYS_DIR, f"{ma_de}.json"), json.dumps(ans_key, ensure_ascii=False))
+    return ma_de, None
+
+# =====================================================================
+# 3. LẬP KẾ HOẠCH (BỎ QUA PHẦN ĐÃ XONG) & GHI ĐÁP ÁN KHI ĐỦ ĐỀ
+# =====================================================================
+
+def plan_file(path, out_root, base_config):
+    name = os.path.basename(path)
+    config_data = dict(base_config, **base_config.get("files", {}).get(name, {}))
+    config_data.pop("files", None)
+    config_data.setdefault("thoiGian", "90")
+    out_dir = os.path.join(out_root, os.path.splitext(name)[0])
+    keys_dir = os.path.join(out_dir, KEYS_DIR)
+    os.makedirs(keys_dir, exist_ok=True)
+
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest() + hashlib.sha256(json.dumps(config_data, sort_keys=True).encode()).hexdigest()[:16]
+    stamp = os.path.join(keys_dir, "source.sha256")
+    if not os.path.exists(stamp) or open(stamp).read() != digest:
+        # File gốc / config đổi từ lần chạy trước -> bỏ kết quả cũ của file này
+        for entry in os.listdir(keys_dir): os.remove(os.path.join(keys_dir, entry))
+        if os.path.exists(os.path.join(out_dir, "DapAn.json")): os.remove(os.path.join(out_dir, "DapAn.json"))
+        write_atomic(stamp, digest)
+
+    if os.path.exists(os.path.join(out_dir, "LOI.json")): os.remove(os.path.join(out_dir, "LOI.json"))
+    codes = variant_codes(config_data)
+    if os.path.exists(os.path.join(out_dir, "DapAn.json")): return config_data, out_dir, codes, []
+    todo = [m for m in codes if not os.path.exists(os.path.join(keys_dir, f"{m}.json"))]
+    return config_data, out_dir, codes, todo
+
+def write_answer_keys(out_dir, codes):
+    all_exams_data = {}
+    for ma_de in codes:
+        with open(os.path.join(out_dir, KEYS_DIR, f"{ma_de}.json"), encoding="utf-8") as f:
+            all_exams_data[ma_de] = json.load(f)
+    for name, data in arena.build_answer_workbooks(all_exams_data):
+        write_atomic(os.path.join(out_dir, name), data)
+    write_atomic(os.path.join(out_dir, "DapAn.json"), json.dumps({"version": 1, "exams": all_exams_data}, ensure_ascii=False))
+
+# =====================================================================
+# 4. CHẠY
+# =====================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Trộn đề hàng loạt từ 1 thư mục .docx, ghi thẳng ra đĩa, chạy tiếp được khi bị ngắt")
+    parser.add_argument("source_dir")
+    parser.add_argument("--config", required=True, help="File JSON cấu hình (giống config của /api/mix-docx)")
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Số tiến trình (mặc định: số nhân CPU)")
+    args = parser.parse_args()
+
+    with open(args.config, encoding="utf-8") as f:
+        base_config = json.load(f)
+    sources = sorted(os.path.join(args.source_dir, n) for n in os.listdir(args.source_dir)
+                     if n.lower().endswith(".docx") and not n.startswith("~$"))
+    if not sources:
+        print(f"Không có file .docx nào trong {args.source_dir}")
+        return 1
+
+    plans, units = {}, []
+    for path in sources:
+        config_data, out_dir, codes, todo = plan_file(path, args.out, base_config)
+        plans[path] = {"out_dir": out_dir, "codes": codes, "left": len(todo), "errors": None}
+        units.extend((path, out_dir, config_data, ma_de) for ma_de in todo)
+        if not todo and not os.path.exists(os.path.join(out_dir, "DapAn.json")): write_answer_keys(out_dir, codes)
+    skipped = sum(len(p["codes"]) for p in plans.values()) - len(units)
+    print(f"{len(sources)} file, {len(units)} đề cần trộn ({skipped} đề đã có từ lần chạy trước), {args.jobs} tiến trình", flush=True)
+
+    t0, failed = time.perf_counter(), 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(run_variant, *unit): (unit[0], unit[3]) for unit in units}
+        for future in as_completed(futures):
+            path, ma_de = futures[future]
+            plan = plans[path]
+            try:
+                _, errors = future.result()
+            except Exception as e:
+                errors = [f"Lỗi hệ thống: {e}"]
+            plan["left"] -= 1
+            if errors and plan["errors"] is None:
+                plan["errors"] = errors
+                write_atomic(os.path.join(plan["out_dir"], "LOI.json"),
+                             json.dumps({"ma_de": ma_de, "errors": errors}, ensure_ascii=False, indent=2))
+                print(f"[LỖI] {os.path.basename(path)} (mã {ma_de}): {errors[0]}", flush=True)
+            if plan["left"] == 0:
+                if plan["errors"] is None:
+                    write_answer_keys(plan["out_dir"], plan["codes"])
+                    print(f"[XONG] {os.path.basename(path)}: {len(plan['codes'])} đề -> {plan['out_dir']}", flush=True)
+                else:
+                    failed += 1
+
+    print(f"Hoàn tất sau {time.perf_counter() - t0:.1f} giây, {failed} file lỗi")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
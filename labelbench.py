@@ -0,0 +1,124 @@
+# =====================================================================
+# MICRO-BENCHMARK: KHỚP NHÃN "A." / "Câu 3:" / "(đúng)" VỚI ĐOẠN VĂN DÀI, CỐ TÌNH GÂY KHÓ
+# =====================================================================
+# Chạy:  python labelbench.py
+#        python labelbench.py --sizes 1000,10000,100000 --fuzz 50000
+# So regex cũ (giữ nguyên ở đây làm mốc) với các hàm khớp tuyến tính trong main.py:
+#   1) fuzz: kết quả phải giống hệt regex cũ trên các chuỗi ngắn ngẫu nhiên (trừ chỗ regex cũ khớp nhầm giữa đoạn);
+#   2) đoạn dài gây khó: thời gian hàm mới phải tăng tuyến tính theo độ dài (ns/ký tự gần như không đổi).
+
+import argparse
+import random
+import re
+import sys
+import time
+
+import main as arena
+
+OLD_OPTION_P1 = re.compile(r'^\s*(\*|∗)?\s*([A-D])\s*[.)](\*|∗)?')
+OLD_OPTION_P2 = re.compile(r'^\s*(\*|∗)?\s*([a-d])\s*[.)](\*|∗)?')
+OLD_OPTION_LABEL = re.compile(r'^.*?(\*|∗)?\s*([A-D]|[a-d])\s*[.)](\*|∗)?', re.IGNORECASE)
+OLD_QUESTION_LABEL = re.compile(r'^(\s*)(Câu\s+\d+)([\s:.\-\)]*)', re.IGNORECASE)
+OLD_DUNG_MARK = re.compile(r'\(\s*đ(?:úng)?\s*\)', re.IGNORECASE)
+
+# =====================================================================
+# 1. SO KHỚP VỚI REGEX CŨ
+# =====================================================================
+
+ALPHABET = [" ", "\t", "\xa0", "*", "∗", "A", "B", "d", "e", ".", ")", "(", ":", "-", "đ", "Đ", "úng", "ÚNG",
+            "Câu", "CÂU", "câu", "3", "12", "x", "\n"]
+
+def random_text(rng):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 10)))
+
+def old_option(pattern, text):
+    m = pattern.match(text)
+    return (m.end(), bool(m.group(1) or m.group(3))) if m else None
+
+def old_question(text):
+    m = OLD_QUESTION_LABEL.search(text)
+    return (len(m.group(1)), m.end(), re.search(r'\d+', m.group(2)).group()) if m else None
+
+def fuzz(count, seed):
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(count):
+        text = random_text(rng)
+        checks = [
+            (old_option(OLD_OPTION_P1, text), arena.match_option_label(text, "ABCD")),
+            (old_option(OLD_OPTION_P2, text), arena.match_option_label(text, "abcd")),
+            (old_question(text), arena.match_question_label(text)),
+            (OLD_DUNG_MARK.search(text) is not None, arena.has_dung_mark(text)),
+            (OLD_DUNG_MARK.sub("", text), arena.strip_dung_marks(text)),
+        ]
+        # Regex cũ của bước gắn nhãn không neo đầu đoạn: chỉ so những chuỗi mà nó khớp ngay ở nhãn đầu đoạn.
+        # Bỏ qua chuỗi có xuống dòng: "." của nó không khớp "\n" nên "\n*B." được nhận là phương án nhưng không gắn lại nhãn
+        anchored = old_option(OLD_OPTION_P1, text) or old_option(OLD_OPTION_P2, text)
+        if anchored and "\n" not in text: checks.append((old_option(OLD_OPTION_LABEL, text), arena.match_option_label(text, "ABCDabcd")))
+        for old, new in checks:
+            if old != new:
+                mismatches += 1
+                if mismatches <= 5: print(f"  KHÁC: {text!r}: regex={old} mới={new}")
+    return mismatches
+
+# =====================================================================
+# 2. ĐOẠN DÀI GÂY KHÓ
+# =====================================================================
+
+def adversarial(n):
+    return {
+        "khoang_trang": " " * n + "x",                  # \s* bị thử lại ở mọi vị trí
+        "khoang_trang_sao": "*" + " " * n + "x",
+        "chu_khong_nhan": "x" * n,
+        "chu_cai_lap": "a " * (n // 2),                 # chữ a-d khắp nơi nhưng không có . hoặc )
+        "cau_khoang_trang": "Câu" + " " * n + "x",
+        "ngoac_lap": "( " * (n // 2),                   # nhiều "(" + khoảng trắng, không có "đ"
+        "ngoac_d_lap": "(đ " * (n // 3),
+    }
+
+CASES = [
+    ("option_label", lambda s: OLD_OPTION_LABEL.search(s), lambda s: arena.match_option_label(s, "ABCDabcd")),
+    ("option_p1", lambda s: OLD_OPTION_P1.match(s), lambda s: arena.match_option_label(s, "ABCD")),
+    ("question_label", lambda s: OLD_QUESTION_LABEL.search(s), arena.match_question_label),
+    ("dung_mark", lambda s: OLD_DUNG_MARK.sub("", s), arena.strip_dung_marks),
+]
+
+def best_time(func, text, budget):
+    # Lấy thời gian tốt nhất, lặp tối đa trong khoảng budget giây
+    best, spent = float("inf"), 0.0
+    while spent < budget or best == float("inf"):
+        t0 = time.perf_counter()
+        func(text)
+        elapsed = time.perf_counter() - t0
+        best, spent = min(best, elapsed), spent + elapsed
+        if elapsed > budget: break
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo hàm khớp nhãn tuyến tính so với regex cũ trên đoạn văn dài gây khó")
+    parser.add_argument("--sizes", default="1000,4000,16000")
+    parser.add_argument("--fuzz", type=int, default=20000, help="Số chuỗi ngẫu nhiên để so kết quả với regex cũ")
+    parser.add_argument("--old-limit", type=int, default=16000, help="Bỏ đo regex cũ với đoạn dài hơn (quá chậm)")
+    parser.add_argument("--seed", type=int, default=2024)
+    args = parser.parse_args()
+
+    mismatches = fuzz(args.fuzz, args.seed)
+    print(f"fuzz: {args.fuzz} chuỗi, {mismatches} khác biệt")
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    print(f"{'ham':>15} {'doan':>17} {'n':>7} {'regex_ms':>10} {'moi_ms':>9} {'moi_ns/ky_tu':>13}")
+    worst = 0.0
+    for name, old, new in CASES:
+        for kind in adversarial(sizes[0]):
+            for n in sizes:
+                text = adversarial(n)[kind]
+                old_ms = f"{best_time(old, text, 0.05) * 1000:.3f}" if n <= args.old_limit else "-"
+                new_s = best_time(new, text, 0.05)
+                per_char = new_s * 1e9 / max(1, len(text))
+                worst = max(worst, per_char)
+                print(f"{name:>15} {kind:>17} {n:>7} {old_ms:>10} {new_s * 1000:>9.3f} {per_char:>13.1f}")
+    print(f"Tệ nhất (hàm mới): {worst:.1f} ns/ký tự")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
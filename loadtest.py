@@ -0,0 +1,270 @@
+# =====================================================================
+# LOAD TEST: MÔ PHỎNG TUẦN THI CHO /api/mix-docx
+# =====================================================================
+# Chạy:  python loadtest.py --concurrency 1,4,16,32 --requests 40
+#        python loadtest.py --url http://127.0.0.1:8000 --json ket_qua.json
+# Không truyền --url thì script tự bật uvicorn (main:app) ở cổng trống và đo RSS của tiến trình đó
+# (cộng cả tiến trình con nếu bật ARENA_JOB_WORKERS).
+# Mỗi request kèm "nonce" riêng trong config để server không gộp các yêu cầu giống hệt (single-flight) thành 1 lần trộn;
+# thêm --coalesce để các request cùng loại đề + số đề dùng chung 1 nonce (như client gửi lại) và đo cả hiệu quả gộp.
+
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from docx import Document
+from docx.shared import Cm
+from docx.oxml import parse_xml
+
+OMML_NS = 'xmlns:m="http://schemas.openxmlformats.org/officeDocument/2006/math"'
+
+# =====================================================================
+# 1. ĐỀ GIẢ LẬP (CHỈ CHỮ / NHIỀU CÔNG THỨC / NHIỀU ẢNH)
+# =====================================================================
+
+def make_png(width, height, seed):
+    # Ảnh nhiễu ngẫu nhiên -> khó nén, giống ảnh chụp điện thoại dán vào đề
+    rng = random.Random(seed)
+    rows = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 6)) + chunk(b"IEND", b""))
+
+def add_math(paragraph, text):
+    paragraph._p.append(parse_xml(
+        f'<m:oMath {OMML_NS}><m:f><m:num><m:r><m:t>{text}</m:t></m:r></m:num>'
+        f'<m:den><m:r><m:t>2</m:t></m:r></m:den></m:f></m:oMath>'))
+
+def build_exam(kind, n_p1=12, n_p2=4, n_p3=6, seed=0):
+    rng = random.Random(seed)
+    doc = Document()
+    png = make_png(640, 480, seed) if kind == "image" else None
+
+    def stem(i):
+        p = doc.add_paragraph(f"Câu {i}: Nội dung câu hỏi số {i} ")
+        if kind == "math": add_math(p, f"x+{i}")
+        if kind == "image" and i % 2: doc.add_paragraph().add_run().add_picture(io.BytesIO(png), width=Cm(8))
+
+    doc.add_paragraph("PHẦN I. Câu trắc nghiệm nhiều phương án lựa chọn")
+    for i in range(1, n_p1 + 1):
+        stem(i)
+        correct = rng.randrange(4)
+        for j, label in enumerate("ABCD"):
+            p = doc.add_paragraph(f"{'*' if j == correct else ''}{label}. Phương án {label} ")
+            if kind == "math": add_math(p, f"{j}y")
+
+    doc.add_paragraph("PHẦN II. Câu trắc nghiệm đúng sai")
+    for i in range(1, n_p2 + 1):
+        stem(i)
+        for label in "abcd":
+            p = doc.add_paragraph(f"{label}) Mệnh đề {label} ")
+            if rng.random() < 0.5: p.add_run("(đúng)")
+
+    doc.add_paragraph("PHẦN III. Câu trắc nghiệm trả lời ngắn")
+    for i in range(1, n_p3 + 1):
+        stem(i)
+        doc.add_paragraph(f"Key: {rng.randint(1, 99)}")
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def build_workload(mix, max_so_de, total, seed):
+    rng = random.Random(seed)
+    docs = {kind: build_exam(kind, seed=seed) for kind in mix}
+    kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+    jobs = []
+    for _ in range(total):
+        kind = rng.choice(kinds)
+        so_de = min(max_so_de, max(1, int(rng.paretovariate(1.2))))  # phần lớn 1-4 đề, thỉnh thoảng 20-40
+        jobs.append((kind, so_de, docs[kind]))
+    return jobs
+
+# =====================================================================
+# 2. CLIENT HTTP (CHỈ DÙNG THƯ VIỆN CHUẨN)
+# =====================================================================
+
+def encode_multipart(file_bytes, config):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="config"\r\n\r\n'.encode())
+    body.write(json.dumps(config).encode() + b"\r\n")
+    body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="de.docx"\r\n'
+               'Content-Type: application/vnd.openxmlformats-officedocument.wordprocessingml.document\r\n\r\n'.encode())
+    body.write(file_bytes + b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return body.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+def post_mix(base_url, job, timeout, coalesce=False):
+    kind, so_de, file_bytes = job
+    url = urlparse(base_url)
+    config = {"soDe": so_de, "maDeList": [str(101 + i) for i in range(so_de)]}
+    # khoá single-flight = file + config (gồm nonce); server chỉ gộp khi có nonce
+    config["nonce"] = f"loadtest-{kind}-{so_de}" if coalesce else uuid.uuid4().hex
+    body, content_type = encode_multipart(file_bytes, config)
+    t0 = time.perf_counter()
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        conn.request("POST", "/api/mix-docx", body=body, headers={"Content-Type": content_type})
+        resp = conn.getresponse()
+        resp.read()
+        status = resp.status
+    except (OSError, http.client.HTTPException):
+        status = 0
+    finally:
+        conn.close()
+    return kind, so_de, status, time.perf_counter() - t0
+
+# =====================================================================
+# 3. ĐO RSS ĐỈNH CỦA SERVER (ĐỌC /proc, CỘNG CẢ TIẾN TRÌNH CON)
+# =====================================================================
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(c) for c in f.read().split()]
+    except OSError:
+        return []
+
+def _rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return 0.0
+
+def tree_rss_mb(pid):
+    total, stack = 0.0, [pid]
+    while stack:
+        p = stack.pop()
+        total += _rss_mb(p)
+        stack.extend(_children(p))
+    return total
+
+class RssSampler:
+    def __init__(self, pid, interval=0.1):
+        self.pid, self.interval, self.peak = pid, interval, 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, tree_rss_mb(self.pid))
+
+    def __enter__(self):
+        if self.pid: self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.pid: self._thread.join()
+
+# =====================================================================
+# 4. CHẠY THEO TỪNG MỨC ĐỒNG THỜI & BÁO CÁO
+# =====================================================================
+
+def percentile(sorted_values, q):
+    if not sorted_values: return 0.0
+    k = (len(sorted_values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def run_level(base_url, jobs, concurrency, timeout, server_pid, coalesce=False):
+    with RssSampler(server_pid) as sampler, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        t0 = time.perf_counter()
+        results = list(pool.map(lambda job: post_mix(base_url, job, timeout, coalesce), jobs))
+        elapsed = time.perf_counter() - t0
+    latencies = sorted(r[3] for r in results if r[2] == 200)
+    errors = sum(1 for r in results if r[2] != 200)
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "p50_s": round(percentile(latencies, 0.50), 3),
+        "p95_s": round(percentile(latencies, 0.95), 3),
+        "p99_s": round(percentile(latencies, 0.99), 3),
+        "error_rate": round(errors / len(results), 4) if results else 0.0,
+        "peak_rss_mb": round(sampler.peak, 1) if server_pid else None,
+        "by_kind": {kind: sum(1 for r in results if r[0] == kind) for kind in sorted({r[0] for r in results})},
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(workers):
+    port = free_port()
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    if workers > 1: cmd += ["--workers", str(workers)]
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/api/ready")
+            if conn.getresponse().status == 200: return proc, base_url
+        except OSError:
+            pass
+        time.sleep(0.25)
+    proc.kill()
+    raise RuntimeError("Server không sẵn sàng sau 60 giây")
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition(":")
+        mix[kind.strip()] = int(weight or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /api/mix-docx với lưu lượng mô phỏng tuần thi")
+    parser.add_argument("--url", help="Server có sẵn; bỏ trống để tự bật uvicorn")
+    parser.add_argument("--server-workers", type=int, default=1)
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests", type=int, default=40, help="Số request ở mỗi mức đồng thời")
+    parser.add_argument("--mix", default="text:6,math:3,image:1")
+    parser.add_argument("--max-so-de", type=int, default=40)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    parser.add_argument("--coalesce", action="store_true",
+                        help="Dùng chung nonce: request giống hệt đang chạy cùng lúc được server gộp (single-flight)")
+    args = parser.parse_args()
+
+    proc, base_url = (None, args.url) if args.url else start_server(args.server_workers)
+    try:
+        jobs = build_workload(parse_mix(args.mix), args.max_so_de, args.requests, args.seed)
+        report = []
+        print(f"{'conc':>5} {'req':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err%':>6} {'peakMB':>8}")
+        for level in [int(c) for c in args.concurrency.split(",")]:
+            row = run_level(base_url, jobs, level, args.timeout, proc.pid if proc else None, args.coalesce)
+            report.append(row)
+            print(f"{row['concurrency']:>5} {row['requests']:>5} {row['throughput_rps']:>8} {row['p50_s']:>8} "
+                  f"{row['p95_s']:>8} {row['p99_s']:>8} {row['error_rate'] * 100:>6.1f} {str(row['peak_rss_mb']):>8}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"url": base_url, "mix": args.mix, "coalesce": args.coalesce, "levels": report}, f,
+                          ensure_ascii=False, indent=2)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,65 @@
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.requests import ClientDisconnect
 from docx import Document
 from docx.shared import Cm, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING
 from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
+from lxml import etree
 import random
 import io
 import re
 import traceback
 import zipfile
+import zlib
+import struct
 import json
 import csv
+import html
+import hashlib
+import tempfile
+import shutil
+import email.utils
 import copy
-from openpyxl import Workbook
+import os
+import sys
+import gc
+import time
+import threading
+import cProfile
+import pstats
+import marshal
+import math
+import queue
+import uuid
+import signal
+import asyncio
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from bisect import bisect_right
+from operator import itemgetter
+from contextlib import asynccontextmanager
 
-app = FastAPI(title="Arena Mix - Final Layout Engine")
+try:
+    import resource  # chỉ có trên Linux/macOS: dùng để giới hạn RAM/CPU cho từng job
+except ImportError:
+    resource = None
+try:
+    import fcntl  # khoá file giữa các worker khi cập nhật trạng thái upload theo khúc
+except ImportError:
+    fcntl = None
+
+@asynccontextmanager
+async def lifespan(app):
+    start_warm_up_in_background()
+    if JOB_POOL is not None: JOB_POOL.start()
+    yield
+    if JOB_POOL is not None: JOB_POOL.shutdown()
+
+app = FastAPI(title="Arena Mix - Final Layout Engine", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,11 +70,79 @@ app.add_middleware(
 )
 
 WORD_NS = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+W_P, W_R, W_T, W_TAB = qn('w:p'), qn('w:r'), qn('w:t'), qn('w:tab')
+W_PPR, W_IND = qn('w:pPr'), qn('w:ind')
+W_RPR, W_COLOR, W_U, W_VAL = qn('w:rPr'), qn('w:color'), qn('w:u'), qn('w:val')
+
+# Biên dịch sẵn các mẫu regex dùng trong vòng lặp nóng (tránh chi phí lần gọi đầu tiên)
+RE_MARKER_TAG = re.compile(r'\[P[1-4]\]', re.IGNORECASE)
+RE_MARKER_TAG_SUB = re.compile(r'\[P[1-4]\]\s*', re.IGNORECASE)
+RE_ZONE_HEADERS = [
+    ("P1", re.compile(r'^PHẦN\s+(I|1|MỘT)\b')),
+    ("P2", re.compile(r'^PHẦN\s+(II|2|HAI)\b')),
+    ("P3", re.compile(r'^PHẦN\s+(III|3|BA)\b')),
+    ("P4", re.compile(r'^PHẦN\s+(IV|4|BỐN)\b')),
+]
+RE_KEY_LINE = re.compile(r'^\s*(?:Đáp án|ĐS|Key)\s*[:=]\s*(.*)', re.IGNORECASE)
 
 # =====================================================================
 # MODULE 1: CORE UTILS & BOLDING ENGINE
 # =====================================================================
 
+# =====================================================================
+# [KHỚP NHÃN TUYẾN TÍNH]: "A." / "Câu 3:" / "(đúng)" KHÔNG DÙNG REGEX QUAY LUI
+# =====================================================================
+# Regex cũ r'^.*?(\*|∗)?\s*([A-D]|[a-d])\s*[.)]' thử lại \s* ở mọi vị trí -> O(n²) với đoạn nhiều khoảng trắng
+# (16.000 dấu cách ~ 3,7 giây / đoạn) và có thể khớp nhầm chữ "b)" nằm giữa nội dung phương án.
+# Các hàm dưới đây chỉ đi tiến, neo ở đầu đoạn, mỗi ký tự đọc tối đa 1 lần;
+# bước nhảy qua khoảng trắng là 1 lớp \s* đứng riêng (chạy trong C, không có gì phía sau để quay lui):
+#   match_option_label / match_question_label: O(độ dài nhãn + khoảng trắng trước nhãn) <= O(n);
+#   has_dung_mark / strip_dung_marks: O(n) - mỗi lần thử bắt đầu ở 1 dấu "(" (so khớp chữ, không có .*),
+#   \s* dừng ở ký tự khác khoảng trắng đầu tiên nên khoảng trắng sau mỗi "(" chỉ thuộc về đúng 1 lần thử.
+# Đo và so khớp với regex cũ: python labelbench.py
+STAR_MARKS = "*∗"
+OPTION_LETTERS = {"P1": "ABCD", "P2": "abcd"}
+RE_SPACES = re.compile(r'\s*')
+RE_DUNG_MARK = re.compile(r'\(\s*đ(?:úng)?\s*\)', re.IGNORECASE)
+
+def _skip_spaces(text, i):
+    return RE_SPACES.match(text, i).end()
+
+def match_option_label(text, letters):
+    """Nhãn phương án ở đầu đoạn: [*] <chữ trong letters> (. hoặc )) [*], cho phép khoảng trắng xen giữa.
+    Trả về (vị trí hết nhãn, có dấu *) hoặc None."""
+    i = _skip_spaces(text, 0)
+    star = i < len(text) and text[i] in STAR_MARKS
+    if star: i = _skip_spaces(text, i + 1)
+    if i >= len(text) or text[i] not in letters: return None
+    i = _skip_spaces(text, i + 1)
+    if i >= len(text) or text[i] not in ".)": return None
+    i += 1
+    if i < len(text) and text[i] in STAR_MARKS: return i + 1, True
+    return i, star
+
+def match_question_label(text):
+    """"Câu <số>" ở đầu đoạn (không phân biệt hoa thường) + dấu phân cách [khoảng trắng : . - )].
+    Trả về (số ký tự khoảng trắng đầu, vị trí hết nhãn, số câu gốc) hoặc None."""
+    n = len(text)
+    lead = _skip_spaces(text, 0)
+    if text[lead:lead + 3].lower() != "câu": return None
+    start = _skip_spaces(text, lead + 3)
+    if start == lead + 3: return None
+    end = start
+    while end < n and text[end].isdecimal(): end += 1
+    if end == start: return None
+    number = text[start:end]
+    while end < n and (text[end].isspace() or text[end] in ":.-)"): end += 1
+    return lead, end, number
+
+def has_dung_mark(text):
+    return RE_DUNG_MARK.search(text) is not None
+
+def strip_dung_marks(text):
+    return RE_DUNG_MARK.sub('', text)
+
+
 def get_text_from_element(element):
     return "".join(node.text for node in element.iter() if node.tag.endswith('t') and node.text)
 
@@ -57,26 +168,98 @@ def remove_bold(r):
         bCs = rPr.find(f'{{{WORD_NS["w"]}}}bCs')
         if bCs is not None: rPr.remove(bCs)
 
-def check_and_clean_answer_formatting(run_element):
-    is_correct = False
-    rPr = run_element.find('w:rPr', namespaces=WORD_NS)
-    if rPr is not None:
-        color = rPr.find('w:color', namespaces=WORD_NS)
-        if color is not None:
-            val = color.get(f'{{{WORD_NS["w"]}}}val', '').lower()
-            if val in ['ff0000', 'red', 'c00000', 'e36c09', 'e52237']:
-                is_correct = True; rPr.remove(color) 
-        u = rPr.find('w:u', namespaces=WORD_NS)
-        if u is not None:
-            val = u.get(f'{{{WORD_NS["w"]}}}val', '').lower()
-            if val != 'none':
-                is_correct = True; rPr.remove(u) 
-    return is_correct
+def make_label_run(text):
+    new_run = OxmlElement('w:r')
+    rPr = OxmlElement('w:rPr')
+    rPr.append(OxmlElement('w:b'))
+    rPr.append(OxmlElement('w:bCs'))
+
+    rFonts = OxmlElement('w:rFonts')
+    rFonts.set(qn('w:ascii'), 'Times New Roman')
+    rFonts.set(qn('w:hAnsi'), 'Times New Roman')
+    rFonts.set(qn('w:cs'), 'Times New Roman')
+    rPr.append(rFonts)
+    new_run.append(rPr)
+
+    t = OxmlElement('w:t')
+    t.set(qn('xml:space'), 'preserve')
+    t.text = text
+    new_run.append(t)
+    return new_run
+
+class RunSpanIndex:
+    """Chỉ mục offset ký tự theo run của MỘT đoạn văn (tổng tiền tố độ dài w:t).
+
+    Mọi thao tác chỉ cắt từ đầu đoạn, nên sau khi cắt, offset logic = offset gốc - base.
+    Tìm run chứa một offset bằng bisect (O(log n)), chỉ động vào các run bị ảnh hưởng.
+    """
+    __slots__ = ('p', 'runs', 'nodes', 'ends', 'tabs', 'text', 'base')
+
+    def __init__(self, p):
+        self.p = p
+        self.runs, self.nodes, self.ends, self.tabs = [], [], [], []
+        parts, total = [], 0
+        for run in p.iter(W_R):
+            t_node = run.find(W_T)
+            if t_node is not None and t_node.text:
+                total += len(t_node.text)
+                parts.append(t_node.text)
+                self.runs.append(run); self.nodes.append(t_node); self.ends.append(total)
+            self.tabs.extend(run.iter(W_TAB))
+        self.text = "".join(parts)
+        self.base = 0
+
+    def delete_prefix(self, k, unbold=False):
+        # Xoá ký tự [0, k) (tính theo offset hiện tại) xuyên qua các run, rồi cắt khoảng trắng đầu
+        target = self.base + k
+        first = bisect_right(self.ends, self.base)
+        last = bisect_right(self.ends, target)
+        for i in range(first, last):
+            self.nodes[i].text = ""
+            if unbold: remove_bold(self.runs[i])
+        if last < len(self.nodes):
+            t_node = self.nodes[last]
+            cut = target - (self.ends[last] - len(t_node.text))
+            if cut > 0:
+                t_node.text = t_node.text[cut:]
+                if unbold: remove_bold(self.runs[last])
+        self.base = target
+        self.lstrip()
+
+    def lstrip(self):
+        i = bisect_right(self.ends, self.base)
+        while i < len(self.nodes):
+            t_node = self.nodes[i]
+            stripped = t_node.text.lstrip()
+            self.base += len(t_node.text) - len(stripped)
+            t_node.text = stripped
+            if stripped: break
+            i += 1
+
+    def strip_tabs_and_indent(self):
+        for tab in self.tabs:
+            parent = tab.getparent()
+            if parent is not None: parent.remove(tab)
+        self.tabs = []
+        pPr = self.p.find(W_PPR)
+        if pPr is not None:
+            ind = pPr.find(W_IND)
+            if ind is not None: pPr.remove(ind)
+
+    def insert_label_run(self, text):
+        # Run nhãn mới không nằm trong chỉ mục: offset vẫn tính trên phần nội dung gốc
+        new_run = make_label_run(text)
+        pPr = self.p.find(W_PPR)
+        if pPr is not None:
+            pPr.addnext(new_run)
+        else:
+            self.p.insert(0, new_run)
+        return new_run
 
 def clean_marker_tags(element):
     text = get_text_from_element(element)
-    if re.search(r'\[P[1-4]\]', text, re.IGNORECASE):
-        cleaned_text = re.sub(r'\[P[1-4]\]\s*', '', text, flags=re.IGNORECASE)
+    if RE_MARKER_TAG.search(text):
+        cleaned_text = RE_MARKER_TAG_SUB.sub('', text)
         runs = element.findall('.//w:r', namespaces=WORD_NS)
         first = True
         for run in runs:
@@ -94,13 +277,17 @@ def create_field_code_element(field_type):
     fldChar3 = OxmlElement('w:fldChar'); fldChar3.set(qn('w:fldCharType'), 'end')
     return [fldChar1, instrText, fldChar2, t, fldChar3]
 
+# Bitmask độ phức tạp của 1 phần tử (0 = chữ thường)
+COMPLEX_MATH, COMPLEX_OBJECT, COMPLEX_PICTURE = 1, 2, 4
+COMPLEX_TAGS = {'oMath': COMPLEX_MATH, 'oMathPara': COMPLEX_MATH, 'object': COMPLEX_OBJECT,
+                'pict': COMPLEX_PICTURE, 'shape': COMPLEX_PICTURE, 'drawing': COMPLEX_PICTURE}
+
 def analyze_complexity(el):
-    has_complex = False
+    mask = 0
     for node in el.iter():
-        tag = node.tag.split('}')[-1] if '}' in node.tag else node.tag
-        if tag in ['object', 'oMath', 'oMathPara', 'pict', 'shape', 'drawing']:
-            has_complex = True; break
-    return has_complex
+        if not isinstance(node.tag, str): continue
+        mask |= COMPLEX_TAGS.get(node.tag.rpartition('}')[2], 0)
+    return mask
 
 def clean_paragraph_for_table(p):
     for run in p.findall(f'.//{{{WORD_NS["w"]}}}r'):
@@ -221,202 +408,491 @@ def build_standard_header(doc, config_data, ma_de):
 # =====================================================================
 # MODULE 3: PARSER
 # =====================================================================
+# =====================================================================
+# [CHUẨN HOÁ ĐỀ GỐC]: BỎ RÁC MARKUP + GỘP RUN CÙNG ĐỊNH DẠNG (1 LẦN / FILE)
+# =====================================================================
+
+COMPACT_SOURCE = os.environ.get("ARENA_COMPACT_SOURCE", "1") == "1"
+W_PROOF_ERR, W_LAST_BREAK = qn('w:proofErr'), qn('w:lastRenderedPageBreak')
+W_BOOKMARK_START, W_BOOKMARK_END = qn('w:bookmarkStart'), qn('w:bookmarkEnd')
+W_INSTR, W_ANCHOR, W_NAME, W_ID = qn('w:instrText'), qn('w:anchor'), qn('w:name'), qn('w:id')
+W_RSID_PREFIX = qn('w:rsid')
+XML_SPACE = qn('xml:space')
+
+def _run_merge_key(run):
+    # Chỉ gộp run dạng đơn giản [rPr] + 1 w:t; khoá = thuộc tính run + rPr đã serialize
+    children = len(run)
+    if children == 0 or children > 2: return None
+    rPr = run[0] if run[0].tag == W_RPR else None
+    t_node = run[children - 1]
+    if t_node.tag != W_T or (children == 2 and rPr is None): return None
+    return (tuple(sorted(run.attrib.items())), etree.tostring(rPr) if rPr is not None else b"")
+
+def _label_runs(body):
+    # Run chạm vào nhãn phương án ("A.", "*b)") ở đầu đoạn: không gộp với run sau. delete_prefix(unbold=True)
+    # bỏ đậm cả run chứa nhãn, gộp thêm chữ phía sau vào run đó sẽ làm mất đậm của chữ (đổi hiển thị)
+    protected = set()
+    for p in body.iter(W_P):
+        runs, texts = [], []
+        for run in p.iter(W_R):
+            t_node = run.find(W_T)
+            if t_node is not None and t_node.text:
+                runs.append(run); texts.append(t_node.text)
+        label = match_option_label("".join(texts), "ABCDabcd") if runs else None
+        if not label: continue
+        start = 0
+        for run, text in zip(runs, texts):
+            if start >= label[0]: break
+            protected.add(run)
+            start += len(text)
+    return protected
+
+def compact_document(doc):
+    """Bỏ w:proofErr, w:lastRenderedPageBreak, thuộc tính w:rsid*, bookmark rỗng / _GoBack không ai tham chiếu,
+    rồi gộp các run liền kề có rPr giống hệt. Không đổi hiển thị; trả về thống kê trước/sau."""
+    body = doc._body._body
+    before = len(etree.tostring(body))
+    stats = {"proof_errors": 0, "page_break_hints": 0, "rsid_attributes": 0, "bookmarks": 0, "merged_runs": 0}
+
+    for el in list(body.iter(W_PROOF_ERR, W_LAST_BREAK)):
+        stats["proof_errors" if el.tag == W_PROOF_ERR else "page_break_hints"] += 1
+        el.getparent().remove(el)
+
+    for el in body.iter():
+        if not isinstance(el.tag, str): continue
+        rsids = [key for key in el.attrib if key.startswith(W_RSID_PREFIX)]
+        for key in rsids: del el.attrib[key]
+        stats["rsid_attributes"] += len(rsids)
+
+    # Bookmark được trường REF/PAGEREF hoặc hyperlink nội bộ dùng thì giữ nguyên
+    referenced = " ".join(el.text or "" for el in body.iter(W_INSTR))
+    anchors = {el.get(W_ANCHOR) for el in body.iter() if isinstance(el.tag, str) and el.get(W_ANCHOR)}
+    ends = {el.get(W_ID): el for el in body.iter(W_BOOKMARK_END)}
+    for start in list(body.iter(W_BOOKMARK_START)):
+        name, end = start.get(W_NAME, ""), ends.get(start.get(W_ID))
+        if end is None or name in anchors or (name and name in referenced): continue
+        if name == "_GoBack" or start.getnext() is end:
+            start.getparent().remove(start); end.getparent().remove(end)
+            stats["bookmarks"] += 1
+
+    protected = _label_runs(body)
+    prev_run, prev_key = None, None
+    for run in list(body.iter(W_R)):
+        key = _run_merge_key(run)
+        if key is not None and key == prev_key and run.getprevious() is prev_run and prev_run not in protected:
+            prev_t, t_node = prev_run[len(prev_run) - 1], run[len(run) - 1]
+            prev_t.text = (prev_t.text or "") + (t_node.text or "")
+            if t_node.get(XML_SPACE) or prev_t.text != prev_t.text.strip(): prev_t.set(XML_SPACE, "preserve")
+            run.getparent().remove(run)
+            stats["merged_runs"] += 1
+            continue
+        prev_run, prev_key = run, key
+
+    after = len(etree.tostring(body))
+    stats.update(xml_bytes_before=before, xml_bytes_after=after,
+                 saved_percent=round(100.0 * (before - after) / before, 1) if before else 0.0)
+    return stats
+
+# =====================================================================
+# [TỐI ƯU ẢNH]: THU NHỎ VỀ KÍCH THƯỚC HIỂN THỊ, NÉN LẠI, GỘP ẢNH TRÙNG (1 LẦN / FILE)
+# =====================================================================
+# Cần Pillow cho bước thu nhỏ / nén lại; thiếu Pillow thì chỉ gộp ảnh trùng.
+
+OPTIMIZE_MEDIA = os.environ.get("ARENA_OPTIMIZE_MEDIA", "1") == "1"
+MEDIA_DPI = int(os.environ.get("ARENA_MEDIA_DPI", "200"))
+MEDIA_JPEG_QUALITY = int(os.environ.get("ARENA_MEDIA_JPEG_QUALITY", "85"))
+EMU_PER_INCH = 914400
+A_BLIP, A_SRC_RECT = qn('a:blip'), qn('a:srcRect')
+WP_INLINE, WP_ANCHOR, WP_EXTENT = qn('wp:inline'), qn('wp:anchor'), qn('wp:extent')
+R_EMBED = qn('r:embed')
+
+def _image_usages(package):
+    # image part -> (cx, cy) lớn nhất mà đề hiển thị (EMU); None = không biết (VML, ảnh bị crop) -> không thu nhỏ
+    usages, sources = {}, []
+    for part in package.iter_parts():
+        element = getattr(part, "_element", None)
+        if element is None: continue
+        sources.append(part)
+        for blip in element.iter(A_BLIP):
+            rel = part.rels.get(blip.get(R_EMBED))
+            if rel is None or rel.is_external: continue
+            target = rel.target_part
+            holder = next(blip.iterancestors(WP_INLINE, WP_ANCHOR), None)
+            extent = holder.find(WP_EXTENT) if holder is not None else None
+            src_rect = blip.getparent().find(A_SRC_RECT)
+            if extent is None or (src_rect is not None and len(src_rect.attrib)):
+                usages[target] = None; continue
+            size = (int(extent.get('cx', 0)), int(extent.get('cy', 0)))
+            if target in usages and usages[target] is None: continue
+            old = usages.get(target, (0, 0))
+            usages[target] = (max(old[0], size[0]), max(old[1], size[1]))
+    return usages, sources
+
+def _reencode_image(blob, content_type, displayed, stats):
+    try:
+        from PIL import Image  # import lười: Pillow là phụ thuộc tuỳ chọn
+    except ImportError:
+        return blob, content_type
+    try:
+        img = Image.open(io.BytesIO(blob))
+        fmt = img.format
+        if fmt not in ("PNG", "JPEG"): return blob, content_type
+        exif = img.info.get("exif")
+        if displayed and displayed[0] > 0:
+            target_w = math.ceil(displayed[0] / EMU_PER_INCH * MEDIA_DPI)
+            if img.width > target_w * 1.05:
+                target_h = max(1, round(img.height * target_w / img.width))
+                img = img.resize((target_w, target_h), Image.LANCZOS)
+                stats["resized"] += 1
+
+        out = io.BytesIO()
+        if fmt == "JPEG":
+            img.save(out, "JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True, **({"exif": exif} if exif else {}))
+        else:
+            img.save(out, "PNG", optimize=True)
+        best, best_type = out.getvalue(), content_type
+
+        # Ảnh chụp dán dưới dạng PNG: đổi sang JPEG nếu ảnh không trong suốt và nhỏ hơn hẳn
+        if fmt == "PNG" and img.mode in ("RGB", "L", "RGBA") and (img.mode != "RGBA" or img.getchannel("A").getextrema()[0] == 255):
+            jpeg = io.BytesIO()
+            img.convert("RGB" if img.mode != "L" else "L").save(jpeg, "JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True)
+            if jpeg.tell() < len(best) // 2:
+                best, best_type = jpeg.getvalue(), "image/jpeg"
+                stats["converted_to_jpeg"] += 1
+        if len(best) >= len(blob): return blob, content_type
+        stats["recompressed"] += 1
+        return best, best_type
+    except Exception:
+        return blob, content_type  # ảnh lỗi / định dạng lạ: giữ nguyên
+
+# Ảnh tối ưu sẵn trên đĩa (upload theo khúc tối ưu từng ảnh ngay khi ảnh tải xong, xem MODULE 18);
+# khoá = nội dung ảnh + kích thước hiển thị + DPI/chất lượng -> tiến trình con nào cũng dùng được.
+MEDIA_CACHE_DIR = os.environ.get("ARENA_MEDIA_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "arena-media")
+MEDIA_STATS = ("resized", "recompressed", "converted_to_jpeg")
+
+def media_cache_path(blob, displayed):
+    size = f"{displayed[0]}x{displayed[1]}" if displayed else "goc"
+    return os.path.join(MEDIA_CACHE_DIR, f"{hashlib.sha1(blob).hexdigest()}-{size}-{MEDIA_DPI}-{MEDIA_JPEG_QUALITY}.img")
+
+def store_reencoded_image(blob, displayed):
+    # File cache: 1 dòng JSON (thống kê, có giữ ảnh gốc không) rồi tới bytes ảnh mới
+    stats = dict.fromkeys(MEDIA_STATS, 0)
+    out, content_type = _reencode_image(blob, None, displayed, stats)
+    path = media_cache_path(blob, displayed)
+    os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.tmp{threading.get_ident()}"
+    with open(tmp, "wb") as f:
+        f.write(json.dumps({"stats": stats, "kept": out is blob, "jpeg": content_type == "image/jpeg"}).encode() + b"\n")
+        if out is not blob: f.write(out)
+    os.replace(tmp, path)
+
+def reencode_image(blob, content_type, displayed, stats):
+    try:
+        with open(media_cache_path(blob, displayed), "rb") as f:
+            cached, data = json.loads(f.readline()), f.read()
+    except (OSError, ValueError):
+        return _reencode_image(blob, content_type, displayed, stats)
+    for key, n in cached["stats"].items(): stats[key] += n
+    if cached["kept"]: return blob, content_type
+    return data, "image/jpeg" if cached["jpeg"] else content_type
+
+def optimize_media(doc):
+    """Gộp các media part trùng nội dung, thu nhỏ ảnh về kích thước hiển thị (wp:extent) ở MEDIA_DPI,
+    nén lại PNG/JPEG. Các đề nạp lại từ bản đã tối ưu nên dùng chung media đã xử lý."""
+    package = doc.part.package
+    usages, sources = _image_usages(package)
+    stats = {"images": len(usages), "duplicates": 0, "resized": 0, "recompressed": 0, "converted_to_jpeg": 0,
+             "bytes_before": sum(len(p.blob) for p in usages), "bytes_after": 0}
+
+    canonical, by_digest = {}, {}
+    for image_part in usages:
+        first = by_digest.setdefault(hashlib.sha1(image_part.blob).digest(), image_part)
+        if first is not image_part:
+            canonical[image_part] = first
+            stats["duplicates"] += 1
+            a, b = usages[first], usages[image_part]
+            usages[first] = None if a is None or b is None else (max(a[0], b[0]), max(a[1], b[1]))
+    for part in sources:
+        for rel in part.rels.values():
+            if not rel.is_external and rel.target_part in canonical:
+                rel._target = canonical[rel.target_part]
+
+    for image_part, displayed in usages.items():
+        if image_part in canonical: continue
+        blob, content_type = reencode_image(image_part.blob, image_part.content_type, displayed, stats)
+        if blob is not image_part.blob:
+            image_part._blob = blob
+            if hasattr(image_part, "_image"): image_part._image = None
+            if content_type != image_part.content_type:
+                image_part._content_type = content_type
+                image_part.partname = package.next_partname("/word/media/image%d.jpeg")
+        stats["bytes_after"] += len(image_part.blob)
+    return stats
+
+def prepare_source(content, compact=True, media=True):
+    # Chạy 1 lần trước vòng lặp các đề: mọi đề sau đó nạp bản đã chuẩn hoá / đã tối ưu ảnh
+    # Đề có trong kho đề gốc (MODULE 19): dùng lại bản đã chuẩn bị của lần trộn trước
+    report = {}
+    if not (compact or media): return content, report
+    document_id = hashlib.sha256(content).hexdigest() if DOCUMENT_STORE else None
+    cached = load_prepared_source(document_id, compact, media) if document_id else None
+    if cached is not None: return cached
+    doc = Document(io.BytesIO(content))
+    if compact: report["compaction"] = compact_document(doc)
+    if media: report["media"] = optimize_media(doc)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    if document_id: store_prepared_source(document_id, compact, media, buffer.getvalue(), report)
+    return buffer.getvalue(), report
+
+# =====================================================================
+# [MÔ HÌNH CÂU HỎI]: OBJECT GỌN (__slots__) THAY CHO DICT
+# =====================================================================
+
+ZONES = ["P1", "P2", "P3", "P4"]
+
+class Option:
+    """1 phương án: các phần tử XML, cờ đúng, vị trí gốc, độ dài chữ đoạn đầu (sau khi gắn nhãn mới),
+    bitmask độ phức tạp, có xuống dòng (w:br) hay không và run nhãn mới ("B. ") nếu có."""
+    __slots__ = ('xml', 'is_correct', 'orig', 'text_len', 'complexity', 'has_br', 'label')
 
-def parse_docx(doc):
+    def __init__(self, xml, is_correct, orig):
+        self.xml, self.is_correct, self.orig = xml, is_correct, orig
+        self.text_len, self.complexity, self.has_br, self.label = 0, 0, False, None
+
+class Question:
+    """1 câu hỏi: xml (sau khi trộn là khối đã dàn trang), số thứ tự gốc, đáp án, hoán vị phương án, layout 1/2/4,
+    run nhãn mới ("Câu 3: ") và danh sách Option theo vị trí sau khi trộn (chỉ P1/P2)."""
+    __slots__ = ('xml', 'zone', 'src', 'ans', 'perm', 'layout', 'label', 'options')
+
+    def __init__(self, xml, zone):
+        self.xml, self.zone = xml, zone
+        self.src, self.ans, self.perm, self.layout = None, None, None, None
+        self.label, self.options = None, None
+
+class Zone:
+    __slots__ = ('name', 'header', 'questions')
+
+    def __init__(self, name):
+        self.name, self.header, self.questions = name, [], []
+
+def parse_docx(doc, costs=None):
+    # costs: dict phần tử XML -> giây đọc chữ + khớp nhãn, chỉ dùng khi phân tích đề chậm (MODULE 17)
     body = doc._body._body
-    parsed_data = {
-        "header": [], "P1": [], "P1_header": [], "P2": [], "P2_header": [],
-        "P3": [], "P3_header": [], "P4": [], "P4_header": []
-    }
+    parsed_data = {z: Zone(z) for z in ZONES}
     
     current_zone = "trash" 
     current_block = []
 
     for element in body:
+        t0 = time.perf_counter() if costs is not None else 0
         text = get_text_from_element(element)
         text_upper = text.strip().upper()
         
         if text_upper in ["HẾT", "---HẾT---", "HẾT.", "-HẾT-", "HẾT"]:
             continue
 
-        if "[P1]" in text_upper or re.match(r'^PHẦN\s+(I|1|MỘT)\b', text_upper):
-            if current_block and current_zone in parsed_data: parsed_data[current_zone].append({'xml': current_block})
-            current_zone, current_block = "P1", []; clean_marker_tags(element); parsed_data["P1_header"].append(element); continue
-        elif "[P2]" in text_upper or re.match(r'^PHẦN\s+(II|2|HAI)\b', text_upper):
-            if current_block and current_zone in parsed_data: parsed_data[current_zone].append({'xml': current_block})
-            current_zone, current_block = "P2", []; clean_marker_tags(element); parsed_data["P2_header"].append(element); continue
-        elif "[P3]" in text_upper or re.match(r'^PHẦN\s+(III|3|BA)\b', text_upper):
-            if current_block and current_zone in parsed_data: parsed_data[current_zone].append({'xml': current_block})
-            current_zone, current_block = "P3", []; clean_marker_tags(element); parsed_data["P3_header"].append(element); continue
-        elif "[P4]" in text_upper or re.match(r'^PHẦN\s+(IV|4|BỐN)\b', text_upper):
-            if current_block and current_zone in parsed_data: parsed_data[current_zone].append({'xml': current_block})
-            current_zone, current_block = "P4", []; clean_marker_tags(element); parsed_data["P4_header"].append(element); continue
-
-        if current_zone in ["P1", "P2", "P3", "P4"]:
-            if re.match(r'^Câu\s+\d+[:.\s]?', text.strip(), re.IGNORECASE):
-                if current_block: parsed_data[current_zone].append({'xml': current_block})
+        new_zone = None
+        for zone, zone_re in RE_ZONE_HEADERS:
+            if f"[{zone}]" in text_upper or zone_re.match(text_upper):
+                new_zone = zone; break
+        if new_zone:
+            if current_block and current_zone in parsed_data: parsed_data[current_zone].questions.append(Question(current_block, current_zone))
+            current_zone, current_block = new_zone, []; clean_marker_tags(element); parsed_data[new_zone].header.append(element); continue
+
+        if current_zone in parsed_data:
+            if match_question_label(text.strip()):
+                if current_block: parsed_data[current_zone].questions.append(Question(current_block, current_zone))
                 current_block = [element]
             else:
                 if current_block: 
                     current_block.append(element)
                 else:
-                    parsed_data[f"{current_zone}_header"].append(element)
+                    parsed_data[current_zone].header.append(element)
+            if costs is not None: costs[element] = time.perf_counter() - t0
 
-    if current_block and current_zone in ["P1", "P2", "P3", "P4"]: parsed_data[current_zone].append({'xml': current_block})
+    if current_block and current_zone in parsed_data: parsed_data[current_zone].questions.append(Question(current_block, current_zone))
     return parsed_data
 
 # =====================================================================
 # MODULE 4: SHUFFLE & FLEXIBLE LAYOUT
 # =====================================================================
-def process_options_and_extract_p1_p2(doc, block, zone_type, question_text):
-    pattern = r'^\s*(\*|∗)?\s*([A-D])\s*[.)](\*|∗)?' if zone_type == "P1" else r'^\s*(\*|∗)?\s*([a-d])\s*[.)](\*|∗)?'
-    labels = ['A', 'B', 'C', 'D'] if zone_type == "P1" else ['a', 'b', 'c', 'd']
-    stem, options, current_opt = [], [], None
-    
-    for el in block:
+# =====================================================================
+# [NHẬN DIỆN ĐÁP ÁN ĐÚNG]: 1 LẦN / CÂU, GHI LẠI THÀNH BẢN GHI, ÁP LẠI CHO MỌI ĐỀ
+# =====================================================================
+
+ANSWER_COLORS = ['ff0000', 'red', 'c00000', 'e36c09', 'e52237']
+_UPPER, _LOWER = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'
+
+# Một truy vấn duy nhất lọc ra các run ứng viên: tô màu đáp án, gạch chân, hoặc có dấu "(" (đúng)
+ANSWER_MARKER_XPATH = etree.XPath(
+    "descendant-or-self::w:r["
+    f"w:rPr/w:color[contains('|{'|'.join(ANSWER_COLORS)}|', concat('|', translate(@w:val, '{_UPPER}', '{_LOWER}'), '|'))]"
+    f" or w:rPr/w:u[not(translate(@w:val, '{_UPPER}', '{_LOWER}') = 'none')]"
+    " or w:t[contains(., '(')]]",
+    namespaces=WORD_NS)
+
+DROP_COLOR, DROP_U, STRIP_DUNG = 1, 2, 4
+
+class AnswerRecord:
+    """Kết quả nhận diện của 1 câu P1/P2, tính trên đề gốc và áp lại cho từng bản sao.
+
+    stem: chỉ số phần tử thuộc phần dẫn; options: (chỉ số phần tử, is_correct) theo thứ tự gốc;
+    edits: (chỉ số phần tử, thứ tự run trong phần tử, cờ DROP_COLOR | DROP_U | STRIP_DUNG).
+    layout / option_meta: layout 1/2/4 và (text_len, complexity, has_br) theo thứ tự gốc; không phụ thuộc
+    thứ tự trộn nên chỉ đo ở đề đầu tiên, các đề sau đọc lại.
+    """
+    __slots__ = ('stem', 'options', 'edits', 'layout', 'option_meta')
+
+    def __init__(self, stem, options, edits):
+        self.stem, self.options, self.edits = stem, options, edits
+        self.layout, self.option_meta = None, None
+
+def _scan_marker_runs(el, el_idx, text_runs_only, edits, dung_nodes):
+    hits = ANSWER_MARKER_XPATH(el)
+    if not hits: return False
+    run_order = {run: n for n, run in enumerate(el.iter(W_R))}
+    is_correct = False
+    for run in hits:
+        flags, has_format = 0, False
+        rPr = run.find(W_RPR)
+        if rPr is not None:
+            color = rPr.find(W_COLOR)
+            if color is not None and color.get(W_VAL, '').lower() in ANSWER_COLORS:
+                flags |= DROP_COLOR; has_format = True
+            u = rPr.find(W_U)
+            if u is not None and u.get(W_VAL, '').lower() != 'none':
+                flags |= DROP_U; has_format = True
+        t_node = run.find(W_T)
+        has_text = t_node is not None and bool(t_node.text)
+        if has_text and has_dung_mark(t_node.text):
+            flags |= STRIP_DUNG; dung_nodes.add(t_node)
+        if has_format and (has_text or not text_runs_only): is_correct = True
+        if flags: edits.append((el_idx, run_order[run], flags))
+    return is_correct
+
+def _text_after_edits(el, dung_nodes):
+    return "".join(strip_dung_marks(node.text) if node in dung_nodes else node.text
+                   for node in el.iter() if node.tag.endswith('t') and node.text)
+
+def detect_answer_markers(block, zone_type):
+    # Chỉ đọc, không sửa cây XML: mọi chỉnh sửa được ghi vào edits để áp cho từng đề
+    letters = OPTION_LETTERS[zone_type]
+    stem, options, edits, dung_nodes = [], [], [], set()
+    current_opt = None
+
+    for i, el in enumerate(block):
         if el.tag.endswith('p'):
             text = get_text_from_element(el)
-            match = re.match(pattern, text)
-            if match:
-                if current_opt is not None: options.append(current_opt)
-                current_opt = {'xml': [el], 'is_correct': False}
-                
-                if match.group(1) or match.group(3) or re.search(r'\(\s*đ(?:úng)?\s*\)', text, re.IGNORECASE):
-                    current_opt['is_correct'] = True
-                
-                for run in el.findall('.//w:r', namespaces=WORD_NS):
-                    has_format = check_and_clean_answer_formatting(run)
-                    t_node = run.find('w:t', namespaces=WORD_NS)
-                    if t_node is not None and t_node.text:
-                        t_node.text = re.sub(r'\(\s*đ(?:úng)?\s*\)', '', t_node.text, flags=re.IGNORECASE)
-                        if has_format: current_opt['is_correct'] = True
-            else:
-                if current_opt is not None:
-                    current_opt['xml'].append(el)
-                    p_text = get_text_from_element(el)
-                    if re.search(r'\(\s*đ(?:úng)?\s*\)', p_text, re.IGNORECASE):
-                         current_opt['is_correct'] = True
-                    for run in el.findall('.//w:r', namespaces=WORD_NS):
-                        if check_and_clean_answer_formatting(run): current_opt['is_correct'] = True
-                        t_node = run.find('w:t', namespaces=WORD_NS)
-                        if t_node is not None and t_node.text:
-                            t_node.text = re.sub(r'\(\s*đ(?:úng)?\s*\)', '', t_node.text, flags=re.IGNORECASE)
-                else: stem.append(el)
+            label = match_option_label(text, letters)
+            if label:
+                current_opt = [[i], bool(label[1] or has_dung_mark(text))]
+                options.append(current_opt)
+                if _scan_marker_runs(el, i, True, edits, dung_nodes): current_opt[1] = True
+            elif current_opt is not None:
+                current_opt[0].append(i)
+                if has_dung_mark(text): current_opt[1] = True
+                if _scan_marker_runs(el, i, False, edits, dung_nodes): current_opt[1] = True
+            else: stem.append(i)
         else:
-            if current_opt is not None: current_opt['xml'].append(el)
-            else: stem.append(el)
-                
-    if current_opt is not None: options.append(current_opt)
+            if current_opt is not None: current_opt[0].append(i)
+            else: stem.append(i)
+
     for opt in options:
-        while len(opt['xml']) > 1 and not get_text_from_element(opt['xml'][-1]).strip(): opt['xml'].pop()
+        while len(opt[0]) > 1 and not _text_after_edits(block[opt[0][-1]], dung_nodes).strip(): opt[0].pop()
 
-    if len(options) != 4: return block, "A", f"{zone_type} - {question_text} LỖI ĐỊNH DẠNG: Yêu cầu 4 đáp án tách rời."
-    
-    correct_count = sum(1 for opt in options if opt['is_correct'])
+    return AnswerRecord(tuple(stem), tuple((tuple(idxs), is_correct) for idxs, is_correct in options), tuple(edits))
+
+def apply_answer_record(block, record):
+    runs_of = {}
+    for el_idx, run_idx, flags in record.edits:
+        runs = runs_of.get(el_idx)
+        if runs is None: runs = runs_of[el_idx] = list(block[el_idx].iter(W_R))
+        run = runs[run_idx]
+        if flags & (DROP_COLOR | DROP_U):
+            rPr = run.find(W_RPR)
+            if flags & DROP_COLOR: rPr.remove(rPr.find(W_COLOR))
+            if flags & DROP_U: rPr.remove(rPr.find(W_U))
+        if flags & STRIP_DUNG:
+            t_node = run.find(W_T)
+            t_node.text = strip_dung_marks(t_node.text)
+
+    stem = [block[i] for i in record.stem]
+    options = [Option([block[i] for i in idxs], is_correct, orig) for orig, (idxs, is_correct) in enumerate(record.options)]
+    return stem, options
+
+def answer_record_error(record, zone_type, question_text):
+    # Dùng chung cho lúc trộn và /api/preview -> cùng 1 thông báo lỗi
+    if len(record.options) != 4: return f"{zone_type} - {question_text} LỖI ĐỊNH DẠNG: Yêu cầu 4 đáp án tách rời."
+    correct_count = sum(1 for _, is_correct in record.options if is_correct)
     if zone_type == "P1":
         if correct_count == 0:
-            return block, "A", f"PHẦN I - {question_text} CHƯA có đáp án đúng (thiếu dấu *)."
+            return f"PHẦN I - {question_text} CHƯA có đáp án đúng (thiếu dấu *)."
         elif correct_count > 1:
-            return block, "A", f"PHẦN I - {question_text} LỖI LOGIC: Có đến {correct_count} đáp án đúng. Phần I chỉ cho phép DUY NHẤT 1 đáp án đúng!"
+            return f"PHẦN I - {question_text} LỖI LOGIC: Có đến {correct_count} đáp án đúng. Phần I chỉ cho phép DUY NHẤT 1 đáp án đúng!"
+    return None
+
+def choose_layout(options, zone_type):
+    # 1 = mỗi phương án 1 dòng, 2 = bảng 2x2, 4 = 1 hàng 4 ô
+    can_merge = all(len(opt.xml) == 1 for opt in options)
+    if zone_type == "P2" or not can_merge or any(opt.has_br for opt in options): return 1
+    max_len = max(opt.text_len for opt in options)
+    if any(opt.complexity for opt in options): return 2 if max_len <= 20 else 1
+    if max_len <= 12: return 4
+    elif max_len <= 40: return 2
+    return 1
+
+def measure_options(record, options, zone_type):
+    # Đo sau khi đã gắn nhãn mới (độ dài nhãn như nhau ở mọi vị trí) -> kết quả dùng chung cho mọi đề
+    w_br = f'.//{{{WORD_NS["w"]}}}br'
+    for opt in options:
+        opt.has_br = any(el.find(w_br) is not None for el in opt.xml)
+        opt.text_len = len(get_text_from_element(opt.xml[0]))
+        opt.complexity = analyze_complexity(opt.xml[0])
+    meta = [None] * len(options)
+    for opt in options: meta[opt.orig] = (opt.text_len, opt.complexity, opt.has_br)
+    record.option_meta, record.layout = tuple(meta), choose_layout(options, zone_type)
+
+def process_options_and_extract_p1_p2(doc, block, zone_type, question_text, record=None):
+    labels = ['A', 'B', 'C', 'D'] if zone_type == "P1" else ['a', 'b', 'c', 'd']
+    if record is None: record = detect_answer_markers(block, zone_type)
+    stem, options = apply_answer_record(block, record)
+
+    err = answer_record_error(record, zone_type, question_text)
+    if err: return block, "A", err, None, None
             
     random.shuffle(options)
     ans_result = ""
+    # perm[i] = nhãn GỐC của phương án đang đứng ở vị trí i (dùng để quy đổi khi phân tích câu hỏi)
+    perm = "".join(labels[opt.orig] for opt in options)
 
     for idx, opt in enumerate(options):
-        first_p = opt['xml'][0]
-        p_text = get_text_from_element(first_p)
-        
-        search_pattern = r'^.*?(\*|∗)?\s*([A-D]|[a-d])\s*[.)](\*|∗)?'
-        match = re.search(search_pattern, p_text, re.IGNORECASE)
+        spans = RunSpanIndex(opt.xml[0])
+        label = match_option_label(spans.text, "ABCDabcd")
         
-        if match:
-            chars_to_remove = match.end()
-            has_stripped_remainder = False
-            
-            for run in first_p.findall('.//w:r', namespaces=WORD_NS):
-                t_node = run.find('w:t', namespaces=WORD_NS)
-                if t_node is not None and t_node.text:
-                    if chars_to_remove > 0:
-                        run_text_len = len(t_node.text)
-                        if run_text_len <= chars_to_remove:
-                            chars_to_remove -= run_text_len
-                            t_node.text = ""
-                            remove_bold(run) 
-                        else:
-                            t_node.text = t_node.text[chars_to_remove:].lstrip()
-                            chars_to_remove = 0
-                            remove_bold(run) 
-                            if t_node.text: has_stripped_remainder = True
-                    elif not has_stripped_remainder:
-                        stripped = t_node.text.lstrip()
-                        t_node.text = stripped
-                        if t_node.text: has_stripped_remainder = True
-
-            # ========================================================
+        if label:
+            spans.delete_prefix(label[0], unbold=True)
+
             # [FIX GAPS]: DIỆT SẠCH TAB VÀ THỤT LỀ Ở ĐÁP ÁN
-            # ========================================================
-            for run in first_p.findall('.//w:r', namespaces=WORD_NS):
-                for tab in run.findall('.//w:tab', namespaces=WORD_NS):
-                    run.remove(tab)
-            pPr_opt = first_p.find(f'{{{WORD_NS["w"]}}}pPr')
-            if pPr_opt is not None:
-                ind = pPr_opt.find(f'{{{WORD_NS["w"]}}}ind')
-                if ind is not None: pPr_opt.remove(ind)
-            # ========================================================
+            spans.strip_tabs_and_indent()
 
             separator = '.' if zone_type == "P1" else ')'
-            new_run = OxmlElement('w:r')
-            rPr = OxmlElement('w:rPr')
-            b = OxmlElement('w:b')
-            bCs = OxmlElement('w:bCs')
-            rPr.append(b)
-            rPr.append(bCs)
-            
-            rFonts = OxmlElement('w:rFonts')
-            rFonts.set(qn('w:ascii'), 'Times New Roman')
-            rFonts.set(qn('w:hAnsi'), 'Times New Roman')
-            rFonts.set(qn('w:cs'), 'Times New Roman')
-            rPr.append(rFonts)
-            
-            new_run.append(rPr)
-            
-            t = OxmlElement('w:t')
-            t.set(qn('xml:space'), 'preserve')
-            t.text = f"{labels[idx]}{separator} "
-            new_run.append(t)
-            
-            pPr = first_p.find(f'{{{WORD_NS["w"]}}}pPr')
-            if pPr is not None:
-                pPr.addnext(new_run)
-            else:
-                first_p.insert(0, new_run)
+            opt.label = spans.insert_label_run(f"{labels[idx]}{separator} ")
 
         if zone_type == "P1":
-            if opt['is_correct']: ans_result = labels[idx]
+            if opt.is_correct: ans_result = labels[idx]
         else:
-            ans_result += "Đ" if opt['is_correct'] else "S"
-
-    has_br = False
-    for opt in options:
-        for el in opt['xml']:
-            if el.find(f'.//{{{WORD_NS["w"]}}}br') is not None:
-                has_br = True; break
+            ans_result += "Đ" if opt.is_correct else "S"
 
-    can_merge = all(len(opt['xml']) == 1 for opt in options)
-    if zone_type == "P2" or not can_merge or has_br: layout = 1 
+    if record.layout is None: measure_options(record, options, zone_type)
     else:
-        max_len = max(len(get_text_from_element(opt['xml'][0])) for opt in options)
-        has_complex = any(analyze_complexity(opt['xml'][0]) for opt in options)
-        if has_complex: layout = 2 if max_len <= 20 else 1
-        else:
-            if max_len <= 12: layout = 4     
-            elif max_len <= 40: layout = 2   
-            else: layout = 1                 
+        for opt in options: opt.text_len, opt.complexity, opt.has_br = record.option_meta[opt.orig]
+    layout = record.layout
             
     new_block = stem.copy()
 
     if layout == 1:
-        for opt in options: new_block.extend(opt['xml'])
+        for opt in options: new_block.extend(opt.xml)
     elif layout == 2:
         table = create_invisible_table(doc, 2, 2)
         tbl_element = table._tbl
@@ -424,7 +900,7 @@ def process_options_and_extract_p1_p2(doc, block, zone_type, question_text):
         for idx in range(4):
             cell = table.cell(idx // 2, idx % 2)
             cell._element.remove(cell.paragraphs[0]._element)
-            for el in options[idx]['xml']: 
+            for el in options[idx].xml: 
                 if el.tag.endswith('p'): clean_paragraph_for_table(el)
                 cell._element.append(el)
         new_block.append(tbl_element)
@@ -435,118 +911,78 @@ def process_options_and_extract_p1_p2(doc, block, zone_type, question_text):
         for idx in range(4):
             cell = table.cell(0, idx)
             cell._element.remove(cell.paragraphs[0]._element)
-            for el in options[idx]['xml']: 
+            for el in options[idx].xml: 
                 if el.tag.endswith('p'): clean_paragraph_for_table(el)
                 cell._element.append(el)
         new_block.append(tbl_element)
 
-    return new_block, ans_result or "A", None
+    return new_block, ans_result or "A", None, perm, options
 
-def shuffle_engine(doc, parsed_data, config_data):
+def shuffle_engine(doc, parsed_data, config_data, answer_records=None, costs=None):
+    # answer_records: dict dùng chung giữa các đề của cùng 1 file gốc -> mỗi câu chỉ nhận diện đáp án 1 lần
+    # costs: dict Question -> {"detect", "options", "label": giây}, chỉ dùng khi phân tích đề chậm (MODULE 17)
     ans_key, errors = [], []
     q_counter = 1
     
-    for z in ["P1", "P2", "P3", "P4"]:
+    for z in ZONES:
+        questions = parsed_data[z].questions
         if z in ["P1", "P2", "P3"]:
-            for q_obj in parsed_data[z]:
-                q_text_short = get_text_from_element(q_obj['xml'][0]).strip()[:40] + "..."
+            for q_index, question in enumerate(questions):
+                question.src = q_index + 1
+                q_text_short = get_text_from_element(question.xml[0]).strip()[:40] + "..."
                 if z in ["P1", "P2"]:
-                    new_block, ans, err = process_options_and_extract_p1_p2(doc, q_obj['xml'], z, q_text_short)
-                    q_obj['xml'] = new_block; q_obj['ans'] = ans
+                    t0 = time.perf_counter() if costs is not None else 0
+                    record = answer_records.get((z, q_index)) if answer_records is not None else None
+                    if record is None:
+                        record = detect_answer_markers(question.xml, z)
+                        if answer_records is not None: answer_records[(z, q_index)] = record
+                    t1 = time.perf_counter() if costs is not None else 0
+                    new_block, ans, err, perm, options = process_options_and_extract_p1_p2(doc, question.xml, z, q_text_short, record)
+                    if costs is not None: costs[question] = {"detect": t1 - t0, "options": time.perf_counter() - t1}
+                    question.xml, question.ans, question.perm, question.layout = new_block, ans, perm, record.layout
+                    question.options = options
                     if err: errors.append(err)
                 else:
+                    t0 = time.perf_counter() if costs is not None else 0
                     new_block, ans = [], None
-                    for el in q_obj['xml']:
+                    for el in question.xml:
                         is_key_line = False
                         if el.tag.endswith('p'):
-                            match = re.search(r'^\s*(?:Đáp án|ĐS|Key)\s*[:=]\s*(.*)', get_text_from_element(el).strip(), re.IGNORECASE)
+                            match = RE_KEY_LINE.search(get_text_from_element(el).strip())
                             if match: ans = match.group(1).strip(); is_key_line = True
                         if not is_key_line: new_block.append(el)
-                    q_obj['xml'] = new_block; q_obj['ans'] = ans or "..."
+                    question.xml = new_block; question.ans = ans or "..."
+                    if costs is not None: costs[question] = {"detect": time.perf_counter() - t0, "options": 0.0}
                     if not ans: errors.append(f"{z} - {q_text_short} CHƯA có dòng đáp án (Key: 123).")
                 
-            random.shuffle(parsed_data[z])
+            random.shuffle(questions)
         
-        for index, q_dict in enumerate(parsed_data[z]):
-            first_paragraph = q_dict['xml'][0] 
-            p_text = get_text_from_element(first_paragraph)
+        for index, question in enumerate(questions):
+            t0 = time.perf_counter() if costs is not None else 0
+            spans = RunSpanIndex(question.xml[0])
             
-            match = re.search(r'^(\s*)(Câu\s+\d+)([\s:.\-\)]*)', p_text, re.IGNORECASE)
-            if match:
-                leading_spaces = match.group(1)
-                full_match_str = match.group(0) 
-                chars_to_remove = len(full_match_str)
-                
-                has_stripped_remainder = False
-                for run in first_paragraph.findall('.//w:r', namespaces=WORD_NS):
-                    t_node = run.find('w:t', namespaces=WORD_NS)
-                    if t_node is not None and t_node.text:
-                        if chars_to_remove > 0:
-                            run_text_len = len(t_node.text)
-                            if run_text_len <= chars_to_remove:
-                                chars_to_remove -= run_text_len
-                                t_node.text = ""
-                            else:
-                                t_node.text = t_node.text[chars_to_remove:].lstrip()
-                                chars_to_remove = 0
-                                if t_node.text: has_stripped_remainder = True
-                        elif not has_stripped_remainder:
-                            stripped = t_node.text.lstrip()
-                            t_node.text = stripped
-                            if t_node.text: has_stripped_remainder = True
-
-                # ========================================================
+            label = match_question_label(spans.text)
+            if label:
+                leading_spaces = spans.text[:label[0]]
+                spans.delete_prefix(label[1])
+
                 # [FIX GAPS]: DIỆT SẠCH TAB VÀ THỤT LỀ Ở CÂU HỎI
-                # ========================================================
-                for run in first_paragraph.findall('.//w:r', namespaces=WORD_NS):
-                    for tab in run.findall('.//w:tab', namespaces=WORD_NS):
-                        run.remove(tab)
-                pPr_q = first_paragraph.find(f'{{{WORD_NS["w"]}}}pPr')
-                if pPr_q is not None:
-                    ind = pPr_q.find(f'{{{WORD_NS["w"]}}}ind')
-                    if ind is not None: pPr_q.remove(ind)
-                # ========================================================
+                spans.strip_tabs_and_indent()
                 
                 if config_data.get("resetChiSo", True):
                     new_label = f'{config_data.get("nhanCau", "Câu")} {index + 1}'
                 else:
-                    num_match = re.search(r'\d+', match.group(2))
-                    match_num = num_match.group() if num_match else str(index + 1)
-                    new_label = f'{config_data.get("nhanCau", "Câu")} {match_num}'
+                    new_label = f'{config_data.get("nhanCau", "Câu")} {label[2]}'
                 
                 separator = ':'
-                
-                new_run = OxmlElement('w:r')
-                rPr = OxmlElement('w:rPr')
-                
-                b = OxmlElement('w:b')
-                bCs = OxmlElement('w:bCs')
-                rPr.append(b)
-                rPr.append(bCs)
-                
-                rFonts = OxmlElement('w:rFonts')
-                rFonts.set(qn('w:ascii'), 'Times New Roman')
-                rFonts.set(qn('w:hAnsi'), 'Times New Roman')
-                rFonts.set(qn('w:cs'), 'Times New Roman')
-                rPr.append(rFonts)
-                
-                new_run.append(rPr)
-                
-                t = OxmlElement('w:t')
-                t.set(qn('xml:space'), 'preserve')
-                t.text = f"{leading_spaces}{new_label}{separator} "
-                new_run.append(t)
-                
-                pPr = first_paragraph.find(f'{{{WORD_NS["w"]}}}pPr')
-                if pPr is not None:
-                    pPr.addnext(new_run)
-                else:
-                    first_paragraph.insert(0, new_run)
+                question.label = spans.insert_label_run(f"{leading_spaces}{new_label}{separator} ")
+            if costs is not None: costs.setdefault(question, {})["label"] = time.perf_counter() - t0
         
         if z in ["P1", "P2", "P3"]:
-            for q_obj in parsed_data[z]:
+            for question in questions:
                 score = "0.25" if z == "P1" else ("0.1 0.25 0.5 1" if z == "P2" else "0.5")
-                ans_key.append({'q_num': q_counter, 'ans': q_obj['ans'], 'score': score, 'zone': z})
+                ans_key.append({'q_num': q_counter, 'ans': question.ans, 'score': score, 'zone': z,
+                                'src': question.src, 'perm': question.perm})
                 q_counter += 1
 
     return parsed_data, ans_key, errors
@@ -555,7 +991,8 @@ def shuffle_engine(doc, parsed_data, config_data):
 # MODULE 5: RENDERER & GLOBAL FORMATTING
 # =====================================================================
 
-def apply_global_formatting(doc):
+def apply_global_formatting(doc, costs=None):
+    # costs: dict phần tử w:p -> giây định dạng, chỉ dùng khi phân tích đề chậm (MODULE 17)
     for section in doc.sections:
         section.page_width = Cm(21.0)
         section.page_height = Cm(29.7)
@@ -565,80 +1002,96 @@ def apply_global_formatting(doc):
         section.right_margin = Cm(1.5)
         section.footer_distance = Cm(1.27)
 
-    def force_format(p):
-        xml_str = p._element.xml
-        has_complex = 'm:oMath' in xml_str or 'w:drawing' in xml_str or 'v:imagedata' in xml_str or 'w:pict' in xml_str
-        
-        p_text = p.text.strip().upper()
-        is_header = False
-        if (p_text.startswith("PHẦN I") or p_text.startswith("PHẦN 1") or p_text.startswith("PHẦN MỘT") or 
-            p_text.startswith("PHẦN II") or p_text.startswith("PHẦN 2") or p_text.startswith("PHẦN HAI") or 
-            p_text.startswith("PHẦN III") or p_text.startswith("PHẦN 3") or p_text.startswith("PHẦN BA") or 
-            p_text.startswith("PHẦN IV") or p_text.startswith("PHẦN 4") or p_text.startswith("PHẦN BỐN")):
-            is_header = True
-            
-        if not has_complex:
-            p.paragraph_format.line_spacing_rule = WD_LINE_SPACING.SINGLE
-            if is_header:
-                p.paragraph_format.space_before = Pt(6) 
-                p.paragraph_format.space_after = Pt(6)
-            else:
-                p.paragraph_format.space_before = Pt(0) 
-                p.paragraph_format.space_after = Pt(0)
-            
-        for run in p.runs:
-            run.font.name = 'Times New Roman'
-            rPr = run._element.get_or_add_rPr()
-            rFonts = rPr.get_or_add_rFonts()
-            rFonts.set(qn('w:ascii'), 'Times New Roman')
-            rFonts.set(qn('w:hAnsi'), 'Times New Roman')
-            rFonts.set(qn('w:cs'), 'Times New Roman')
-            
-            if run.font.size != Pt(14):
-                run.font.size = Pt(12)
-
-    for p in doc.paragraphs: force_format(p)
+    fmt = format_paragraph if costs is None else lambda p: timed_format_paragraph(p, costs)
+    for p in doc.paragraphs: fmt(p)
     for table in doc.tables:
         for row in table.rows:
             for cell in row.cells:
-                for p in cell.paragraphs: force_format(p)
+                for p in cell.paragraphs: fmt(p)
+
+def timed_format_paragraph(p, costs):
+    t0 = time.perf_counter()
+    format_paragraph(p)
+    costs[p._element] = costs.get(p._element, 0.0) + time.perf_counter() - t0
+
+def format_paragraph(p):
+    xml_str = p._element.xml
+    has_complex = 'm:oMath' in xml_str or 'w:drawing' in xml_str or 'v:imagedata' in xml_str or 'w:pict' in xml_str
+    
+    p_text = p.text.strip().upper()
+    is_header = False
+    if (p_text.startswith("PHẦN I") or p_text.startswith("PHẦN 1") or p_text.startswith("PHẦN MỘT") or 
+        p_text.startswith("PHẦN II") or p_text.startswith("PHẦN 2") or p_text.startswith("PHẦN HAI") or 
+        p_text.startswith("PHẦN III") or p_text.startswith("PHẦN 3") or p_text.startswith("PHẦN BA") or 
+        p_text.startswith("PHẦN IV") or p_text.startswith("PHẦN 4") or p_text.startswith("PHẦN BỐN")):
+        is_header = True
+        
+    if not has_complex:
+        p.paragraph_format.line_spacing_rule = WD_LINE_SPACING.SINGLE
+        if is_header:
+            p.paragraph_format.space_before = Pt(6) 
+            p.paragraph_format.space_after = Pt(6)
+        else:
+            p.paragraph_format.space_before = Pt(0) 
+            p.paragraph_format.space_after = Pt(0)
+        
+    for run in p.runs:
+        run.font.name = 'Times New Roman'
+        rPr = run._element.get_or_add_rPr()
+        rFonts = rPr.get_or_add_rFonts()
+        rFonts.set(qn('w:ascii'), 'Times New Roman')
+        rFonts.set(qn('w:hAnsi'), 'Times New Roman')
+        rFonts.set(qn('w:cs'), 'Times New Roman')
+        
+        if run.font.size != Pt(14):
+            run.font.size = Pt(12)
+
+# Cache các đoạn XML cố định (dựng 1 lần, mỗi đề chỉ deepcopy thay vì gọi Document() mới)
+FRAGMENT_CACHE = {}
 
-def render_template(doc, parsed_data, config_data, current_ma_de):
+def get_closing_fragment():
+    fragment = FRAGMENT_CACHE.get("closing")
+    if fragment is None:
+        temp_doc = Document()
+        temp_doc.add_paragraph() 
+        
+        p_het = temp_doc.add_paragraph("---Hết---")
+        p_het.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        p_het.runs[0].bold = True
+        
+        p_note1 = temp_doc.add_paragraph("- Cán bộ coi thi không giải thích gì thêm.")
+        p_note1.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        p_note1.runs[0].italic = True
+        
+        p_note2 = temp_doc.add_paragraph("- Học sinh không được sử dụng tài liệu.")
+        p_note2.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        p_note2.runs[0].italic = True
+
+        fragment = [p._element for p in temp_doc.paragraphs]
+        FRAGMENT_CACHE["closing"] = fragment
+    return [copy.deepcopy(el) for el in fragment]
+
+def render_template(doc, parsed_data, config_data, current_ma_de, costs=None):
     body = doc._body._body
     body.clear_content()
 
     build_standard_header(doc, config_data, current_ma_de)
 
-    for z in ["P1", "P2", "P3", "P4"]:
-        for el in parsed_data[f"{z}_header"]: 
+    for z in ZONES:
+        for el in parsed_data[z].header: 
             text_upper = get_text_from_element(el).strip().upper()
             if "PHẦN" in text_upper:
                 for run in el.findall('.//w:r', namespaces=WORD_NS):
                     make_run_bold(run)
             body.append(el)
             
-        for q_obj in parsed_data[z]:
-            for el in q_obj['xml']: body.append(el)
+        for question in parsed_data[z].questions:
+            for el in question.xml: body.append(el)
 
-    temp_doc = Document()
-    temp_doc.add_paragraph() 
-    
-    p_het = temp_doc.add_paragraph("---Hết---")
-    p_het.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p_het.runs[0].bold = True
-    
-    p_note1 = temp_doc.add_paragraph("- Cán bộ coi thi không giải thích gì thêm.")
-    p_note1.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p_note1.runs[0].italic = True
-    
-    p_note2 = temp_doc.add_paragraph("- Học sinh không được sử dụng tài liệu.")
-    p_note2.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p_note2.runs[0].italic = True
-    
-    for p in temp_doc.paragraphs:
-        body.append(p._element)
+    for el in get_closing_fragment():
+        body.append(el)
 
-    apply_global_formatting(doc)
+    apply_global_formatting(doc, costs)
 
     for section in doc.sections:
         header = section.header
@@ -676,137 +1129,2742 @@ def render_template(doc, parsed_data, config_data, current_ma_de):
 
     return doc
 
-@app.post("/api/mix-docx")
-async def mix_docx_endpoint(file: UploadFile = File(...), config: str = Form(...)):
+# =====================================================================
+# [GHÉP ĐỀ TỪ BYTES]: SERIALIZE MỖI CÂU / PHƯƠNG ÁN 1 LẦN, CÁC ĐỀ SAU CHỈ NỐI BYTES
+# =====================================================================
+
+# Giữa các đề chỉ đổi: thứ tự câu, thứ tự phương án, chữ nhãn ("Câu 3: ", "B. ") và mã đề.
+# Đề đầu tiên render như thường nhưng đánh dấu ranh giới câu / phương án / nhãn bằng processing instruction
+# <?arena ...?> rồi lưu 1 lần; document.xml được cắt thành các mảnh bytes có chỗ trống, các part khác nén sẵn.
+# Đề sau: bốc thăm (đúng thứ tự gọi random như shuffle_engine) rồi nối mảnh -> không parse, không dựng cây XML.
+FRAGMENT_RENDER = os.environ.get("ARENA_FRAGMENT_RENDER", "1") != "0"
+TEMPLATE_KEY = "template"  # khoá trong answer_records (dict dùng chung giữa các đề của 1 file gốc)
+MA_DE_SLOT = "\ue000ma-de\ue001"  # ký tự vùng riêng (PUA) -> không trùng chữ trong đề thật
+RE_TEMPLATE_SLOT = re.compile(rb'<\?arena ([^?]*)\?>')
+OPTION_LABELS = {"P1": ("ABCD", "."), "P2": ("abcd", ")")}
+
+class VariantTemplate:
+    """Khuôn ghép đề của 1 file gốc + 1 config.
+
+    parts: (tên part, kích thước, (method, crc, bytes nén) | None, mảnh cắt theo mã đề | None) theo thứ tự ZIP;
+    document: mảnh bytes của document.xml xen chỗ trống ("made",) / ("q", phần, vị trí);
+    questions: {phần: [dict câu theo thứ tự gốc]}; first_plan: cách trộn của chính đề dựng khuôn.
+    """
+    __slots__ = ('parts', 'document', 'questions', 'first_plan', 'counts')
+
+    def __init__(self):
+        self.parts, self.document, self.questions, self.first_plan, self.counts = [], [], {}, {}, {}
+
+def _mark_span(first, last, start, end):
+    first.addprevious(etree.ProcessingInstruction("arena", start))
+    last.addnext(etree.ProcessingInstruction("arena", end))
+
+def _mark_label(run):
+    t_node = run.find(W_T)
+    t_node.text = None
+    t_node.append(etree.ProcessingInstruction("arena", "label"))
+
+def mark_variant_slots(shuffled_data, config_data):
+    # Gọi sau render_template (đã định dạng xong); trả về thông tin từng câu, cây XML được gắn dấu tại chỗ
+    questions, first_plan = {}, {}
+    for z in ZONES:
+        zone_questions = shuffled_data[z].questions
+        questions[z], first_plan[z] = [None] * len(zone_questions), []
+        for k, question in enumerate(zone_questions):
+            i = question.src - 1 if question.src else k
+            q = {"ans": question.ans, "correct": None, "leading": None, "label": None, "segments": None, "options": {}}
+            if question.label is not None:
+                label = question.label.find(W_T).text
+                suffix = f'{config_data.get("nhanCau", "Câu")} {k + 1}: '
+                if config_data.get("resetChiSo", True) and label.endswith(suffix): q["leading"] = label[:-len(suffix)]
+                else: q["label"] = label
+            _mark_span(question.xml[0], question.xml[-1], f"q {z} {k}", "/q")
+            if question.label is not None: _mark_label(question.label)
+            perm = None
+            if question.options is not None:
+                q["correct"] = [False] * len(question.options)
+                for opt in question.options:
+                    q["correct"][opt.orig] = opt.is_correct
+                    _mark_span(opt.xml[0], opt.xml[-1], f"o {opt.orig}", "/o")
+                    if opt.label is not None: _mark_label(opt.label)
+                perm = [opt.orig for opt in question.options]
+            questions[z][i] = q
+            first_plan[z].append((i, perm))
+    return questions, first_plan
+
+def split_document_xml(data, questions, first_plan):
+    # Cắt theo <?arena ...?>: mảnh ngoài câu -> template.document, trong câu/phương án -> dict câu tương ứng
+    top, question, current = [], None, None
+    pieces = RE_TEMPLATE_SLOT.split(data)
+    for n, piece in enumerate(pieces):
+        if n % 2 == 0:
+            if piece: (current if current is not None else top).append(piece)
+            continue
+        kind, *args = piece.decode("ascii").split()
+        if kind == "made": (current if current is not None else top).append(("made",))
+        elif kind == "label": current.append(("label",))
+        elif kind == "q":
+            z, k = args[0], int(args[1])
+            question = questions[z][first_plan[z][k][0]]
+            question["segments"] = current = []
+            top.append(("q", z, k))
+        elif kind == "/q": question, current = None, None
+        elif kind == "o":
+            current = []
+            question["segments"].append(("o", len(question["options"])))
+            question["options"][int(args[0])] = current
+        elif kind == "/o": current = question["segments"]
+    return top
+
+def build_variant_template(doc, shuffled_data, config_data):
+    template = VariantTemplate()
+    template.questions, template.first_plan = mark_variant_slots(shuffled_data, config_data)
+    template.counts = {z: len(shuffled_data[z].questions) for z in ZONES}
+    package_buffer = io.BytesIO()
+    doc.save(package_buffer)
+    slot = MA_DE_SLOT.encode("utf-8")
+    with zipfile.ZipFile(package_buffer) as package:
+        for info in package.infolist():
+            data = package.read(info)
+            if info.filename == "word/document.xml":
+                template.document = split_document_xml(data.replace(slot, b"<?arena made?>"), template.questions, template.first_plan)
+                template.parts.append((info.filename, None, None, None))
+            elif slot in data:
+                template.parts.append((info.filename, None, None, data.split(slot)))
+            else:
+                template.parts.append((info.filename, len(data), _compress_entry(data, zip_entry_level(info.filename)), None))
+    return template
+
+def plan_variant(template):
+    # Gọi random đúng thứ tự shuffle_engine: xáo phương án từng câu P1/P2 theo thứ tự gốc, rồi xáo câu của phần
+    plan = {}
+    for z in ZONES:
+        questions = template.questions[z]
+        perms = [None] * len(questions)
+        if z in ["P1", "P2"]:
+            for i, q in enumerate(questions):
+                perms[i] = list(range(len(q["correct"])))
+                random.shuffle(perms[i])
+        order = list(range(len(questions)))
+        if z in ["P1", "P2", "P3"]: random.shuffle(order)
+        plan[z] = [(i, perms[i]) for i in order]
+    return plan
+
+def plan_answer_key(template, plan):
+    # Cùng cấu trúc ans_key của shuffle_engine
+    ans_key, q_counter = [], 1
+    for z in ["P1", "P2", "P3"]:
+        score = "0.25" if z == "P1" else ("0.1 0.25 0.5 1" if z == "P2" else "0.5")
+        for i, perm in plan[z]:
+            q = template.questions[z][i]
+            ans, perm_text = q["ans"], None
+            if perm is not None:
+                labels = OPTION_LABELS[z][0]
+                ans = ""
+                for idx, orig in enumerate(perm):
+                    if z == "P1":
+                        if q["correct"][orig]: ans = labels[idx]
+                    else:
+                        ans += "Đ" if q["correct"][orig] else "S"
+                ans, perm_text = ans or "A", "".join(labels[orig] for orig in perm)
+            ans_key.append({'q_num': q_counter, 'ans': ans, 'score': score, 'zone': z, 'src': i + 1, 'perm': perm_text})
+            q_counter += 1
+    return ans_key
+
+def _xml_text(text):
+    return html.escape(text, quote=False).encode("utf-8")
+
+def assemble_document_xml(template, plan, ma_de, config_data, costs=None):
+    # costs: dict (phần, vị trí gốc) -> giây nối mảnh, chỉ dùng khi phân tích đề chậm (MODULE 17)
+    made, nhan_cau = _xml_text(ma_de), config_data.get("nhanCau", "Câu")
+    out = []
+    for seg in template.document:
+        if type(seg) is bytes: out.append(seg); continue
+        if seg[0] == "made": out.append(made); continue
+        t0 = time.perf_counter() if costs is not None else 0
+        z, k = seg[1], seg[2]
+        i, perm = plan[z][k]
+        q = template.questions[z][i]
+        label = _xml_text(f"{q['leading']}{nhan_cau} {k + 1}: " if q["leading"] is not None else q["label"] or "")
+        for part in q["segments"]:
+            if type(part) is bytes: out.append(part)
+            elif part[0] == "label": out.append(label)
+            else:
+                labels, separator = OPTION_LABELS[z]
+                idx = part[1]
+                option_label = _xml_text(f"{labels[idx]}{separator} ")
+                for opt_part in q["options"][perm[idx]]:
+                    out.append(opt_part if type(opt_part) is bytes else option_label)
+        if costs is not None: costs[(z, i)] = time.perf_counter() - t0
+    return b"".join(out)
+
+def assemble_variant(template, plan, ma_de, config_data, costs=None):
+    docx_buffer = io.BytesIO()
+    with ParallelZipWriter(docx_buffer) as docx:
+        for name, size, packed, pieces in template.parts:
+            if packed is not None: docx.write_compressed(name, size, packed)
+            elif pieces is not None: docx.writestr(name, _xml_text(ma_de).join(pieces))
+            else: docx.writestr(name, assemble_document_xml(template, plan, ma_de, config_data, costs))
+    return docx_buffer.getvalue()
+
+# =====================================================================
+# MODULE 6: ANSWER KEY WORKBOOKS
+# =====================================================================
+
+def build_answer_workbooks(all_exams_data):
+    from openpyxl import Workbook  # import lười: chỉ cần khi xuất đáp án
+    workbooks = []
+
+    wb_doc = Workbook()
+    ws_doc = wb_doc.active
+    ws_doc.title = "Dap An Doc"
+    ws_doc.append(['Mã đề', 'Câu hỏi', 'Đáp án', 'Điểm'])
+    for m_de, ans_list in all_exams_data.items():
+        for item in ans_list: 
+            ws_doc.append([m_de, item['q_num'], item['ans'], item['score']])
+
+    doc_excel_buffer = io.BytesIO()
+    wb_doc.save(doc_excel_buffer)
+    workbooks.append(("DapAn_ChiTiet_Doc.xlsx", doc_excel_buffer.getvalue()))
+
+    wb_ngang = Workbook()
+    ws_ngang = wb_ngang.active
+    ws_ngang.title = "Dap An Ngang"
+    made_keys = list(all_exams_data.keys())
+
+    ws_ngang.append(['Câu hỏi'] + made_keys + ['diem'])
+    if len(made_keys) > 0:
+        max_questions = max(len(all_exams_data[k]) for k in made_keys)
+        for q_idx in range(max_questions):
+            row = [str(q_idx + 1)]
+            for m_de in made_keys: 
+                if q_idx < len(all_exams_data[m_de]): row.append(all_exams_data[m_de][q_idx]['ans'])
+                else: row.append("")
+            if q_idx < len(all_exams_data[made_keys[0]]): row.append(all_exams_data[made_keys[0]][q_idx]['score'])
+            else: row.append("")
+            ws_ngang.append(row)
+
+    ngang_excel_buffer = io.BytesIO()
+    wb_ngang.save(ngang_excel_buffer)
+    workbooks.append(("DapAn_DeTron_Ngang.xlsx", ngang_excel_buffer.getvalue()))
+
+    wb_olm = Workbook()
+    ws_olm = wb_olm.active
+    ws_olm.title = "Dap An OLM"
+
+    if len(made_keys) > 0:
+        first_made = made_keys[0]
+        first_ans_list = all_exams_data[first_made]
+
+        p1_list = [item for item in first_ans_list if item['zone'] == 'P1']
+        p2_list = [item for item in first_ans_list if item['zone'] == 'P2']
+        p3_list = [item for item in first_ans_list if item['zone'] == 'P3']
+
+        num_p1 = len(p1_list)
+        num_p2 = len(p2_list)
+        num_p3 = len(p3_list)
+
+        row1 = [""]
+        if num_p1 > 0:
+            row1.extend(["Phần Ⅰ: Mỗi câu 0.25đ"] + [""] * (num_p1 - 1))
+        if num_p2 > 0:
+            row1.extend(["Phần Ⅱ: Mỗi câu tối đa 1đ: đúng 1 ý 0.1đ, đúng 2 ý: 0.25đ, đúng 3 ý: 0.5đ, đúng 4 ý: 1đ."] + [""] * (num_p2 * 4 - 1))
+        if num_p3 > 0:
+            row1.extend(["Phần Ⅲ: Mỗi câu 0.5 điểm"] + [""] * (num_p3 - 1))
+        ws_olm.append(row1)
+
+        row2 = [""]
+        for i in range(1, num_p1 + 1): row2.append(str(i))
+        for i in range(1, num_p2 + 1): row2.extend([f"{i}a", f"{i}b", f"{i}c", f"{i}d"])
+        for i in range(1, num_p3 + 1): row2.append(f"Câu {i}")
+        ws_olm.append(row2)
+
+        row3 = ["Điểm"]
+        for _ in range(num_p1): row3.append("0.25")
+        for _ in range(num_p2 * 4): row3.append("0.25")
+        for _ in range(num_p3): row3.append("0.5")
+        ws_olm.append(row3)
+
+        for m_de in made_keys:
+            ans_list = all_exams_data[m_de]
+            row_data = [m_de]
+            for item in ans_list:
+                if item['zone'] == 'P1':
+                    row_data.append(item['ans'])
+                elif item['zone'] == 'P2':
+                    ans_str = str(item['ans']).strip()
+                    ans_str = (ans_str + "SSSS")[:4] 
+                    for char in ans_str:
+                        row_data.append(char)
+                elif item['zone'] == 'P3':
+                    row_data.append(item['ans'])
+            ws_olm.append(row_data)
+
+    olm_excel_buffer = io.BytesIO()
+    wb_olm.save(olm_excel_buffer)
+    workbooks.append(("DapAn_OLM.xlsx", olm_excel_buffer.getvalue()))
+
+    return workbooks
+
+# =====================================================================
+# MODULE 7: PROFILING (CHẨN ĐOÁN ĐỀ CHẠY CHẬM)
+# =====================================================================
+
+# Chỉ bật khi server có cấu hình token quản trị; gửi token qua header X-Arena-Profile hoặc ?profile=
+PROFILE_TOKEN = os.environ.get("ARENA_PROFILE_TOKEN", "")
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("ARENA_PROFILE_INTERVAL", "0.001"))
+
+def profiling_requested(request):
+    if not PROFILE_TOKEN: return False
+    token = request.headers.get("x-arena-profile") or request.query_params.get("profile")
+    return token == PROFILE_TOKEN
+
+class RequestProfiler:
+    """cProfile (cho profile.pstats) + luồng lấy mẫu stack (cho profile.collapsed.txt, vẽ flame graph)."""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.profile = cProfile.Profile()
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._target_id = None
+
+    def start(self):
+        self._target_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._sample, name="arena-profiler", daemon=True)
+        self._thread.start()
+        self.profile.enable()
+
+    def stop(self):
+        if self._stop.is_set(): return
+        self.profile.disable()
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack: self.stacks[";".join(reversed(stack))] += 1
+
+    def write_to_zip(self, zip_file):
+        # Định dạng .pstats giống hệt Stats.dump_stats() nhưng ghi thẳng vào ZIP
+        stats_buffer = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stats_buffer)
+        zip_file.writestr("profile/profile.pstats", marshal.dumps(stats.stats))
+        stats.sort_stats("cumulative").print_stats(60)
+        zip_file.writestr("profile/profile.txt", stats_buffer.getvalue())
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+        zip_file.writestr("profile/profile.collapsed.txt", collapsed + "\n")
+
+# =====================================================================
+# MODULE 8: WARM-UP & READINESS
+# =====================================================================
+
+WARM_STATE = {"ready": False, "started": False, "seconds": None, "error": None}
+_warm_lock = threading.Lock()
+
+def build_synthetic_exam():
+    doc = Document()
+    doc.add_paragraph("PHẦN I. Trắc nghiệm")
+    doc.add_paragraph("Câu 1: Warm-up?")
+    for label in "ABCD":
+        doc.add_paragraph(f"{'*' if label == 'A' else ''}{label}. {label}")
+    doc.add_paragraph("PHẦN II. Đúng sai")
+    doc.add_paragraph("Câu 1: Warm-up?")
+    for label in "abcd":
+        doc.add_paragraph(f"{label}) {label} (đúng)")
+    doc.add_paragraph("PHẦN III. Trả lời ngắn")
+    doc.add_paragraph("Câu 1: Warm-up?")
+    doc.add_paragraph("Key: 1")
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def warm_up():
+    # Nạp template mặc định, regex, cache đoạn XML, openpyxl và chạy thử 1 lượt trộn nhỏ
+    with _warm_lock:
+        if WARM_STATE["ready"]: return
+        WARM_STATE["started"] = True
+        t0 = time.perf_counter()
+        try:
+            get_closing_fragment()
+            content = build_synthetic_exam()
+            config_data = {"soDe": 1, "thoiGian": "90"}
+            doc = Document(io.BytesIO(content))
+            parsed_data = parse_docx(doc)
+            shuffled_data, ans_key, errors = shuffle_engine(doc, parsed_data, config_data)
+            final_doc = render_template(doc, shuffled_data, config_data, "000")
+            final_doc.save(io.BytesIO())
+            build_answer_workbooks({"000": ans_key})
+        except Exception as e:
+            traceback.print_exc()
+            WARM_STATE["error"] = str(e)
+        WARM_STATE["seconds"] = round(time.perf_counter() - t0, 3)
+        WARM_STATE["ready"] = True
+    # Đóng băng các object đã nạp: GC không quét lại, và các worker fork ra dùng chung trang nhớ
+    gc.freeze()
+
+def start_warm_up_in_background():
+    if WARM_STATE["started"]: return
+    WARM_STATE["started"] = True
+    threading.Thread(target=warm_up, name="arena-warm-up", daemon=True).start()
+
+@app.get("/api/health")
+async def health_endpoint():
+    return {"status": "ok"}
+
+@app.get("/api/ready")
+async def ready_endpoint():
+    # Có job worker: chỉ sẵn sàng khi mọi tiến trình con đã khởi động và warm-up xong
+    workers = JOB_POOL.describe() if JOB_POOL is not None else None
+    if not WARM_STATE["ready"] or (workers is not None and not workers["ready"]):
+        return JSONResponse(status_code=503, content={"ready": False, "workers": workers})
+    return {"ready": True, "warm_up_seconds": WARM_STATE["seconds"], "error": WARM_STATE["error"], "workers": workers}
+
+# =====================================================================
+# MODULE 9: OUTPUT ARCHIVE (NÉN THEO CHÍNH SÁCH, SONG SONG)
+# =====================================================================
+
+# .docx/.xlsx bản thân đã là ZIP nén deflate -> chỉ lưu (STORED), không tốn CPU nén lại
+ZIP_STORE_EXTENSIONS = tuple(ext.strip().lower() for ext in
+                             os.environ.get("ARENA_ZIP_STORE_EXT", ".docx,.xlsx,.zip,.png,.jpg,.jpeg,.gif").split(",") if ext.strip())
+ZIP_DEFLATE_LEVEL = int(os.environ.get("ARENA_ZIP_LEVEL", "6"))
+ZIP_THREADS = int(os.environ.get("ARENA_ZIP_THREADS", str(min(4, os.cpu_count() or 1))))
+ZIP64_LIMIT = 0xFFFFFFFF  # từ ngưỡng này trở lên phải ghi trường zip64
+
+def _zip32(value):
+    return value if value < ZIP64_LIMIT else 0xFFFFFFFF
+_zip_executor = None
+_zip_executor_lock = threading.Lock()
+
+def get_zip_executor():
+    global _zip_executor
+    with _zip_executor_lock:
+        if _zip_executor is None:
+            _zip_executor = ThreadPoolExecutor(max_workers=max(1, ZIP_THREADS), thread_name_prefix="arena-zip")
+        return _zip_executor
+
+def zip_entry_level(name):
+    # None = lưu nguyên (STORED); số = mức deflate
+    if name.lower().endswith(ZIP_STORE_EXTENSIONS) or ZIP_DEFLATE_LEVEL <= 0: return None
+    return ZIP_DEFLATE_LEVEL
+
+def _compress_entry(data, level):
+    # zlib.crc32 và zlib.compress nhả GIL với dữ liệu lớn -> chạy song song thật trên nhiều luồng
+    crc = zlib.crc32(data) & 0xFFFFFFFF
+    if level is None: return zipfile.ZIP_STORED, crc, data
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    packed = compressor.compress(data) + compressor.flush()
+    if len(packed) >= len(data): return zipfile.ZIP_STORED, crc, data
+    return zipfile.ZIP_DEFLATED, crc, packed
+
+class ParallelZipWriter:
+    """Ghi ZIP kiểu zipfile.ZipFile(..., "w"): writestr() chỉ giao việc nén cho thread pool
+    rồi trả về ngay (đề tiếp theo render song song), close() chỉ còn ghi nối các khối đã nén."""
+
+    def __init__(self, fileobj):
+        self.fp = fileobj
+        self.entries = []
+        self.aborted = False
+        t = time.localtime()
+        self.dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        self.dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+    def writestr(self, name, data):
+        if isinstance(data, str): data = data.encode("utf-8")
+        future = get_zip_executor().submit(_compress_entry, data, zip_entry_level(name))
+        self.entries.append((name, len(data), future))
+
+    def write_compressed(self, name, size, entry):
+        # entry = (method, crc, bytes) đã nén sẵn bằng _compress_entry (part tĩnh dùng lại cho mọi đề)
+        future = Future()
+        future.set_result(entry)
+        self.entries.append((name, size, future))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+            return False
+        self.close()
+        return False
+
+    def abort(self):
+        # Bỏ toàn bộ: huỷ các khối chưa nén, giải phóng dữ liệu đã giao, close() không ghi gì nữa
+        for _, _, future in self.entries: future.cancel()
+        self.entries = []
+        self.aborted = True
+
+    def close(self):
+        if self.aborted: return
+        central = []
+        offset = self.fp.tell()
+        for name, size, future in self.entries:
+            method, crc, packed = future.result()
+            name_bytes = name.encode("utf-8")
+            flags = 0x800 if not name.isascii() else 0
+            zip64 = size >= ZIP64_LIMIT or len(packed) >= ZIP64_LIMIT
+            extra = struct.pack("<HHQQ", 1, 16, size, len(packed)) if zip64 else b""
+            version = 45 if zip64 else 20
+            self.fp.write(struct.pack("<IHHHHHIIIHH", 0x04034b50, version, flags, method, self.dos_time, self.dos_date, crc,
+                                      0xFFFFFFFF if zip64 else len(packed), 0xFFFFFFFF if zip64 else size,
+                                      len(name_bytes), len(extra)))
+            self.fp.write(name_bytes); self.fp.write(extra); self.fp.write(packed)
+            central.append((name_bytes, flags, method, crc, len(packed), size, offset))
+            offset += 30 + len(name_bytes) + len(extra) + len(packed)
+        self.entries = []
+
+        cd_start = offset
+        for name_bytes, flags, method, crc, csize, usize, header_offset in central:
+            fields = [v for v in (usize, csize, header_offset) if v >= ZIP64_LIMIT]
+            extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields) if fields else b""
+            version = 45 if fields else 20
+            self.fp.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, version, version, flags, method,
+                                      self.dos_time, self.dos_date, crc, _zip32(csize), _zip32(usize),
+                                      len(name_bytes), len(extra), 0, 0, 0, 0, _zip32(header_offset)))
+            self.fp.write(name_bytes); self.fp.write(extra)
+            offset += 46 + len(name_bytes) + len(extra)
+
+        count, cd_size = len(central), offset - cd_start
+        if count >= 0xFFFF or cd_size >= ZIP64_LIMIT or cd_start >= ZIP64_LIMIT:
+            self.fp.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_start))
+            self.fp.write(struct.pack("<IIQI", 0x07064b50, 0, offset, 1))
+        self.fp.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                  _zip32(cd_size), _zip32(cd_start), 0))
+
+# =====================================================================
+# MODULE 10: MIX JOB (TOÀN BỘ PIPELINE CHO 1 YÊU CẦU)
+# =====================================================================
+
+# Hạn xử lý mặc định cho 1 job (giây, 0 = không giới hạn); từng yêu cầu có thể đặt riêng bằng config "hanXuLy".
+# config "traMotPhan": true -> quá hạn thì trả ZIP gồm các đề đã xong + manifest.json liệt kê đề còn thiếu.
+JOB_DEADLINE_SECONDS = float(os.environ.get("ARENA_JOB_DEADLINE", "0"))
+
+class CancelToken:
+    """Cờ huỷ hợp tác: pipeline gọi check() giữa các giai đoạn / giữa các đề và dừng nếu có lý do.
+    deadline_seconds None hoặc 0: không có hạn.
+    event có thể là multiprocessing.Event để tiến trình cha huỷ job đang chạy ở tiến trình con."""
+    __slots__ = ('event', 'deadline', 'reason')
+
+    def __init__(self, deadline_seconds=0, event=None):
+        self.event = event if event is not None else threading.Event()
+        self.deadline = time.monotonic() + deadline_seconds if deadline_seconds and deadline_seconds > 0 else None
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        if self.reason is None: self.reason = reason
+        self.event.set()
+
+    def check(self):
+        if self.reason is None:
+            if self.event.is_set(): self.reason = "cancelled"
+            elif self.deadline is not None and time.monotonic() > self.deadline: self.reason = "deadline"
+        return self.reason
+
+    def remaining(self):
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+def job_deadline(config_data):
+    try:
+        return float(config_data.get("hanXuLy", JOB_DEADLINE_SECONDS) or 0)
+    except (TypeError, ValueError):
+        return JOB_DEADLINE_SECONDS
+
+def cancelled_error(reason):
+    if reason == "deadline":
+        return 504, {"message": "Quá hạn xử lý, đã dừng trộn đề", "details": ["deadline"]}
+    return 499, {"message": "Yêu cầu đã bị huỷ", "details": [reason]}
+
+def render_variant(content, config_data, ma_de, answer_records, cancel=None):
+    # 1 đề: nạp lại bản gốc đã chuẩn bị -> parse -> trộn -> dựng -> bytes .docx (dùng chung cho API và batch.py)
+    # Trả về (docx | None, ans_key, errors, số câu mỗi phần); docx = None khi đề gốc lỗi hoặc bị huỷ giữa chừng
+    # Bật FRAGMENT_RENDER: đề đầu dựng khuôn (lưu vào answer_records), các đề sau chỉ bốc thăm + nối bytes
+    template = answer_records.get(TEMPLATE_KEY) if FRAGMENT_RENDER else None
+    if template is not None:
+        if cancel is not None and cancel.check(): return None, [], [], template.counts
+        plan = plan_variant(template)
+        return assemble_variant(template, plan, ma_de, config_data), plan_answer_key(template, plan), [], template.counts
+
+    doc = Document(io.BytesIO(content))
+    parsed_data = parse_docx(doc)
+    shuffled_data, ans_key, errors = shuffle_engine(doc, parsed_data, config_data, answer_records)
+    counts = {z: len(shuffled_data[z].questions) for z in ZONES}
+    if errors: return None, ans_key, list(dict.fromkeys(errors)), counts
+    if cancel is not None and cancel.check(): return None, ans_key, [], counts
+    if not FRAGMENT_RENDER:
+        doc_buffer = io.BytesIO()
+        render_template(doc, shuffled_data, config_data, ma_de).save(doc_buffer)
+        return doc_buffer.getvalue(), ans_key, [], counts
+    render_template(doc, shuffled_data, config_data, MA_DE_SLOT)
+    template = answer_records[TEMPLATE_KEY] = build_variant_template(doc, shuffled_data, config_data)
+    return assemble_variant(template, template.first_plan, ma_de, config_data), ans_key, [], counts
+
+def run_mix_job(content, config_data, profile=False, progress=None, cancel=None):
+    # Trả về (status, payload): 200 + bytes ZIP, hoặc mã lỗi + dict JSON
+    # progress(event, **data): báo tiến độ từng giai đoạn / từng đề (dùng cho /api/jobs)
+    # cancel: CancelToken, kiểm tra giữa các giai đoạn và giữa các đề
+    profiler = RequestProfiler() if profile else None
+    if profiler: profiler.start()
+    if cancel is None: cancel = CancelToken(job_deadline(config_data))
     try:
-        content = await file.read()
-        config_data = json.loads(config)
         so_de = int(config_data.get("soDe", 1))
         ma_de_list = config_data.get("maDeList", ["101"])
+        if cancel.check(): return cancelled_error(cancel.reason)
+        content, report = prepare_source(content, COMPACT_SOURCE, OPTIMIZE_MEDIA and config_data.get("toiUuAnh", True))
+        if progress and "compaction" in report: progress("compacted", **report["compaction"])
+        if progress and "media" in report: progress("media", **report["media"])
         
         if "thoiGian" not in config_data: config_data["thoiGian"] = "90"
         
         zip_buffer = io.BytesIO()
         all_exams_data = {} 
+        answer_records = {}
         
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for i in range(so_de):
-                ma_de = ma_de_list[i] if i < len(ma_de_list) else str(100 + i)
-                doc = Document(io.BytesIO(content))
-                
-                parsed_data = parse_docx(doc)
-                shuffled_data, ans_key, errors = shuffle_engine(doc, parsed_data, config_data)
+        all_ma_de = [ma_de_list[i] if i < len(ma_de_list) else str(100 + i) for i in range(so_de)]
+        
+        with ParallelZipWriter(zip_buffer) as zip_file:
+            for i, ma_de in enumerate(all_ma_de):
+                if cancel.check(): break
+                docx, ans_key, errors, counts = render_variant(content, config_data, ma_de, answer_records, cancel)
                 
                 if errors:
-                    unique_errors = list(dict.fromkeys(errors))
-                    return JSONResponse(status_code=400, content={"message": "Phát hiện lỗi Đề Gốc!", "details": unique_errors})
-                
-                final_doc = render_template(doc, shuffled_data, config_data, ma_de)
+                    return 400, {"message": "Phát hiện lỗi Đề Gốc!", "details": errors}
+                if progress and i == 0:
+                    progress("parsed", questions=counts)
+                if docx is None: break
                 
                 all_exams_data[ma_de] = ans_key
-                doc_buffer = io.BytesIO()
-                final_doc.save(doc_buffer)
-                zip_file.writestr(f"De_Ma_{ma_de}.docx", doc_buffer.getvalue())
-            
-            wb_doc = Workbook()
-            ws_doc = wb_doc.active
-            ws_doc.title = "Dap An Doc"
-            ws_doc.append(['Mã đề', 'Câu hỏi', 'Đáp án', 'Điểm'])
-            for m_de, ans_list in all_exams_data.items():
-                for item in ans_list: 
-                    ws_doc.append([m_de, item['q_num'], item['ans'], item['score']])
-            
-            doc_excel_buffer = io.BytesIO()
-            wb_doc.save(doc_excel_buffer)
-            doc_excel_buffer.seek(0)
-            zip_file.writestr("DapAn_ChiTiet_Doc.xlsx", doc_excel_buffer.read())
-
-            wb_ngang = Workbook()
-            ws_ngang = wb_ngang.active
-            ws_ngang.title = "Dap An Ngang"
-            made_keys = list(all_exams_data.keys())
-            
-            ws_ngang.append(['Câu hỏi'] + made_keys + ['diem'])
-            if len(made_keys) > 0:
-                max_questions = max(len(all_exams_data[k]) for k in made_keys)
-                for q_idx in range(max_questions):
-                    row = [str(q_idx + 1)]
-                    for m_de in made_keys: 
-                        if q_idx < len(all_exams_data[m_de]): row.append(all_exams_data[m_de][q_idx]['ans'])
-                        else: row.append("")
-                    if q_idx < len(all_exams_data[made_keys[0]]): row.append(all_exams_data[made_keys[0]][q_idx]['score'])
-                    else: row.append("")
-                    ws_ngang.append(row)
+                zip_file.writestr(f"De_Ma_{ma_de}.docx", docx)
+                if progress: progress("variant", index=i + 1, total=so_de, ma_de=ma_de, docx=docx)
+                docx = None
             
-            ngang_excel_buffer = io.BytesIO()
-            wb_ngang.save(ngang_excel_buffer)
-            ngang_excel_buffer.seek(0)
-            zip_file.writestr("DapAn_DeTron_Ngang.xlsx", ngang_excel_buffer.read())
-
-            wb_olm = Workbook()
-            ws_olm = wb_olm.active
-            ws_olm.title = "Dap An OLM"
-            
-            if len(made_keys) > 0:
-                first_made = made_keys[0]
-                first_ans_list = all_exams_data[first_made]
-                
-                p1_list = [item for item in first_ans_list if item['zone'] == 'P1']
-                p2_list = [item for item in first_ans_list if item['zone'] == 'P2']
-                p3_list = [item for item in first_ans_list if item['zone'] == 'P3']
-                
-                num_p1 = len(p1_list)
-                num_p2 = len(p2_list)
-                num_p3 = len(p3_list)
-                
-                row1 = [""]
-                if num_p1 > 0:
-                    row1.extend(["Phần Ⅰ: Mỗi câu 0.25đ"] + [""] * (num_p1 - 1))
-                if num_p2 > 0:
-                    row1.extend(["Phần Ⅱ: Mỗi câu tối đa 1đ: đúng 1 ý 0.1đ, đúng 2 ý: 0.25đ, đúng 3 ý: 0.5đ, đúng 4 ý: 1đ."] + [""] * (num_p2 * 4 - 1))
-                if num_p3 > 0:
-                    row1.extend(["Phần Ⅲ: Mỗi câu 0.5 điểm"] + [""] * (num_p3 - 1))
-                ws_olm.append(row1)
-                
-                row2 = [""]
-                for i in range(1, num_p1 + 1): row2.append(str(i))
-                for i in range(1, num_p2 + 1): row2.extend([f"{i}a", f"{i}b", f"{i}c", f"{i}d"])
-                for i in range(1, num_p3 + 1): row2.append(f"Câu {i}")
-                ws_olm.append(row2)
-                
-                row3 = ["Điểm"]
-                for _ in range(num_p1): row3.append("0.25")
-                for _ in range(num_p2 * 4): row3.append("0.25")
-                for _ in range(num_p3): row3.append("0.5")
-                ws_olm.append(row3)
-                
-                for m_de in made_keys:
-                    ans_list = all_exams_data[m_de]
-                    row_data = [m_de]
-                    for item in ans_list:
-                        if item['zone'] == 'P1':
-                            row_data.append(item['ans'])
-                        elif item['zone'] == 'P2':
-                            ans_str = str(item['ans']).strip()
-                            ans_str = (ans_str + "SSSS")[:4] 
-                            for char in ans_str:
-                                row_data.append(char)
-                        elif item['zone'] == 'P3':
-                            row_data.append(item['ans'])
-                    ws_olm.append(row_data)
-
-            olm_excel_buffer = io.BytesIO()
-            wb_olm.save(olm_excel_buffer)
-            olm_excel_buffer.seek(0)
-            zip_file.writestr("DapAn_OLM.xlsx", olm_excel_buffer.read())
-
-        zip_buffer.seek(0)
-        return StreamingResponse(
-            zip_buffer, 
-            media_type="application/zip", 
-            headers={'Content-Disposition': 'attachment; filename="De_Thi.zip"'}
-        )
+            if cancel.check() and (cancel.reason != "deadline" or len(all_exams_data) < so_de):
+                # Không ai nhận (client đã đóng) hoặc không xin trả một phần -> bỏ luôn, không dựng đáp án
+                if cancel.reason != "deadline" or not config_data.get("traMotPhan") or not all_exams_data:
+                    zip_file.abort()
+                    return cancelled_error(cancel.reason)
+                missing = [m for m in all_ma_de if m not in all_exams_data]
+                zip_file.writestr("manifest.json", json.dumps({"complete": False, "reason": cancel.reason,
+                                                               "done": list(all_exams_data), "missing": missing}, ensure_ascii=False))
+                if progress: progress("partial", done=len(all_exams_data), missing=missing)
+
+            for name, data in build_answer_workbooks(all_exams_data):
+                zip_file.writestr(name, data)
+            # Bản máy đọc được của đáp án (dùng cho /api/grade)
+            zip_file.writestr("DapAn.json", json.dumps({"version": 1, "exams": all_exams_data}, ensure_ascii=False))
+            if progress: progress("keys")
+
+            if profiler:
+                profiler.stop()
+                profiler.write_to_zip(zip_file)
+                # Chi phí từng câu (đo riêng sau khi tắt profiler để không lẫn vào profile.pstats)
+                report = question_cost_report(content, config_data, top=QUESTION_COST_TOP)
+                zip_file.writestr("profile/questions.json", json.dumps(report, ensure_ascii=False, indent=2))
+
+        return 200, zip_buffer.getvalue()
+    finally:
+        if profiler: profiler.stop()
+
+# =====================================================================
+# MODULE 11: JOB WORKERS (TIẾN TRÌNH CON, TÁI SINH, GIỚI HẠN TÀI NGUYÊN)
+# =====================================================================
+
+# ARENA_JOB_WORKERS=0 (mặc định): chạy ngay trong tiến trình server như trước
+JOB_WORKERS = int(os.environ.get("ARENA_JOB_WORKERS", "0"))
+JOB_MAX_JOBS_PER_WORKER = int(os.environ.get("ARENA_JOB_MAX_JOBS", "50"))
+JOB_MAX_RSS_MB = int(os.environ.get("ARENA_JOB_MAX_RSS_MB", "1024"))
+JOB_MEMORY_LIMIT_MB = int(os.environ.get("ARENA_JOB_MEMORY_LIMIT_MB", "2048"))
+JOB_CPU_LIMIT_SECONDS = int(os.environ.get("ARENA_JOB_CPU_SECONDS", "120"))
+JOB_WALL_TIMEOUT_SECONDS = float(os.environ.get("ARENA_JOB_TIMEOUT", "300"))
+JOB_WARM_TIMEOUT_SECONDS = float(os.environ.get("ARENA_JOB_WARM_TIMEOUT", "120"))
+
+class JobLimitExceeded(Exception):
+    pass
+
+def _raise_cpu_limit(signum, frame):
+    raise JobLimitExceeded("cpu")
+
+def _statm_mb(field):
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[field]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def current_rss_mb():
+    try:
+        return _statm_mb(1)
+    except (OSError, ValueError, AttributeError):
+        if resource is None: return 0.0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def limit_error(status, detail):
+    return status, {"message": "Đề vượt giới hạn tài nguyên của máy chủ", "details": [detail]}
+
+def _job_worker_main(conn, memory_limit_mb, cpu_limit_seconds, cancel_event):
+    warm_up()
+    cpu_soft, cpu_hard = (None, None)
+    if resource is not None:
+        if memory_limit_mb > 0:
+            # Giới hạn = bộ nhớ ảo sau warm-up + ngân sách cho 1 job (thư viện đã nạp không bị tính)
+            _, as_hard = resource.getrlimit(resource.RLIMIT_AS)
+            try:
+                baseline = int(_statm_mb(0) * 1024 * 1024)
+            except (OSError, ValueError, AttributeError):
+                baseline = 0
+            limit = baseline + memory_limit_mb * 1024 * 1024
+            if as_hard != resource.RLIM_INFINITY: limit = min(limit, as_hard)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, as_hard))
+        if cpu_limit_seconds > 0:
+            cpu_soft, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+            signal.signal(signal.SIGXCPU, _raise_cpu_limit)
+    conn.send(("ready", WARM_STATE["seconds"]))
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None: break
+        content, config_data, profile, want_progress, deadline = job
+        progress = (lambda event, **data: conn.send(("progress", event, data))) if want_progress else None
+        cancel = CancelToken(deadline, cancel_event)
+
+        if cpu_hard is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft = math.ceil(usage.ru_utime + usage.ru_stime) + cpu_limit_seconds
+            if cpu_hard != resource.RLIM_INFINITY: soft = min(soft, cpu_hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, cpu_hard))
+        try:
+            status, payload = run_mix_job(content, config_data, profile, progress, cancel)
+            reply = ("ok", status, payload)
+        except JobLimitExceeded:
+            reply = ("limit", 413, f"Vượt quá {cpu_limit_seconds} giây CPU cho một yêu cầu.")
+        except MemoryError:
+            reply = ("limit", 413, f"Vượt quá {memory_limit_mb} MB bộ nhớ cho một yêu cầu.")
+        except Exception as e:
+            traceback.print_exc()
+            reply = ("error", 500, str(e))
+        finally:
+            if cpu_hard is not None: resource.setrlimit(resource.RLIMIT_CPU, (cpu_soft, cpu_hard))
+        content = job = progress = cancel = None
+        gc.collect()
+        conn.send(("done", reply, current_rss_mb()))
+
+class JobWorker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.cancel_event = ctx.Event()
+        self.process = ctx.Process(target=_job_worker_main, name="arena-job-worker", daemon=True,
+                                   args=(child_conn, JOB_MEMORY_LIMIT_MB, JOB_CPU_LIMIT_SECONDS, self.cancel_event))
+        self.process.start()
+        child_conn.close()
+        self.jobs_done, self.ready = 0, False
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=2)
+        if self.process.is_alive(): self.process.kill(); self.process.join()
+        self.conn.close()
+
+class JobWorkerPool:
+    """Mỗi slot là 1 tiến trình con chạy run_mix_job; tiến trình bị thay mới sau N job,
+    khi RSS vượt ngưỡng, hoặc khi job vượt giới hạn / chết giữa chừng.
+    Tiến trình được tạo sẵn khi khởi động (start) và ngay sau mỗi lần thay mới; chỉ vào hàng chờ job khi
+    đã warm-up xong -> job không phải chờ tiến trình khởi động. Tiến trình không warm-up được thì slot để
+    None và được tạo lại khi có job."""
+
+    def __init__(self, size):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.size = size
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = self.closed = False
+        self.warm = 0  # số tiến trình đang sống đã warm-up xong
+        self.all_ready = threading.Event()  # mọi slot đã có tiến trình warm-up xong (lần khởi động đầu)
+        self.stats = {"jobs": 0, "recycled": 0, "limit_errors": 0, "crashes": 0}
+
+    def start(self):
+        with self.lock:
+            if self.started: return
+            self.started = True
+        for _ in range(self.size): self._spawn()
+
+    def _spawn(self):
+        worker = JobWorker(self.ctx)
+        threading.Thread(target=self._warm_up, args=(worker,), name="arena-job-worker-warm-up", daemon=True).start()
+
+    def _warm_up(self, worker):
+        try:
+            ok = worker.conn.poll(JOB_WARM_TIMEOUT_SECONDS) and worker.conn.recv()[0] == "ready"
+        except (EOFError, OSError):
+            ok = False
+        if ok:
+            self._mark_ready(worker)
+        else:
+            self.stats["crashes"] += 1
+            worker.stop(); worker = None
+        if self.closed and worker is not None:
+            worker.stop()
+            return
+        self.idle.put(worker)
+
+    def _mark_ready(self, worker):
+        worker.ready = True
+        with self.lock:
+            self.warm += 1
+            if self.warm >= self.size: self.all_ready.set()
+
+    def _retire(self, worker):
+        worker.stop()
+        if worker.ready:
+            with self.lock: self.warm -= 1
+
+    def describe(self):
+        return dict(self.stats, size=self.size, warm=self.warm, ready=self.all_ready.is_set())
+
+    def run(self, content, config_data, profile=False, progress=None, cancel=None):
+        if cancel is None: cancel = CancelToken(job_deadline(config_data))
+        self.start()
+        worker = self.idle.get()
+        recycle = True
+        try:
+            if worker is None: worker = JobWorker(self.ctx)
+            # Hết hạn / bị huỷ trong lúc chờ tiến trình thì không gửi đi: hạn 0 giây sẽ bị hiểu là "không có hạn"
+            remaining = cancel.remaining()
+            if cancel.check() or remaining == 0.0:
+                recycle = False
+                return cancelled_error(cancel.reason or "deadline")
+            try:
+                worker.cancel_event.clear()
+                worker.conn.send((content, config_data, profile, progress is not None, remaining))
+                deadline = time.monotonic() + JOB_WALL_TIMEOUT_SECONDS
+                while True:
+                    # Hạn xử lý do tiến trình con tự kiểm tra (để còn trả một phần); huỷ thì báo qua cancel_event
+                    if not worker.conn.poll(min(0.25, max(0.0, deadline - time.monotonic()))):
+                        if cancel.check() and cancel.reason != "deadline":
+                            worker.cancel_event.set()
+                        if time.monotonic() < deadline: continue
+                        self.stats["limit_errors"] += 1
+                        return limit_error(504, f"Quá {int(JOB_WALL_TIMEOUT_SECONDS)} giây xử lý, đã huỷ yêu cầu.")
+                    message = worker.conn.recv()
+                    if message[0] == "ready":
+                        self._mark_ready(worker)
+                        continue
+                    if message[0] == "progress":
+                        progress(message[1], **message[2])
+                        continue
+                    _, reply, rss_mb = message
+                    break
+            except (EOFError, OSError):
+                # Tiến trình bị hệ điều hành giết (thường do hết RAM hoặc vượt hard limit CPU)
+                self.stats["crashes"] += 1
+                return limit_error(500, f"Tiến trình xử lý bị dừng đột ngột (exit code {worker.process.exitcode}).")
+
+            worker.jobs_done += 1
+            self.stats["jobs"] += 1
+            kind, status, payload = reply
+            if kind == "ok":
+                recycle = worker.jobs_done >= JOB_MAX_JOBS_PER_WORKER or rss_mb > JOB_MAX_RSS_MB
+                return status, payload
+            if kind == "limit":
+                self.stats["limit_errors"] += 1
+                return limit_error(status, payload)
+            recycle = False
+            return status, {"message": "Lỗi hệ thống", "details": [payload]}
+        finally:
+            if recycle and worker is not None:
+                self._retire(worker)
+                self.stats["recycled"] += 1
+                if not self.closed: self._spawn()
+            else:
+                self.idle.put(worker)
+
+    def shutdown(self):
+        self.closed = True
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None: worker.stop()
+
+JOB_POOL = JobWorkerPool(JOB_WORKERS) if JOB_WORKERS > 0 and multiprocessing.parent_process() is None else None
+
+# ---------------------------------------------------------------------
+# Lập lịch công bằng giữa các trường (tenant) dùng chung 1 máy chủ
+# ---------------------------------------------------------------------
+# Số slot = số tiến trình con (ARENA_JOB_WORKERS), hoặc ARENA_SCHED_SLOTS khi chạy trong tiến trình server.
+# Job nặng (theo ước lượng trước khi chạy) đi làn riêng ARENA_HEAVY_SLOTS slot, trừ vào số slot trên: làn nhanh + làn
+# nặng = tổng số slot và làn nhanh luôn giữ ít nhất 1 slot (dưới 2 slot thì không tách làn, mọi job dùng chung 1 làn).
+# Giới hạn đồng thời của 1 trường tính trên cả 2 làn.
+# ARENA_TENANT_WEIGHTS="thpt-a:2,thcs-b:1"  ARENA_TENANT_MAX_CONCURRENCY="2" hoặc "thpt-a:3,*:1"
+# ARENA_TENANT_MAX_QUEUE: số job tối đa đang chờ của 1 trường (0 = không giới hạn)
+
+def parse_tenant_setting(text, default):
+    values = {"*": default}
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        tenant, sep, value = part.rpartition(":")
+        values[tenant.strip().lower() if sep else "*"] = float(value)
+    return values
+
+TENANT_HEADER = "x-arena-tenant"
+SCHED_SLOTS = max(1, JOB_WORKERS if JOB_POOL is not None else int(os.environ.get("ARENA_SCHED_SLOTS", "1")))
+HEAVY_SLOTS = max(0, min(int(os.environ.get("ARENA_HEAVY_SLOTS", "1")), SCHED_SLOTS - 1))
+TENANT_WEIGHTS = parse_tenant_setting(os.environ.get("ARENA_TENANT_WEIGHTS", ""), 1.0)
+TENANT_MAX_CONCURRENCY = parse_tenant_setting(os.environ.get("ARENA_TENANT_MAX_CONCURRENCY", ""), 0)
+TENANT_MAX_QUEUE = int(os.environ.get("ARENA_TENANT_MAX_QUEUE", "0"))
+
+class TenantQueueFull(Exception):
+    pass
+
+def _resolve_waiter(future):
+    if not future.done(): future.set_result(None)
+
+class LoopWaiters:
+    """Coroutine chờ 1 thay đổi do luồng khác báo (có slot, có sự kiện mới, job xong) mà không giữ luồng nào của
+    executor trong lúc chờ. add/remove/wake gọi khi đang giữ lock của đối tượng sở hữu."""
+    __slots__ = ('futures',)
+
+    def __init__(self):
+        self.futures = []
+
+    def add(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.futures.append((loop, future))
+        return future
+
+    def remove(self, future):
+        self.futures = [(loop, f) for loop, f in self.futures if f is not future]
+
+    def wake(self):
+        for loop, future in self.futures: loop.call_soon_threadsafe(_resolve_waiter, future)
+        self.futures = []
+
+async def wait_future(future, timeout):
+    # True nếu future xong trong thời hạn (future bị huỷ khi hết giờ)
+    try:
+        await asyncio.wait_for(future, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+class FairScheduler:
+    """Hàng đợi riêng cho từng trường, chia slot theo trọng số (weighted fair queuing).
+
+    Mỗi trường có đồng hồ ảo vtime; khi 1 job được cấp slot, vtime tăng thêm chi phí / trọng số
+    (chi phí = số giây CPU ước lượng của job). Slot trống luôn dành cho trường có vtime nhỏ nhất -> trường gửi
+    20 đề x 40 mã không chặn được trường chỉ trộn 2 mã. Trường mới vào (hoặc nghỉ lâu) được kéo
+    vtime lên mức thấp nhất đang hoạt động để không "tích điểm" rồi chiếm hết slot.
+    Slot được cấp cho vé đứng đầu (_dispatch) ngay khi trống; người chờ là luồng (acquire) hoặc coroutine
+    (acquire_async: chờ trên event loop, không chiếm luồng của executor khi còn xếp hàng).
+    Các làn tạo với shares_with dùng chung lock và giới hạn đồng thời của mỗi trường.
+    """
+
+    def __init__(self, slots, shares_with=None):
+        self.slots, self.running = max(1, slots), 0
+        self.lanes = shares_with.lanes if shares_with is not None else []
+        self.lanes.append(self)
+        self.cond = shares_with.cond if shares_with is not None else threading.Condition()
+        self.tenants = {}
+        self.ticket = 0
+        self.active = {}  # ticket -> (chi phí, lúc bắt đầu) của các job đang chạy, để ước lượng thời gian chờ
+        self.granted = set()  # vé đã được cấp slot nhưng người chờ chưa nhận
+        self.waiters = {}  # ticket -> LoopWaiters của coroutine đang chờ
+
+    def _tenant(self, name):
+        t = self.tenants.get(name)
+        if t is None:
+            t = self.tenants[name] = {"queue": [], "running": 0, "vtime": 0.0, "done": 0, "cancelled": 0,
+                                      "wait_total": 0.0, "wait_max": 0.0}
+        return t
+
+    @staticmethod
+    def _setting(values, name):
+        return values.get(name, values["*"])
+
+    def _active_vtime(self, exclude):
+        active = [t["vtime"] for n, t in self.tenants.items() if n != exclude and (t["queue"] or t["running"])]
+        return min(active) if active else None
+
+    def _tenant_running(self, name):
+        return sum(lane.tenants[name]["running"] for lane in self.lanes if name in lane.tenants)
+
+    def _pick(self):
+        best = None
+        for name, t in self.tenants.items():
+            if not t["queue"]: continue
+            cap = self._setting(TENANT_MAX_CONCURRENCY, name)
+            if cap and self._tenant_running(name) >= cap: continue
+            key = (t["vtime"], t["queue"][0][0])
+            if best is None or key < best[0]: best = (key, name)
+        return best and best[1]
+
+    def _enqueue(self, tenant, cost):
+        t = self._tenant(tenant)
+        if TENANT_MAX_QUEUE and len(t["queue"]) >= TENANT_MAX_QUEUE:
+            raise TenantQueueFull(tenant)
+        if not t["queue"] and not t["running"]:
+            floor = self._active_vtime(tenant)
+            if floor is not None: t["vtime"] = max(t["vtime"], floor)
+        self.ticket += 1
+        entry = (self.ticket, cost, time.monotonic())
+        t["queue"].append(entry)
+        self._dispatch()
+        return entry
+
+    def _dispatch(self):
+        # Cấp slot trống cho vé đầu hàng của trường có vtime nhỏ nhất, báo người chờ
+        while self.running < self.slots:
+            tenant = self._pick()
+            if tenant is None: break
+            t = self.tenants[tenant]
+            ticket, cost, queued_at = t["queue"].pop(0)
+            t["running"] += 1
+            t["vtime"] += cost / self._setting(TENANT_WEIGHTS, tenant)
+            waited = time.monotonic() - queued_at
+            t["wait_total"] += waited; t["wait_max"] = max(t["wait_max"], waited)
+            self.running += 1
+            self.active[ticket] = (cost, time.monotonic())
+            self.granted.add(ticket)
+            waiters = self.waiters.pop(ticket, None)
+            if waiters is not None: waiters.wake()
+        self.cond.notify_all()
+
+    def _withdraw(self, tenant, entry):
+        t = self.tenants[tenant]
+        t["queue"].remove(entry)
+        t["cancelled"] += 1
+        self._dispatch()
+
+    def acquire(self, tenant, cost=1, cancel=None):
+        # Trả về số vé (truyền lại cho release), hoặc False nếu job bị huỷ / quá hạn khi còn đang xếp hàng
+        with self.cond:
+            entry = self._enqueue(tenant, cost)
+            while entry[0] not in self.granted:
+                if cancel is not None and cancel.check():
+                    self._withdraw(tenant, entry)
+                    return False
+                self.cond.wait(0.25 if cancel is not None else None)
+            self.granted.discard(entry[0])
+            return entry[0]
+
+    async def acquire_async(self, tenant, cost=1, cancel=None):
+        # Như acquire nhưng chờ trên event loop; huỷ được kiểm tra mỗi 0.25 giây
+        with self.cond:
+            entry = self._enqueue(tenant, cost)
+        while True:
+            with self.cond:
+                if entry[0] in self.granted:
+                    self.granted.discard(entry[0])
+                    return entry[0]
+                if cancel is not None and cancel.check():
+                    self.waiters.pop(entry[0], None)
+                    self._withdraw(tenant, entry)
+                    return False
+                future = self.waiters.setdefault(entry[0], LoopWaiters()).add()
+            try:
+                woken = await wait_future(future, 0.25 if cancel is not None else None)
+            except asyncio.CancelledError:
+                # Coroutine bị huỷ: rút vé khỏi hàng, hoặc trả slot nếu vừa được cấp
+                with self.cond:
+                    self.waiters.pop(entry[0], None)
+                    if entry[0] in self.granted:
+                        self.granted.discard(entry[0])
+                        self.release(tenant, entry[0])
+                    else:
+                        self._withdraw(tenant, entry)
+                raise
+            if not woken:
+                with self.cond:
+                    if entry[0] in self.waiters: self.waiters[entry[0]].remove(future)
+
+    def release(self, tenant, ticket=None):
+        with self.cond:
+            t = self.tenants[tenant]
+            t["running"] -= 1; t["done"] += 1
+            self.running -= 1
+            self.active.pop(ticket, None)
+            # Slot của trường vừa trống có thể mở khoá job của trường đó ở làn kia
+            for lane in self.lanes: lane._dispatch()
+
+    def expected_wait(self):
+        # Phần việc còn lại (job đang chạy: chi phí - đã chạy; job đang chờ: cả chi phí) chia đều cho các slot
+        with self.cond:
+            queued = [entry[1] for t in self.tenants.values() for entry in t["queue"]]
+            if self.running < self.slots and not queued: return 0.0
+            now = time.monotonic()
+            backlog = sum(max(0.0, cost - (now - start)) for cost, start in self.active.values()) + sum(queued)
+            return backlog / self.slots
+
+    def stats(self):
+        with self.cond:
+            now = time.monotonic()
+            return {"slots": self.slots, "running": self.running, "tenants": {
+                name: {"queued": len(t["queue"]), "running": t["running"], "done": t["done"], "cancelled": t["cancelled"],
+                       "weight": self._setting(TENANT_WEIGHTS, name),
+                       "max_concurrency": self._setting(TENANT_MAX_CONCURRENCY, name) or None,
+                       "oldest_wait_s": round(now - t["queue"][0][2], 3) if t["queue"] else 0.0,
+                       "avg_wait_s": round(t["wait_total"] / t["done"], 3) if t["done"] else 0.0,
+                       "max_wait_s": round(t["wait_max"], 3), "vtime": round(t["vtime"], 3)}
+                for name, t in sorted(self.tenants.items())}}
+
+SCHEDULER = FairScheduler(SCHED_SLOTS - HEAVY_SLOTS)
+HEAVY_SCHEDULER = FairScheduler(HEAVY_SLOTS, SCHEDULER) if HEAVY_SLOTS else SCHEDULER
+LANES = {"fast": SCHEDULER, "heavy": HEAVY_SCHEDULER}
+
+def tenant_of(request, config_data):
+    return (request.headers.get(TENANT_HEADER) or str(config_data.get("truong") or "") or "default").strip().lower()
+
+def job_cost(config_data):
+    try:
+        return max(1, int(config_data.get("soDe", 1)))
+    except (TypeError, ValueError):
+        return 1
+
+def queue_full_error(tenant):
+    return 429, {"message": "Trường đang có quá nhiều đề chờ trộn, vui lòng thử lại sau", "details": [tenant]}
+
+# ---------------------------------------------------------------------
+# Ước lượng chi phí trước khi chạy: chỉ đọc mục lục ZIP + quét bytes document.xml (không parse XML)
+# ---------------------------------------------------------------------
+# Hệ số đo bằng calib trên 1 nhân CPU (xem commit); máy khác chỉnh bằng ARENA_COST_MODEL='{"first_per_xml_mb": 9}'
+COST_MODEL = dict({
+    "prepare_base": 0.03, "prepare_per_xml_mb": 0.3, "prepare_per_media_mb": 0.1,  # chuẩn hoá + tối ưu ảnh (giây)
+    "first_base": 0.1, "first_per_xml_mb": 7.0,                                    # đề đầu: parse, trộn, dựng khuôn
+    "variant_base": 0.001, "variant_per_xml_mb": 0.045,                            # mỗi đề sau: nối bytes + nén
+    "keys_per_question": 0.00012,                                                  # đáp án xlsx, mỗi câu x mỗi đề
+    "media_bytes_per_pixel": 0.25,                                                 # ảnh sau tối ưu (JPEG ở MEDIA_DPI)
+    "xml_deflate": 1.3,                                                            # docx ra / phần không phải ảnh của docx vào
+    "memory_base_mb": 8.0, "memory_per_upload_mb": 4.5, "memory_per_xml_mb": 110.0, "memory_per_output_mb": 2.0,
+}, **json.loads(os.environ.get("ARENA_COST_MODEL", "{}")))
+HEAVY_LANE_SECONDS = float(os.environ.get("ARENA_HEAVY_LANE_SECONDS", "5"))
+HEAVY_LANE_MEMORY_MB = float(os.environ.get("ARENA_HEAVY_LANE_MB", "256"))
+# Ngân sách 1 job (0 = không giới hạn); mặc định theo giới hạn của tiến trình con
+BUDGET_MAX_SO_DE = int(os.environ.get("ARENA_MAX_SO_DE", "100"))
+BUDGET_CPU_SECONDS = float(os.environ.get("ARENA_BUDGET_CPU_SECONDS", str(JOB_CPU_LIMIT_SECONDS)))
+BUDGET_MEMORY_MB = float(os.environ.get("ARENA_BUDGET_MEMORY_MB", str(JOB_MEMORY_LIMIT_MB)))
+BUDGET_OUTPUT_MB = float(os.environ.get("ARENA_BUDGET_OUTPUT_MB", "1024"))
+# "Câu" + khoảng trắng / thẻ XML (run bị tách) + chữ số; đếm trên bytes UTF-8 của document.xml
+RE_EST_QUESTION = re.compile(rb'C(?:\xc3\xa2|\xc3\x82)[uU](?:\s|<[^>]*>)+\d')
+RE_EST_EQUATION = re.compile(rb'<m:oMath[\s>]')
+RE_EST_EXTENT = re.compile(rb'<wp:extent cx="(\d+)" cy="(\d+)"')
+MB = 1024 * 1024
+
+def estimate_job(content, config_data):
+    # None nếu không phải .docx hợp lệ
+    try:
+        with zipfile.ZipFile(io.BytesIO(content)) as package:
+            infos = package.infolist()
+            xml = package.read("word/document.xml")
+    except (zipfile.BadZipFile, KeyError):
+        return None
+    m = COST_MODEL
+    so_de = job_cost(config_data)
+    media = [i for i in infos if i.filename.startswith("word/media/")]
+    media_mb = sum(i.file_size for i in media) / MB
+    other_mb = sum(i.compress_size for i in infos if not i.filename.startswith("word/media/")) / MB
+    xml_mb, upload_mb = len(xml) / MB, len(content) / MB
+    questions = len(RE_EST_QUESTION.findall(xml))
+
+    optimize = OPTIMIZE_MEDIA and config_data.get("toiUuAnh", True)
+    if optimize:
+        # Ảnh được thu về kích thước hiển thị -> dung lượng ra theo diện tích hiển thị, không vượt ảnh gốc
+        pixels = sum(int(cx) * int(cy) for cx, cy in RE_EST_EXTENT.findall(xml)) / EMU_PER_INCH ** 2 * MEDIA_DPI ** 2
+        media_out_mb = min(media_mb, pixels * m["media_bytes_per_pixel"] / MB)
+    else:
+        media_out_mb = media_mb
+    first = m["first_base"] + m["first_per_xml_mb"] * xml_mb
+    variant = m["variant_base"] + m["variant_per_xml_mb"] * xml_mb if FRAGMENT_RENDER else first
+    cpu = (m["prepare_base"] + m["prepare_per_xml_mb"] * xml_mb + (m["prepare_per_media_mb"] * media_mb if optimize else 0)
+           + first + variant * (so_de - 1) + m["keys_per_question"] * questions * so_de)
+    output_mb = so_de * (other_mb * m["xml_deflate"] + media_out_mb)
+    memory = (m["memory_base_mb"] + m["memory_per_upload_mb"] * upload_mb + m["memory_per_xml_mb"] * xml_mb
+              + m["memory_per_output_mb"] * output_mb)
+    lane = "heavy" if HEAVY_SLOTS and (cpu > HEAVY_LANE_SECONDS or memory > HEAVY_LANE_MEMORY_MB) else "fast"
+    return {"soDe": so_de, "questions": questions, "equations": len(RE_EST_EQUATION.findall(xml)),
+            "media": len(media), "media_mb": round(media_mb, 2), "document_xml_mb": round(xml_mb, 3),
+            "cpu_seconds": round(cpu, 2), "peak_memory_mb": round(memory, 1), "output_mb": round(output_mb, 2),
+            "lane": lane, "expected_wait_s": round(LANES[lane].expected_wait(), 1)}
+
+def budget_errors(estimate):
+    errors = []
+    if BUDGET_MAX_SO_DE and estimate["soDe"] > BUDGET_MAX_SO_DE:
+        errors.append(f"Tối đa {BUDGET_MAX_SO_DE} mã đề mỗi lần trộn (yêu cầu {estimate['soDe']}).")
+    if BUDGET_CPU_SECONDS and estimate["cpu_seconds"] > BUDGET_CPU_SECONDS:
+        errors.append(f"Ước tính cần {estimate['cpu_seconds']:.0f} giây xử lý, vượt giới hạn {BUDGET_CPU_SECONDS:.0f} giây.")
+    if BUDGET_MEMORY_MB and estimate["peak_memory_mb"] > BUDGET_MEMORY_MB:
+        errors.append(f"Ước tính cần {estimate['peak_memory_mb']:.0f} MB bộ nhớ, vượt giới hạn {BUDGET_MEMORY_MB:.0f} MB.")
+    if BUDGET_OUTPUT_MB and estimate["output_mb"] > BUDGET_OUTPUT_MB:
+        errors.append(f"File kết quả ước tính {estimate['output_mb']:.0f} MB, vượt giới hạn {BUDGET_OUTPUT_MB:.0f} MB.")
+    if errors: errors.append("Hãy giảm số mã đề, giảm dung lượng ảnh trong đề hoặc chia đề thành nhiều lần trộn.")
+    return errors
+
+def over_budget_error(errors):
+    return 413, {"message": "Đề vượt ngân sách xử lý của máy chủ", "details": errors}
+
+def invalid_docx_error():
+    return 400, {"message": "File không phải .docx hợp lệ", "details": []}
+
+def admit_job(content, config_data, estimate=None):
+    # Ước lượng -> chặn nếu vượt ngân sách. Trả về (ước lượng, None) hoặc (None, lỗi)
+    if estimate is None: estimate = estimate_job(content, config_data)
+    if estimate is None: return None, invalid_docx_error()
+    errors = budget_errors(estimate)
+    if errors: return None, over_budget_error(errors)
+    return estimate, None
+
+def run_admitted_job(content, config_data, profile, progress, cancel, estimate):
+    # Đã có slot của làn -> trộn (trong tiến trình worker nếu có)
+    if progress: progress("started", soDe=job_cost(config_data), lane=estimate["lane"])
+    if JOB_POOL is not None:
+        return JOB_POOL.run(content, config_data, profile, progress, cancel)
+    return run_mix_job(content, config_data, profile, progress, cancel)
+
+def execute_mix_job(tenant, content, config_data, profile=False, progress=None, cancel=None, estimate=None):
+    # Điểm vào của /api/jobs (luồng riêng của job): ước lượng -> chặn nếu vượt ngân sách -> chờ slot
+    # của làn (nhanh / nặng) theo lịch công bằng rồi mới trộn
+    if cancel is None: cancel = CancelToken(job_deadline(config_data))
+    estimate, error = admit_job(content, config_data, estimate)
+    if error: return error
+    scheduler = LANES[estimate["lane"]]
+    ticket = scheduler.acquire(tenant, estimate["cpu_seconds"], cancel)
+    if not ticket:
+        return cancelled_error(cancel.reason)
+    try:
+        return run_admitted_job(content, config_data, profile, progress, cancel, estimate)
+    finally:
+        scheduler.release(tenant, ticket)
+
+async def execute_mix_job_async(tenant, content, config_data, profile, cancel):
+    # Như execute_mix_job cho /api/mix-docx: xếp hàng ngay trên event loop, chỉ chiếm 1 luồng của executor
+    # khi đã có slot và thực sự trộn -> yêu cầu đang chờ không làm nghẽn /api/preview, /api/estimate, ...
+    estimate, error = await asyncio.to_thread(admit_job, content, config_data)
+    if error: return error
+    scheduler = LANES[estimate["lane"]]
+    ticket = await scheduler.acquire_async(tenant, estimate["cpu_seconds"], cancel)
+    if not ticket:
+        return cancelled_error(cancel.reason)
+
+    def run():
+        # Trả slot ngay trong luồng trộn: coroutine có bị huỷ giữa chừng thì slot vẫn giữ đến khi trộn xong
+        try:
+            status, payload = run_admitted_job(content, config_data, profile, None, cancel, estimate)
+            if status != 200: return status, payload
+            return status, store_result(payload)
+        finally:
+            scheduler.release(tenant, ticket)
+    return await asyncio.to_thread(run)
+
+# ---------------------------------------------------------------------
+# Single-flight: các yêu cầu giống hệt nhau (cùng file + cùng config + cùng nonce) đang chạy thì dùng chung 1 lần trộn
+# ---------------------------------------------------------------------
+
+def flight_key(content, config_data):
+    # Đề trộn ngẫu nhiên: 2 giáo viên gửi cùng file + config phải nhận 2 bộ đề khác nhau -> chỉ gộp khi client gửi
+    # "nonce" trong config (sinh 1 lần cho mỗi lần bấm "Trộn", gửi lại nguyên khi retry / bấm 2 lần). Không có nonce
+    # thì trả về None: không gộp. config đã gồm mọi tham số ảnh hưởng kết quả (soDe, maDeList, hanXuLy, ...)
+    if not str(config_data.get("nonce") or ""): return None
+    return hashlib.sha256(content).hexdigest() + ":" + hashlib.sha256(
+        json.dumps(config_data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class MixFlight:
+    __slots__ = ('key', 'cancel', 'attached', 'done', 'result', 'waiters')
+
+    def __init__(self, key, cancel):
+        self.key, self.cancel, self.attached = key, cancel, 1
+        self.done, self.result = threading.Event(), None
+        self.waiters = LoopWaiters()
+
+class SingleFlight:
+    """Yêu cầu đầu tiên (leader) chạy job; yêu cầu giống hệt đến sau gắn vào và nhận cùng kết quả.
+    Job chỉ bị huỷ khi MỌI client gắn vào đều đã ngắt kết nối."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def join(self, key, make_cancel):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and flight.cancel.reason is None:
+                flight.attached += 1
+                self.stats["coalesced"] += 1
+                return flight, False
+            flight = self.flights[key] = MixFlight(key, make_cancel())
+            self.stats["leaders"] += 1
+            return flight, True
+
+    def leave(self, flight):
+        with self.lock:
+            flight.attached -= 1
+            if flight.attached <= 0 and not flight.done.is_set(): flight.cancel.cancel("client_disconnected")
+
+    def finish(self, flight, result):
+        with self.lock:
+            flight.result = result
+            if self.flights.get(flight.key) is flight: del self.flights[flight.key]
+            flight.done.set()
+            flight.waiters.wake()
+
+    async def wait(self, flight):
+        # Yêu cầu gắn vào chờ leader trên event loop (không giữ luồng nào)
+        with self.lock:
+            if flight.done.is_set(): return
+            future = flight.waiters.add()
+        await future
+
+    def describe(self):
+        with self.lock:
+            return dict(self.stats, inflight=len(self.flights), attached=sum(f.attached for f in self.flights.values()))
+
+MIX_FLIGHTS = SingleFlight()
+
+async def cancel_on_disconnect(request, on_disconnect, until):
+    # Client đóng tab / proxy hết giờ -> báo để không render tiếp cho không ai nhận
+    while not until.is_set():
+        if await request.is_disconnected():
+            on_disconnect()
+            return
+        await asyncio.sleep(0.5)
+
+@app.get("/api/scheduler")
+async def scheduler_stats_endpoint():
+    # Mức cao nhất là làn nhanh (giữ nguyên dạng cũ); làn nặng nằm trong "heavy" (null khi không tách làn)
+    return dict(SCHEDULER.stats(), expected_wait_s=round(SCHEDULER.expected_wait(), 1),
+                heavy=dict(HEAVY_SCHEDULER.stats(), expected_wait_s=round(HEAVY_SCHEDULER.expected_wait(), 1))
+                if HEAVY_SCHEDULER is not SCHEDULER else None,
+                budgets={"soDe": BUDGET_MAX_SO_DE, "cpu_seconds": BUDGET_CPU_SECONDS, "memory_mb": BUDGET_MEMORY_MB,
+                         "output_mb": BUDGET_OUTPUT_MB},
+                single_flight=MIX_FLIGHTS.describe())
+
+@app.post("/api/estimate")
+async def estimate_endpoint(file: UploadFile = File(None), upload_id: str = Form(""), document_id: str = Form(""), config: str = Form("{}")):
+    # Ước lượng nhanh (không trộn): thời gian xử lý, bộ nhớ, dung lượng kết quả, làn và thời gian chờ dự kiến
+    content, error = await source_content(file, upload_id, document_id)
+    if error: return JSONResponse(status_code=error[0], content=error[1])
+    estimate = estimate_job(content, json.loads(config))
+    if estimate is None:
+        status, payload = invalid_docx_error()
+        return JSONResponse(status_code=status, content=payload)
+    errors = budget_errors(estimate)
+    return dict(estimate, accepted=not errors, errors=errors)
+
+@app.post("/api/mix-docx")
+async def mix_docx_endpoint(request: Request, file: UploadFile = File(None), upload_id: str = Form(""), document_id: str = Form(""), config: str = Form(...)):
+    try:
+        content, error = await source_content(file, upload_id, document_id)
+        if error: return JSONResponse(status_code=error[0], content=error[1])
+        config_data = json.loads(config)
+        profile = profiling_requested(request)
+        tenant = tenant_of(request, config_data)
+        # Yêu cầu có profile (số liệu riêng của lần chạy đó) hoặc không có nonce -> không gộp
+        key = None if profile else flight_key(content, config_data)
+        flight, leader = MIX_FLIGHTS.join(key or "solo:" + uuid.uuid4().hex, lambda: CancelToken(job_deadline(config_data)))
+        watcher = asyncio.create_task(cancel_on_disconnect(request, lambda: MIX_FLIGHTS.leave(flight), flight.done))
+
+        try:
+            if leader:
+                result = None
+                try:
+                    result = await execute_mix_job_async(tenant, content, config_data, profile, flight.cancel)
+                except TenantQueueFull:
+                    result = queue_full_error(tenant)
+                except Exception as e:
+                    traceback.print_exc()
+                    result = 500, {"message": "Lỗi hệ thống", "details": [str(e)]}
+                finally:
+                    # Coroutine leader bị huỷ (CancelledError: tắt server, timeout bọc ngoài): dừng job và vẫn công bố
+                    # kết quả để các yêu cầu đang gắn vào được trả lời và khoá được giải phóng
+                    if result is None:
+                        flight.cancel.cancel("cancelled")
+                        result = cancelled_error("cancelled")
+                    MIX_FLIGHTS.finish(flight, result)
+            else:
+                await MIX_FLIGHTS.wait(flight)
+            status, payload = flight.result
+        finally:
+            watcher.cancel()
+        if status != 200:
+            return JSONResponse(status_code=status, content=payload)
+
+        # payload = result_id: ZIP đã nằm trong kho kết quả, tải lại / tải tiếp (Range) qua /api/results/{id}
+        return serve_result(request, payload, allow_range=False)
+
+    except Exception as e:
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"message": "Lỗi hệ thống", "details": [str(e)]})
+
+# =====================================================================
+# MODULE 12: JOB NỀN + TIẾN ĐỘ QUA SSE (CÓ THỂ NỐI LẠI THEO JOB ID)
+# =====================================================================
+
+JOB_TTL_SECONDS = int(os.environ.get("ARENA_JOB_TTL", "1800"))
+JOB_FINISHED = ("done", "error", "cancelled")
+MIX_JOBS = {}
+RUNNING_JOB_KEYS = {}  # flight_key -> job_id của job chưa xong
+_mix_jobs_lock = threading.Lock()
+
+class MixJobState:
+    """Trạng thái 1 job nền: danh sách sự kiện có id tăng dần (để client nối lại bằng Last-Event-ID),
+    các đề đã render xong (tải trước được) và ZIP cuối cùng."""
+
+    def __init__(self, job_id):
+        self.job_id, self.created = job_id, time.time()
+        self.status, self.result, self.error, self.error_status = "queued", None, None, None
+        self.cancel, self.estimate = None, None
+        self.events, self.variants = [], {}
+        self.cond = threading.Condition()
+        self.waiters = LoopWaiters()
+
+    def emit(self, event, **data):
+        docx = data.pop("docx", None)
+        with self.cond:
+            if docx is not None:
+                self.variants[data["index"]] = (data["ma_de"], docx)
+                data["url"] = f"/api/jobs/{self.job_id}/variants/{data['index']}"
+            self.events.append((len(self.events) + 1, event, data))
+            self.cond.notify_all()
+            self.waiters.wake()
+
+    def finish(self, job_status, event, **data):
+        with self.cond:
+            self.status = job_status
+        self.emit(event, **data)
+
+    async def events_after(self, last_id, timeout):
+        # Chờ sự kiện mới trên event loop: mỗi client SSE không giữ 1 luồng của executor
+        with self.cond:
+            future = None
+            if len(self.events) <= last_id and self.status not in JOB_FINISHED:
+                future = self.waiters.add()
+        if future is not None and not await wait_future(future, timeout):
+            with self.cond: self.waiters.remove(future)
+        with self.cond:
+            return self.events[last_id:], self.status in JOB_FINISHED
+
+    def describe(self):
+        return {"job_id": self.job_id, "status": self.status, "events": len(self.events),
+                "variants_ready": len(self.variants), "error": self.error}
+
+def _expire_jobs():
+    now = time.time()
+    with _mix_jobs_lock:
+        for job_id in [j for j, s in MIX_JOBS.items() if now - s.created > JOB_TTL_SECONDS]:
+            del MIX_JOBS[job_id]
+        for key in [k for k, j in RUNNING_JOB_KEYS.items() if j not in MIX_JOBS or MIX_JOBS[j].status in JOB_FINISHED]:
+            del RUNNING_JOB_KEYS[key]
+
+def _run_background_job(state, tenant, content, config_data, profile, estimate):
+    def progress(event, **data):
+        if event == "started": state.status = "running"
+        state.emit(event, **data)
+    try:
+        status, payload = execute_mix_job(tenant, content, config_data, profile, progress, state.cancel, estimate)
+    except TenantQueueFull:
+        status, payload = queue_full_error(tenant)
+    except Exception as e:
+        traceback.print_exc()
+        status, payload = 500, {"message": "Lỗi hệ thống", "details": [str(e)]}
+    if status == 200:
+        state.result = store_result(payload)
+        state.finish("done", "archive", size=len(payload), url=f"/api/jobs/{state.job_id}/result",
+                     result_id=state.result, download=f"/api/results/{state.result}")
+    else:
+        state.error, state.error_status = payload, status
+        if status == 499: state.finish("cancelled", "cancelled", status=status, **payload)
+        else: state.finish("error", "error", status=status, **payload)
+
+def get_job_or_404(job_id):
+    state = MIX_JOBS.get(job_id)
+    if state is None:
+        return None, JSONResponse(status_code=404, content={"message": "Không tìm thấy job (có thể đã hết hạn)", "details": [job_id]})
+    return state, None
+
+@app.post("/api/jobs", status_code=202)
+async def create_job_endpoint(request: Request, file: UploadFile = File(None), upload_id: str = Form(""), document_id: str = Form(""), config: str = Form(...)):
+    content, error = await source_content(file, upload_id, document_id)
+    if error: return JSONResponse(status_code=error[0], content=error[1])
+    config_data = json.loads(config)
+    _expire_jobs()
+    # Vượt ngân sách thì từ chối ngay, không tạo job
+    estimate = estimate_job(content, config_data)
+    status, payload = invalid_docx_error() if estimate is None else over_budget_error(budget_errors(estimate))
+    if estimate is None or payload["details"]:
+        return JSONResponse(status_code=status, content=payload)
+    key = None if profiling_requested(request) else flight_key(content, config_data)
+    with _mix_jobs_lock:
+        existing = MIX_JOBS.get(RUNNING_JOB_KEYS.get(key)) if key else None
+        if existing is not None and existing.status not in JOB_FINISHED:
+            # Gửi lại / đồng nghiệp tải cùng đề: nhận job_id đang chạy, theo dõi cùng luồng sự kiện
+            with MIX_FLIGHTS.lock: MIX_FLIGHTS.stats["coalesced"] += 1
+            return {"job_id": existing.job_id, "events": f"/api/jobs/{existing.job_id}/events",
+                    "result": f"/api/jobs/{existing.job_id}/result", "attached": True, "estimate": existing.estimate}
+        state = MixJobState(uuid.uuid4().hex)
+        state.cancel = CancelToken(job_deadline(config_data))
+        state.estimate = estimate
+        state.emit("estimated", **estimate)
+        MIX_JOBS[state.job_id] = state
+        if key: RUNNING_JOB_KEYS[key] = state.job_id
+    threading.Thread(target=_run_background_job, name=f"arena-job-{state.job_id[:8]}", daemon=True,
+                     args=(state, tenant_of(request, config_data), content, config_data, profiling_requested(request),
+                           estimate)).start()
+    return {"job_id": state.job_id, "events": f"/api/jobs/{state.job_id}/events", "result": f"/api/jobs/{state.job_id}/result",
+            "attached": False, "estimate": estimate}
+
+@app.get("/api/jobs/{job_id}")
+async def job_status_endpoint(job_id: str):
+    state, error = get_job_or_404(job_id)
+    return error or state.describe()
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events_endpoint(job_id: str, request: Request, last_event_id: int = 0):
+    state, error = get_job_or_404(job_id)
+    if error: return error
+    # Trình duyệt tự gửi Last-Event-ID khi kết nối lại EventSource
+    header_id = request.headers.get("last-event-id", "")
+    last_id = int(header_id) if header_id.isdigit() else last_event_id
+
+    async def stream():
+        nonlocal last_id
+        while True:
+            events, finished = await state.events_after(last_id, 15)
+            for event_id, event, data in events:
+                last_id = event_id
+                yield f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            if finished and not events: break
+            if not events: yield ": ping\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job_endpoint(job_id: str):
+    state, error = get_job_or_404(job_id)
+    if error: return error
+    if state.status not in JOB_FINISHED: state.cancel.cancel("cancelled")
+    return state.describe()
+
+@app.get("/api/jobs/{job_id}/variants/{index}")
+async def job_variant_endpoint(job_id: str, index: int):
+    state, error = get_job_or_404(job_id)
+    if error: return error
+    variant = state.variants.get(index)
+    if variant is None:
+        return JSONResponse(status_code=404, content={"message": "Đề này chưa render xong", "details": [index]})
+    ma_de, docx = variant
+    return Response(docx, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    headers={'Content-Disposition': f'attachment; filename="De_Ma_{ma_de}.docx"'})
+
+@app.api_route("/api/jobs/{job_id}/result", methods=["GET", "HEAD"])
+async def job_result_endpoint(job_id: str, request: Request):
+    state, error = get_job_or_404(job_id)
+    if error: return error
+    if state.status in ("error", "cancelled"):
+        return JSONResponse(status_code=state.error_status, content=state.error)
+    if state.status != "done":
+        return JSONResponse(status_code=409, content={"message": "Job chưa xong", "details": [state.status]})
+    return serve_result(request, state.result)
+
+# =====================================================================
+# MODULE 13: CHẤM BÀI HÀNG LOẠT (VECTOR HOÁ BẰNG NUMPY)
+# =====================================================================
+
+ZONE_CODES = {"P1": 1, "P2": 2, "P3": 3}
+ZONE_BY_SCORE = {"0.25": "P1", "0.1 0.25 0.5 1": "P2", "0.5": "P3"}
+ID_HEADERS = {"sbd", "số báo danh", "so bao danh", "student_id", "student id", "id", "mã hs", "ma hs", "mahs"}
+MADE_HEADERS = {"mã đề", "ma de", "made", "ma_de", "mã_đề", "exam", "code"}
+RE_P2_COLUMN = re.compile(r'^(\d+)\s*([a-d])$', re.IGNORECASE)
+P2_NORMALIZE = str.maketrans({"D": "Đ", "T": "Đ", "1": "Đ", "F": "S", "0": "S"})
+# Mảng chuỗi numpy rộng theo ô dài nhất (cắt cụt sẽ chấm sai đáp án P3 dài); ô dài quá mức này bị từ chối
+# thay vì làm ma trận (học sinh x câu) phình to
+RESPONSE_MAX_WIDTH = int(os.environ.get("ARENA_GRADE_MAX_CELL", "64"))
+
+def read_table(data, filename):
+    # CSV (tự nhận dấu phân cách) hoặc XLSX -> list các dòng, mỗi ô là chuỗi
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        rows = [["" if v is None else (str(int(v)) if isinstance(v, float) and v.is_integer() else str(v)) for v in row]
+                for row in wb.active.iter_rows(values_only=True)]
+        wb.close()
+        return rows
+    text = data.decode("utf-8-sig")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    return [row for row in csv.reader(io.StringIO(text), dialect)]
+
+def load_answer_keys(data, filename):
+    # DapAn.json trong file ZIP trả về, hoặc DapAn_ChiTiet_Doc.xlsx (suy ra phần thi từ cột Điểm)
+    if filename.lower().endswith(".json"):
+        obj = json.loads(data.decode("utf-8-sig"))
+        return obj.get("exams", obj)
+    keys = {}
+    for row in read_table(data, filename)[1:]:
+        if len(row) < 4 or not str(row[0]).strip(): continue
+        score = str(row[3]).strip()
+        keys.setdefault(str(row[0]).strip(), []).append(
+            {'q_num': int(float(row[1])), 'ans': str(row[2]).strip(), 'score': score, 'zone': ZONE_BY_SCORE.get(score, "P1")})
+    return keys
+
+def _map_unique(np, arr, func, dtype):
+    # Hàm Python chỉ chạy trên các giá trị KHÁC NHAU (vài chục), rồi rải lại bằng chỉ số -> không lặp theo từng ô
+    if arr.size == 0: return np.zeros(arr.shape, dtype=dtype)
+    uniq, inverse = np.unique(arr, return_inverse=True)
+    return np.array([func(u) for u in uniq.tolist()], dtype=dtype)[inverse].reshape(arr.shape)
+
+def _normalize_cells(np, values):
+    arr = np.array(values, dtype=str)
+    if arr.size and arr.dtype.itemsize // 4 > RESPONSE_MAX_WIDTH:
+        longest = arr.flat[int(np.char.str_len(arr).argmax())]
+        raise ValueError(f"Ô đáp án / câu trả lời dài {len(longest)} ký tự, tối đa {RESPONSE_MAX_WIDTH}: "
+                         f"{_excerpt(longest, 40)!r}")
+    return _map_unique(np, arr, lambda s: s.strip().upper(), str)
+
+def _to_float(s):
+    try:
+        return float(s.replace(",", "."))
+    except ValueError:
+        return float("nan")
+
+def compile_answer_keys(np, keys_by_made):
+    made_list = list(keys_by_made.keys())
+    n_q = max((len(v) for v in keys_by_made.values()), default=0)
+    answers = [["" for _ in range(n_q)] for _ in made_list]
+    zones = np.zeros((len(made_list), n_q), dtype=np.int8)
+    weights = np.zeros((len(made_list), n_q), dtype=np.float64)
+    p2_scale = np.zeros((len(made_list), n_q, 5), dtype=np.float64)
+    sources = np.zeros((len(made_list), n_q), dtype=np.int64)
+    perms = np.full((len(made_list), n_q, 4), -1, dtype=np.int64)
+    for m, made in enumerate(made_list):
+        for q, item in enumerate(keys_by_made[made]):
+            answers[m][q] = str(item['ans'])
+            zones[m, q] = ZONE_CODES.get(item['zone'], 0)
+            sources[m, q] = int(item.get('src') or 0)
+            perm = str(item.get('perm') or "").lower()
+            if len(perm) == 4: perms[m, q] = [ord(c) - ord('a') for c in perm]
+            steps = [float(s) for s in str(item['score']).split()] or [0.0]
+            if zones[m, q] == 2:
+                p2_scale[m, q, 1:1 + len(steps[:4])] = steps[:4]
+            else:
+                weights[m, q] = steps[0]
+    return {"made_index": {made: m for m, made in enumerate(made_list)}, "answers": _normalize_cells(np, answers).reshape(len(made_list), n_q),
+            "zones": zones, "weights": weights, "p2_scale": p2_scale, "sources": sources, "perms": perms, "n_q": n_q}
+
+def parse_responses(np, rows):
+    # -> (ds SBD, ds mã đề, ma trận câu trả lời theo thứ tự câu). Cột 1a..1d (kiểu OLM) được gộp thành "ĐSĐS"
+    header = [str(h).strip() for h in rows[0]]
+    lower = [h.lower() for h in header]
+    id_col = next((i for i, h in enumerate(lower) if h in ID_HEADERS), 0)
+    made_col = next((i for i, h in enumerate(lower) if h in MADE_HEADERS), 1)
+    groups = []
+    for i, h in enumerate(header):
+        if i in (id_col, made_col): continue
+        m = RE_P2_COLUMN.match(h)
+        if m and groups and groups[-1][0] == m.group(1):
+            groups[-1][1].append(i)
+        else:
+            groups.append((m.group(1) if m else None, [i]))
+
+    width = len(header)
+    body = [row if len(row) >= width else list(row) + [""] * (width - len(row)) for row in rows[1:]]
+    body = [row for row in body if str(row[id_col]).strip() or str(row[made_col]).strip()]
+    ids = [str(row[id_col]).strip() for row in body]
+    mades = [str(row[made_col]).strip() for row in body]
+
+    q_cols = [i for _, cols in groups for i in cols]
+    if not q_cols or not body: return ids, mades, np.zeros((len(body), 0), dtype=str)
+    pick = itemgetter(*q_cols)
+    cells = _normalize_cells(np, [pick(row) if len(q_cols) > 1 else (pick(row),) for row in body])
+    parts, pos = [], 0
+    for _, cols in groups:
+        joined = cells[:, pos]
+        for k in range(1, len(cols)): joined = np.char.add(joined, cells[:, pos + k])
+        parts.append(joined)
+        pos += len(cols)
+    return ids, mades, np.stack(parts, axis=1)
+
+def prepare_responses(np, keys_by_made, rows):
+    key = compile_answer_keys(np, keys_by_made)
+    ids, mades, answers = parse_responses(np, rows)
+    n_s, n_q = len(ids), key["n_q"]
+
+    resp = np.full((n_s, n_q), "", dtype=answers.dtype)
+    width = min(n_q, answers.shape[1])
+    resp[:, :width] = answers[:, :width]
+
+    made_uniq, made_inverse = np.unique(np.array(mades, dtype=str), return_inverse=True)
+    made_idx = np.array([key["made_index"].get(m, -1) for m in made_uniq.tolist()], dtype=np.int64)[made_inverse].reshape(n_s)
+    known = made_idx >= 0
+    rows_idx = np.where(known, made_idx, 0)
+    return {"key": key, "ids": ids, "mades": mades, "resp": resp, "known": known, "rows_idx": rows_idx,
+            "k_ans": key["answers"][rows_idx], "zones": key["zones"][rows_idx], "weights": key["weights"][rows_idx]}
+
+def _p2_statement_hits(np, resp, k_ans, cols):
+    # -> ma trận bool (học sinh, câu P2, 4 ý): ý thứ i trả lời khớp đáp án
+    normalize = lambda s: s.translate(P2_NORMALIZE)[:4]
+    n_s = resp.shape[0]
+    r_chars = _map_unique(np, resp[:, cols], normalize, "<U4").view("<U1").reshape(n_s, cols.size, 4)
+    k_chars = _map_unique(np, k_ans[:, cols], normalize, "<U4").view("<U1").reshape(n_s, cols.size, 4)
+    return (r_chars == k_chars) & (k_chars != "")
 
+def _p3_correct(np, resp, k_ans, cols):
+    r_sub, k_sub = resp[:, cols], k_ans[:, cols]
+    r_num, k_num = _map_unique(np, r_sub, _to_float, np.float64), _map_unique(np, k_sub, _to_float, np.float64)
+    numeric_ok = np.isfinite(r_num) & np.isfinite(k_num) & np.isclose(r_num, k_num, rtol=0.0, atol=1e-9)
+    text_ok = ~np.isfinite(k_num) & (r_sub == k_sub) & (k_sub != "")
+    return numeric_ok | text_ok
+
+def grade_responses(keys_by_made, rows):
+    import numpy as np  # import lười: chỉ cần khi chấm bài
+    g = prepare_responses(np, keys_by_made, rows)
+    key, ids, mades, resp, known, rows_idx = g["key"], g["ids"], g["mades"], g["resp"], g["known"], g["rows_idx"]
+    k_ans, zones, weights = g["k_ans"], g["zones"], g["weights"]
+    n_s = len(ids)
+
+    # P1: đúng tuyệt đối
+    p1 = (((zones == 1) & (resp == k_ans) & (k_ans != "")) * weights).sum(axis=1)
+
+    # P2: đếm số ý Đ/S khớp -> thang 0.1 / 0.25 / 0.5 / 1 (chỉ xét các cột có câu P2)
+    p2 = np.zeros(n_s)
+    cols = np.flatnonzero((key["zones"] == 2).any(axis=0))
+    if cols.size:
+        hits = _p2_statement_hits(np, resp, k_ans, cols).sum(axis=2)
+        points = np.take_along_axis(key["p2_scale"][rows_idx][:, cols], hits[..., None], axis=2)[..., 0]
+        p2 = (points * (zones[:, cols] == 2)).sum(axis=1)
+
+    # P3: so sánh số sau chuẩn hoá (dấu phẩy -> chấm); đáp án không phải số thì so chuỗi
+    p3 = np.zeros(n_s)
+    cols = np.flatnonzero((key["zones"] == 3).any(axis=0))
+    if cols.size:
+        p3 = (((zones[:, cols] == 3) & _p3_correct(np, resp, k_ans, cols)) * weights[:, cols]).sum(axis=1)
+
+    part_totals = np.stack([p1, p2, p3], axis=1).round(2)
+    totals = part_totals.sum(axis=1).round(2)
+
+    results = []
+    for s, (p1_s, p2_s, p3_s) in enumerate(part_totals.tolist()):
+        if not known[s]:
+            results.append({"sbd": ids[s], "ma_de": mades[s], "error": "Không tìm thấy mã đề trong đáp án"})
+            continue
+        results.append({"sbd": ids[s], "ma_de": mades[s], "P1": p1_s, "P2": p2_s, "P3": p3_s, "tong": float(totals[s])})
+    return results
+
+@app.post("/api/grade")
+async def grade_endpoint(responses: UploadFile = File(...), answer_key: UploadFile = File(...), format: str = Form("json")):
+    try:
+        keys_by_made = load_answer_keys(await answer_key.read(), answer_key.filename or "")
+        rows = read_table(await responses.read(), responses.filename or "")
+        if not rows:
+            return JSONResponse(status_code=400, content={"message": "File bài làm trống", "details": []})
+        results = grade_responses(keys_by_made, rows)
+
+        if format == "csv":
+            out = io.StringIO()
+            writer = csv.writer(out)
+            writer.writerow(["SBD", "Mã đề", "Phần I", "Phần II", "Phần III", "Tổng", "Lỗi"])
+            for r in results:
+                writer.writerow([r["sbd"], r["ma_de"], r.get("P1", ""), r.get("P2", ""), r.get("P3", ""), r.get("tong", ""), r.get("error", "")])
+            return StreamingResponse(io.BytesIO(out.getvalue().encode("utf-8-sig")), media_type="text/csv",
+                                     headers={'Content-Disposition': 'attachment; filename="KetQua_Cham.csv"'})
+        return {"count": len(results), "results": results}
+
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": "Không chấm được", "details": [str(e)]})
+    except Exception as e:
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"message": "Lỗi hệ thống", "details": [str(e)]})
+
+# =====================================================================
+# MODULE 14: PHÂN TÍCH CÂU HỎI (ĐỘ KHÓ, ĐỘ PHÂN BIỆT, PHƯƠNG ÁN NHIỄU, KR-20)
+# =====================================================================
+
+def _column_corr(np, x, y):
+    xc, yc = x - x.mean(axis=0), y - y.mean(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (xc * yc).sum(axis=0) / np.sqrt((xc ** 2).sum(axis=0) * (yc ** 2).sum(axis=0))
+
+def _stat(value):
+    value = float(value)
+    return None if value != value else round(value, 4)
+
+def analyze_items(keys_by_made, rows):
+    # Mọi câu trả lời được quy về câu GỐC (src) và phương án GỐC (perm) trước khi thống kê,
+    # nên "C ở mã 103" được tính cho đúng phương án ban đầu của câu đó
+    import numpy as np  # import lười: chỉ cần khi phân tích
+    g = prepare_responses(np, keys_by_made, rows)
+    key, known = g["key"], g["known"]
+    if (key["sources"] == 0).any() or ((key["zones"] <= 2)[..., None] & (key["perms"] < 0)).any():
+        raise ValueError("Đáp án thiếu thông tin hoán vị: hãy dùng DapAn.json của lần trộn mới.")
+
+    resp, k_ans, rows_idx = g["resp"][known], g["k_ans"][known], g["rows_idx"][known]
+    zones = key["zones"][0]
+    sources, perms = key["sources"][rows_idx], key["perms"][rows_idx]
+    n = resp.shape[0]
+    if n < 2: raise ValueError("Cần ít nhất 2 bài làm có mã đề hợp lệ để phân tích.")
+    student = np.arange(n)[:, None]
+    blocks, items = [], []
+
+    # P1: phương án học sinh chọn (theo vị trí trong đề) -> phương án gốc
+    cols = np.flatnonzero(zones == 1)
+    if cols.size:
+        n1 = int(sources[:, cols].max())
+        choice = _map_unique(np, resp[:, cols], lambda s: "ABCD".index(s) if s in ("A", "B", "C", "D") else -1, np.int64)
+        orig_choice = np.where(choice >= 0, np.take_along_axis(perms[:, cols], np.maximum(choice, 0)[..., None], axis=2)[..., 0], -1)
+        src_choice = np.full((n, n1), -1, dtype=np.int64)
+        src_correct = np.zeros((n, n1))
+        src_choice[student, sources[:, cols] - 1] = orig_choice
+        src_correct[student, sources[:, cols] - 1] = (resp[:, cols] == k_ans[:, cols]) & (k_ans[:, cols] != "")
+        rates = (src_choice[..., None] == np.arange(4)).mean(axis=0)
+        blank = (src_choice == -1).mean(axis=0)
+        # Phương án gốc đúng: lấy từ mã đề đầu tiên (vị trí đáp án trong đề đó -> nhãn gốc)
+        key_pos = {}
+        for q in cols.tolist():
+            letter = str(key["answers"][0, q])
+            if letter in ("A", "B", "C", "D"): key_pos[int(key["sources"][0, q])] = "ABCD"[key["perms"][0, q, "ABCD".index(letter)]]
+        blocks.append(src_correct)
+        for j in range(n1):
+            items.append({"zone": "P1", "src": j + 1, "correct": key_pos.get(j + 1), "cols": [len(items)],
+                          "options": {**{"ABCD"[o]: _stat(rates[j, o]) for o in range(4)}, "blank": _stat(blank[j])}})
+
+    # P2: từng ý a-d được quy về ý gốc
+    cols = np.flatnonzero(zones == 2)
+    if cols.size:
+        n2 = int(sources[:, cols].max())
+        hits = _p2_statement_hits(np, resp, k_ans, cols)
+        src_hits = np.zeros((n, n2, 4))
+        src_hits[student[..., None], (sources[:, cols] - 1)[..., None], perms[:, cols]] = hits
+        start = sum(b.shape[1] for b in blocks)
+        blocks.append(src_hits.reshape(n, n2 * 4))
+        for j in range(n2):
+            items.append({"zone": "P2", "src": j + 1, "cols": list(range(start + 4 * j, start + 4 * j + 4))})
+
+    # P3: đúng / sai
+    cols = np.flatnonzero(zones == 3)
+    if cols.size:
+        n3 = int(sources[:, cols].max())
+        src_correct = np.zeros((n, n3))
+        src_correct[student, sources[:, cols] - 1] = _p3_correct(np, resp, k_ans, cols)
+        start = sum(b.shape[1] for b in blocks)
+        blocks.append(src_correct)
+        for j in range(n3):
+            items.append({"zone": "P3", "src": j + 1, "cols": [start + j]})
+
+    # Ma trận nhị phân (học sinh x ý chấm): P1, từng ý P2, P3
+    x = np.concatenate(blocks, axis=1) if blocks else np.zeros((n, 0))
+    total = x.sum(axis=1)
+    k = x.shape[1]
+    p = x.mean(axis=0)
+    var_total = total.var()
+    kr20 = (k / (k - 1)) * (1 - (p * (1 - p)).sum() / var_total) if k > 1 and var_total > 0 else float("nan")
+    pbis = _column_corr(np, x, total[:, None] - x)
+
+    # Độ phân biệt cấp câu: điểm câu so với điểm phần còn lại
+    item_scores = np.stack([x[:, it["cols"]].sum(axis=1) for it in items], axis=1) if items else np.zeros((n, 0))
+    item_pbis = _column_corr(np, item_scores, total[:, None] - item_scores)
+
+    report = []
+    for i, it in enumerate(items):
+        entry = {"zone": it["zone"], "src": it["src"], "p_value": _stat(p[it["cols"]].mean()), "point_biserial": _stat(item_pbis[i])}
+        if it["zone"] == "P1":
+            entry["correct"] = it["correct"]; entry["options"] = it["options"]
+        elif it["zone"] == "P2":
+            entry["statements"] = {"abcd"[s]: {"p_value": _stat(p[c]), "point_biserial": _stat(pbis[c])} for s, c in enumerate(it["cols"])}
+        report.append(entry)
+    return {"students": int(n), "skipped": int((~known).sum()), "scored_points": int(k), "kr20": _stat(kr20),
+            "mean_raw_score": _stat(total.mean()), "items": report}
+
+@app.post("/api/item-analysis")
+async def item_analysis_endpoint(responses: UploadFile = File(...), answer_key: UploadFile = File(...)):
+    try:
+        keys_by_made = load_answer_keys(await answer_key.read(), answer_key.filename or "")
+        rows = read_table(await responses.read(), responses.filename or "")
+        if not rows:
+            return JSONResponse(status_code=400, content={"message": "File bài làm trống", "details": []})
+        return analyze_items(keys_by_made, rows)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": "Không phân tích được", "details": [str(e)]})
+    except Exception as e:
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"message": "Lỗi hệ thống", "details": [str(e)]})
+
+# =====================================================================
+# MODULE 15: XEM TRƯỚC KẾT QUẢ PHÂN TÍCH ĐỀ GỐC (KHÔNG RENDER DOCX)
+# =====================================================================
+
+PREVIEW_CACHE = {}
+PREVIEW_CACHE_SIZE = int(os.environ.get("ARENA_PREVIEW_CACHE", "64"))
+_preview_lock = threading.Lock()
+PREVIEW_EXCERPT = 80
+
+def _excerpt(text, limit=PREVIEW_EXCERPT):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def preview_question(block, zone_type, number):
+    q_text = get_text_from_element(block[0]).strip()
+    q_text_short = q_text[:40] + "..."
+    item = {"zone": zone_type, "src": number, "text": _excerpt(q_text), "flags": [], "error": None}
+    if zone_type in ["P1", "P2"]:
+        record = detect_answer_markers(block, zone_type)
+        labels = "ABCD" if zone_type == "P1" else "abcd"
+        item["options"] = [{"label": labels[n] if n < 4 else "?", "text": _excerpt(get_text_from_element(block[idxs[0]]), 60),
+                            "correct": is_correct} for n, (idxs, is_correct) in enumerate(record.options)]
+        correct = [o["label"] for o in item["options"] if o["correct"]]
+        item["ans"] = "".join(correct) if zone_type == "P1" else "".join("Đ" if o["correct"] else "S" for o in item["options"])
+        item["error"] = answer_record_error(record, zone_type, q_text_short)
+        if len(record.options) != 4: item["flags"].append("so_phuong_an")
+        elif zone_type == "P1" and len(correct) != 1: item["flags"].append("chua_co_dap_an" if not correct else "nhieu_dap_an")
+    elif zone_type == "P3":
+        ans = None
+        for el in block:
+            if el.tag.endswith('p'):
+                match = RE_KEY_LINE.search(get_text_from_element(el).strip())
+                if match: ans = match.group(1).strip()
+        item["ans"] = ans
+        if not ans:
+            item["flags"].append("thieu_key")
+            item["error"] = f"{zone_type} - {q_text_short} CHƯA có dòng đáp án (Key: 123)."
+    if any(el.find(f'.//{{{WORD_NS["w"]}}}drawing') is not None for el in block): item["flags"].append("co_hinh")
+    if any(node.tag.endswith(('}oMath', '}object')) for el in block for node in el.iter() if isinstance(node.tag, str)):
+        item["flags"].append("co_cong_thuc")
+    return item
+
+def build_preview(content):
+    # Chỉ chạy parse_docx + nhận diện đáp án (đọc, không sửa cây XML), cache theo nội dung file
+    digest = hashlib.sha256(content).hexdigest()
+    cached = PREVIEW_CACHE.get(digest)
+    if cached is not None: return cached
+    return remember_preview(digest, analyze_preview(Document(io.BytesIO(content)), digest))
+
+def remember_preview(digest, preview):
+    with _preview_lock:
+        PREVIEW_CACHE[digest] = preview
+        while len(PREVIEW_CACHE) > PREVIEW_CACHE_SIZE: PREVIEW_CACHE.pop(next(iter(PREVIEW_CACHE)))
+    return preview
+
+def analyze_preview(doc, digest):
+    compaction = compact_document(doc)
+    parsed_data = parse_docx(doc)
+    zones, errors = {}, []
+    for z in ZONES:
+        headers = [_excerpt(get_text_from_element(el)) for el in parsed_data[z].header]
+        questions = [preview_question(question.xml, z, n + 1) for n, question in enumerate(parsed_data[z].questions)]
+        errors.extend(q["error"] for q in questions if q["error"])
+        if headers or questions: zones[z] = {"header": [h for h in headers if h], "questions": questions}
+    return {"sha256": digest, "questions": {z: len(zones[z]["questions"]) for z in zones},
+            "zones": zones, "errors": errors, "compaction": compaction}
+
+def render_preview_html(preview):
+    e = html.escape
+    parts = ["<!doctype html><meta charset='utf-8'><title>Xem trước đề</title>",
+             "<style>body{font-family:sans-serif;max-width:900px;margin:auto}.ok{color:#070}.bad{color:#c00}"
+             "li{margin:4px 0}small{color:#666}</style>"]
+    for message in preview["errors"]: parts.append(f"<p class='bad'>{e(message)}</p>")
+    for z, zone in preview["zones"].items():
+        parts.append(f"<h2>{z} <small>({len(zone['questions'])} câu)</small></h2>")
+        for header in zone["header"]: parts.append(f"<p><small>{e(header)}</small></p>")
+        parts.append("<ol>")
+        for q in zone["questions"]:
+            flags = f" <small>[{', '.join(q['flags'])}]</small>" if q["flags"] else ""
+            ans = f" — <b class='{'bad' if q['error'] else 'ok'}'>{e(q.get('ans') or '?')}</b>" if z != "P4" else ""
+            parts.append(f"<li>{e(q['text'])}{ans}{flags}")
+            if q.get("options"):
+                parts.append("<ul>" + "".join(f"<li class='{'ok' if o['correct'] else ''}'>{o['label']}. {e(o['text'])}</li>"
+                                             for o in q["options"]) + "</ul>")
+            parts.append("</li>")
+        parts.append("</ol>")
+    return "".join(parts)
+
+@app.post("/api/preview")
+async def preview_endpoint(file: UploadFile = File(None), upload_id: str = Form(""), document_id: str = Form(""), format: str = Form("json")):
+    try:
+        content, error = await source_content(file, upload_id, document_id)
+        if error: return JSONResponse(status_code=error[0], content=error[1])
+        preview = await asyncio.to_thread(build_preview, content)
+        if format == "html": return Response(render_preview_html(preview), media_type="text/html; charset=utf-8")
+        return preview
+    except zipfile.BadZipFile:
+        return JSONResponse(status_code=400, content={"message": "File không phải .docx hợp lệ", "details": []})
+    except Exception as e:
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"message": "Lỗi hệ thống", "details": [str(e)]})
+
+# =====================================================================
+# MODULE 16: KHO KẾT QUẢ TRÊN ĐĨA (TTL) + TẢI TIẾP BẰNG RANGE / IF-RANGE / ETAG
+# =====================================================================
+
+RESULT_DIR = os.environ.get("ARENA_RESULT_DIR") or os.path.join(tempfile.gettempdir(), "arena-results")
+RESULT_TTL_SECONDS = int(os.environ.get("ARENA_RESULT_TTL", "86400"))
+RESULT_CHUNK = 256 * 1024
+RE_RESULT_ID = re.compile(r'^[0-9a-f]{32}$')
+RE_BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_results_lock = threading.Lock()
+
+def result_path(result_id):
+    return os.path.join(RESULT_DIR, f"{result_id}.zip")
+
+def expire_results():
+    now = time.time()
+    try:
+        entries = list(os.scandir(RESULT_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if now - entry.stat().st_mtime > RESULT_TTL_SECONDS: os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+def store_result(data):
+    # Ghi tạm rồi đổi tên: file .zip trong kho luôn đầy đủ; nội dung không bao giờ đổi -> ETag = id
+    with _results_lock:
+        os.makedirs(RESULT_DIR, exist_ok=True)
+        expire_results()
+    result_id = uuid.uuid4().hex
+    path = result_path(result_id)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    return result_id
+
+def _if_range_matches(value, etag, mtime):
+    # If-Range: ETag mạnh phải khớp tuyệt đối; dạng ngày thì file không được mới hơn ngày đó
+    if not value: return True
+    value = value.strip()
+    if value.startswith(('"', 'W/')): return value == etag
+    try:
+        return int(mtime) <= email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+def _iter_file(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(RESULT_CHUNK, length))
+            if not chunk: break
+            length -= len(chunk)
+            yield chunk
+
+def serve_result(request, result_id, filename="De_Thi.zip", allow_range=True):
+    not_found = JSONResponse(status_code=404, content={"message": "Không tìm thấy kết quả (có thể đã hết hạn)", "details": [result_id]})
+    if not RE_RESULT_ID.match(result_id or ""): return not_found
+    path = result_path(result_id)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return not_found
+    if time.time() - st.st_mtime > RESULT_TTL_SECONDS: return not_found
+
+    etag = f'"{result_id}"'
+    headers = {"ETag": etag, "Last-Modified": email.utils.formatdate(st.st_mtime, usegmt=True), "Accept-Ranges": "bytes",
+               "Cache-Control": "private, max-age=%d" % RESULT_TTL_SECONDS, "X-Arena-Result-Id": result_id,
+               "X-Arena-Result-Url": f"/api/results/{result_id}",
+               "Content-Disposition": f'attachment; filename="{filename}"'}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    size, start, end, status = st.st_size, 0, st.st_size - 1, 200
+    range_header = request.headers.get("range") if allow_range else None
+    if range_header and _if_range_matches(request.headers.get("if-range"), etag, st.st_mtime):
+        match = RE_BYTE_RANGE.match(range_header.strip())  # nhiều đoạn (a-b,c-d) -> trả cả file (RFC cho phép)
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size or start > end or (not match.group(1) and int(match.group(2)) == 0):
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}", "ETag": etag})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD": return Response(status_code=status, headers=headers, media_type="application/zip")
+    return StreamingResponse(_iter_file(path, start, end - start + 1), status_code=status,
+                             media_type="application/zip", headers=headers)
+
+@app.api_route("/api/results/{result_id}", methods=["GET", "HEAD"])
+async def result_download_endpoint(result_id: str, request: Request):
+    return serve_result(request, result_id)
+
+# =====================================================================
+# MODULE 17: PHÂN TÍCH ĐỀ CHẬM - CHI PHÍ TỪNG CÂU / TỪNG PHẦN
+# =====================================================================
+
+# Chạy 1 đề thử đúng đường render_variant; thời gian từng câu ghi ngay trong vòng lặp thật qua dict costs:
+#   parse (parse_docx: đọc chữ + khớp nhãn), detect (nhận diện đáp án), options (tách/xáo/dàn phương án),
+#   label (đánh lại nhãn câu), format (apply_global_formatting), assemble (nối mảnh bytes khi bật FRAGMENT_RENDER)
+# Phần không chia được theo câu (nạp file, lưu/nén, dựng khuôn) chỉ có trong stages_ms.
+QUESTION_COST_TOP = int(os.environ.get("ARENA_QUESTION_COST_TOP", "10"))
+COST_STAGES = ("parse", "detect", "options", "label", "format", "assemble")
+SLOW_RUNS_PER_PARAGRAPH = 500
+SLOW_MEDIA_BYTES = 1024 * 1024
+
+def _media_sizes(doc):
+    return {rId: len(rel.target_part.blob) for rId, rel in doc.part.rels.items()
+            if not rel.is_external and "image" in rel.reltype}
+
+def question_features(block, media_sizes):
+    features = {"elements": len(block), "paragraphs": 0, "runs": 0, "max_runs_per_paragraph": 0,
+                "tables": 0, "equations": 0, "ole_objects": 0, "images": 0}
+    media_bytes = 0
+    for el in block:
+        for node in el.iter():
+            tag = node.tag
+            if not isinstance(tag, str): continue
+            if tag == qn('w:p'):
+                runs = sum(1 for _ in node.iter(W_R))
+                features["paragraphs"] += 1
+                features["runs"] += runs
+                features["max_runs_per_paragraph"] = max(features["max_runs_per_paragraph"], runs)
+            elif tag == qn('w:tbl'): features["tables"] += 1
+            elif tag.endswith('}oMath'): features["equations"] += 1
+            elif tag.endswith('}OLEObject'): features["ole_objects"] += 1
+            elif tag.endswith('}blip'):
+                features["images"] += 1
+                media_bytes += media_sizes.get(node.get(R_EMBED), 0)
+    return features, media_bytes
+
+def slow_reasons(entry):
+    features, reasons = entry["features"], []
+    if features["max_runs_per_paragraph"] >= SLOW_RUNS_PER_PARAGRAPH:
+        reasons.append(f"Có đoạn gồm {features['max_runs_per_paragraph']} run (nên gõ lại hoặc Clear Formatting)")
+    if features["ole_objects"]:
+        reasons.append(f"Có {features['ole_objects']} công thức/đối tượng OLE nhúng (nên chuyển sang công thức Word)")
+    if entry["bytes"]["media"] >= SLOW_MEDIA_BYTES:
+        reasons.append(f"Ảnh nặng {entry['bytes']['media'] / (1024 * 1024):.1f} MB (nên giảm kích thước ảnh)")
+    return reasons
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+def question_cost_report(content, config_data, top=QUESTION_COST_TOP):
+    # content: file đã qua prepare_source; chạy trên bản sao config để không đổi config của job
+    config_data = dict(config_data)
+    config_data.setdefault("thoiGian", "90")
+    ma_de = (config_data.get("maDeList") or ["101"])[0]
+    stages = {}
+
+    t = time.perf_counter()
+    doc = Document(io.BytesIO(content))
+    stages["load"] = time.perf_counter() - t
+    parse_costs = {}
+    t = time.perf_counter()
+    parsed_data = parse_docx(doc, parse_costs)
+    stages["parse"] = time.perf_counter() - t
+
+    media_sizes = _media_sizes(doc)
+    entries = {}
+    for z in ZONES:
+        for n, question in enumerate(parsed_data[z].questions):
+            features, media_bytes = question_features(question.xml, media_sizes)
+            cost = dict.fromkeys(COST_STAGES, 0.0)
+            cost["parse"] = sum(parse_costs.get(el, 0.0) for el in question.xml)
+            entries[question] = {"zone": z, "src": n + 1, "text": _excerpt(get_text_from_element(question.xml[0])),
+                                 "seconds": cost, "bytes": {"xml": 0, "media": media_bytes}, "features": features}
+
+    costs = {}
+    t = time.perf_counter()
+    shuffled_data, _, errors = shuffle_engine(doc, parsed_data, config_data, costs=costs)
+    stages["shuffle"] = time.perf_counter() - t
+    for question, cost in costs.items(): entries[question]["seconds"].update(cost)
+
+    format_costs = {}
+    t = time.perf_counter()
+    render_template(doc, shuffled_data, config_data, MA_DE_SLOT if FRAGMENT_RENDER else ma_de, format_costs)
+    stages["render"] = time.perf_counter() - t
+
+    positions = {}
+    for z in ZONES:
+        for k, question in enumerate(shuffled_data[z].questions):
+            entry = entries[question]
+            entry["seconds"]["format"] = sum(format_costs.get(p, 0.0) for el in question.xml for p in el.iter(W_P))
+            entry["bytes"]["xml"] = sum(len(etree.tostring(el)) for el in question.xml)
+            positions[(z, question.src - 1 if question.src else k)] = entry
+
+    if FRAGMENT_RENDER:
+        t = time.perf_counter()
+        template = build_variant_template(doc, shuffled_data, config_data)
+        stages["template"] = time.perf_counter() - t
+        assemble_costs = {}
+        t = time.perf_counter()
+        output = assemble_variant(template, template.first_plan, ma_de, config_data, assemble_costs)
+        stages["assemble"] = time.perf_counter() - t
+        for key, seconds in assemble_costs.items(): positions[key]["seconds"]["assemble"] = seconds
+    else:
+        t = time.perf_counter()
+        doc_buffer = io.BytesIO()
+        doc.save(doc_buffer)
+        output = doc_buffer.getvalue()
+        stages["save"] = time.perf_counter() - t
+
+    zones, items = {}, []
+    for entry in entries.values():
+        cost = entry.pop("seconds")
+        entry["ms"] = {stage: _ms(cost[stage]) for stage in COST_STAGES}
+        entry["ms"]["total"] = _ms(sum(cost.values()))
+        entry["reasons"] = slow_reasons(entry)
+        items.append(entry)
+        zone = zones.setdefault(entry["zone"], {"questions": 0, "ms": dict.fromkeys(COST_STAGES + ("total",), 0.0),
+                                                "bytes": {"xml": 0, "media": 0}})
+        zone["questions"] += 1
+        for stage, value in entry["ms"].items(): zone["ms"][stage] = round(zone["ms"][stage] + value, 3)
+        for kind, value in entry["bytes"].items(): zone["bytes"][kind] += value
+
+    attributed = sum(entry["ms"]["total"] for entry in items)
+    items.sort(key=lambda entry: entry["ms"]["total"], reverse=True)
+    for entry in items: entry["share"] = round(entry["ms"]["total"] / attributed, 4) if attributed else 0.0
+    return {"stages_ms": {stage: _ms(value) for stage, value in stages.items()}, "fragment_render": FRAGMENT_RENDER,
+            "output_bytes": len(output), "attributed_ms": round(attributed, 3),
+            "questions": len(items), "zones": zones, "top": items[:max(0, top)], "errors": list(dict.fromkeys(errors))}
+
+@app.post("/api/question-costs")
+async def question_costs_endpoint(file: UploadFile = File(...), config: str = Form("{}"), top: int = Form(QUESTION_COST_TOP)):
+    try:
+        config_data = json.loads(config)
+        content, _ = await asyncio.to_thread(prepare_source, await file.read(), COMPACT_SOURCE,
+                                             OPTIMIZE_MEDIA and config_data.get("toiUuAnh", True))
+        return await asyncio.to_thread(question_cost_report, content, config_data, top)
+    except zipfile.BadZipFile:
+        return JSONResponse(status_code=400, content={"message": "File không phải .docx hợp lệ", "details": []})
     except Exception as e:
         traceback.print_exc()
         return JSONResponse(status_code=500, content={"message": "Lỗi hệ thống", "details": [str(e)]})
+
+# =====================================================================
+# MODULE 18: UPLOAD THEO KHÚC (NỐI LẠI ĐƯỢC) + PHÂN TÍCH NGAY TRONG LÚC TẢI
+# =====================================================================
+# 1. POST /api/uploads (size, sha256, filename) -> upload_id; server cấp sẵn file spool đúng kích thước.
+# 2. PUT /api/uploads/{id}?offset=N, body = bytes của khúc (header X-Chunk-Sha256 tuỳ chọn). Khúc gửi theo thứ tự
+#    bất kỳ, gửi lại được; mất kết nối giữa khúc thì phần đã tới vẫn được giữ (trừ khi khúc có X-Chunk-Sha256).
+# 3. Mọi phản hồi có "wanted": các đoạn byte còn thiếu theo thứ tự server cần: đuôi file (mục lục ZIP) -> các part
+#    không phải ảnh (document.xml, styles, rels...) -> ảnh. Client cứ gửi từ wanted[0]; rớt mạng thì
+#    GET /api/uploads/{id} lấy lại "wanted" rồi gửi tiếp.
+# 4. Đủ mục lục + các part không phải ảnh: dựng bản "khung" (ảnh rỗng) để phân tích câu hỏi / lỗi đề ngay ("check"),
+#    rồi tối ưu từng ảnh ngay khi ảnh đó tải xong (cache trên đĩa, prepare_source dùng lại) -> khi byte cuối tới,
+#    phần chuẩn bị nặng nhất đã xong: thời gian tổng ~ max(tải, xử lý) thay vì cộng dồn.
+# 5. Đủ bytes thì kiểm tra sha256 cả file; /api/mix-docx, /api/jobs, /api/estimate, /api/preview nhận upload_id thay cho file
+#    (upload xong cũng được đưa vào kho đề gốc, xem MODULE 19 -> dùng document_id cho các lần sau).
+# Trạng thái upload (các đoạn đã nhận, mục lục, kết quả kiểm tra) ghi vào file {upload_id}.json cạnh file spool và được
+# nạp lại mỗi lần tra cứu -> khúc tới worker nào (uvicorn --workers N) cũng được, server khởi động lại không mất upload.
+
+UPLOAD_DIR = os.environ.get("ARENA_UPLOAD_DIR") or os.path.join(tempfile.gettempdir(), "arena-uploads")
+UPLOAD_TTL_SECONDS = int(os.environ.get("ARENA_UPLOAD_TTL", "86400"))
+UPLOAD_MAX_BYTES = int(os.environ.get("ARENA_UPLOAD_MAX_MB", "200")) * MB
+UPLOAD_CHUNK = int(os.environ.get("ARENA_UPLOAD_CHUNK_KB", "1024")) * 1024  # cỡ khúc gợi ý cho client
+UPLOAD_TAIL = 22 + 65535  # bản ghi cuối ZIP (EOCD) + comment dài nhất -> chắc chắn nằm trong đoạn đuôi này
+UPLOAD_WANTED = 8
+UPLOAD_WRITE_BUFFER = 256 * 1024  # gom bytes của khúc rồi mới ghi đĩa (trong luồng riêng, không chặn event loop)
+UPLOAD_META_FIELDS = ("size", "sha256", "filename", "ranges", "status", "error", "digest", "directory", "entries",
+                      "check", "touched")
+UPLOAD_PREP_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("ARENA_UPLOAD_PREP_WORKERS", "1")),
+                                      thread_name_prefix="upload-prep")
+PAYLOAD_PREFIXES = ("word/media/", "word/embeddings/")  # phần nặng, không cần để phân tích câu hỏi
+RE_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+RE_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+UPLOADS = {}
+_uploads_lock = threading.Lock()
+
+def _add_range(ranges, start, end):
+    # ranges: các đoạn [start, end) đã sắp xếp, không chồng / không liền nhau
+    merged = []
+    for a, b in ranges:
+        if b < start or a > end: merged.append((a, b))
+        else: start, end = min(a, start), max(b, end)
+    merged.append((start, end))
+    return sorted(merged)
+
+def _missing(ranges, lo, hi):
+    gaps, pos = [], lo
+    for a, b in ranges:
+        if b <= pos: continue
+        if a >= hi: break
+        if a > pos: gaps.append((pos, a))
+        pos = max(pos, b)
+    if pos < hi: gaps.append((pos, hi))
+    return gaps
+
+class UploadSession:
+    """1 lần tải lên theo khúc. entries: [(tên part, đầu, cuối)] theo vị trí trong file, có sau khi đọc được mục lục ZIP;
+    usages: ảnh -> kích thước hiển thị, có sau khi phân tích bản khung; media: ảnh -> Future tối ưu ảnh."""
+
+    def __init__(self, upload_id, size, sha256, filename):
+        self.upload_id, self.size, self.sha256, self.filename = upload_id, size, sha256, filename
+        self.path = os.path.join(UPLOAD_DIR, f"{upload_id}.part")
+        self.meta_path = upload_meta_path(upload_id)
+        self.lock = threading.Lock()
+        self.ranges, self.status, self.error, self.digest = [], "uploading", None, None
+        self.directory, self.entries, self.usages = None, None, None
+        self.preparse, self.media, self.check, self.preview = None, {}, None, None
+        self.touched = time.time()
+
+    def received(self):
+        return sum(b - a for a, b in self.ranges)
+
+    def covered(self, start, end):
+        return not _missing(self.ranges, start, end)
+
+    def regions(self):
+        # Thứ tự ưu tiên khi xin bytes
+        tail = max(0, self.size - UPLOAD_TAIL)
+        if self.directory is None: return [(tail, self.size), (0, tail)]
+        if self.entries is None: return [(self.directory, self.size), (0, self.directory)]
+        light = [(s, e) for name, s, e in self.entries if not name.startswith(PAYLOAD_PREFIXES)]
+        heavy = [(s, e) for name, s, e in self.entries if name.startswith(PAYLOAD_PREFIXES)]
+        return [(self.directory, self.size)] + light + heavy
+
+    def wanted(self):
+        out = []
+        for lo, hi in self.regions():
+            for gap in _missing(self.ranges, lo, hi):
+                if gap not in out: out.append(gap)
+                if len(out) >= UPLOAD_WANTED: return out
+        return out
+
+    def merge(self, meta):
+        # Gộp trạng thái do worker khác ghi: đoạn đã nhận chỉ tăng, trạng thái cuối (complete / error) thắng
+        for start, end in meta["ranges"]: self.ranges = _add_range(self.ranges, start, end)
+        if self.directory is None: self.directory = meta["directory"]
+        if self.entries is None and meta["entries"] is not None: self.entries = [tuple(e) for e in meta["entries"]]
+        if self.check is None: self.check = meta["check"]
+        if self.status not in ("complete", "error") and meta["status"] in ("complete", "error"):
+            self.status, self.error, self.digest = meta["status"], meta["error"], meta["digest"]
+        self.touched = max(self.touched, meta["touched"])
+
+    def save(self):
+        # Gọi khi đang giữ self.lock. Khoá file spool (không bị thay) để 2 worker không ghi đè đoạn của nhau
+        with open(self.path, "rb") as spool:
+            if fcntl is not None: fcntl.flock(spool, fcntl.LOCK_EX)
+            meta = read_upload_meta(self.upload_id)
+            if meta is not None: self.merge(meta)
+            meta = {field: getattr(self, field) for field in UPLOAD_META_FIELDS}
+            # Đang kiểm tra sha256 dở mà tiến trình chết -> lần sau kiểm tra lại
+            if meta["status"] == "verifying": meta["status"] = "uploading"
+            _write_atomic(self.meta_path, json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+    def describe(self):
+        with self.lock:
+            return {"upload_id": self.upload_id, "status": self.status, "size": self.size, "received": self.received(),
+                    "chunk_size": UPLOAD_CHUNK, "wanted": [list(r) for r in self.wanted()], "check": self.check,
+                    "media": {"images": len(self.usages or {}), "optimized": sum(f.done() for f in self.media.values())},
+                    "sha256": self.digest, "document_id": self.digest if self.status == "complete" and DOCUMENT_STORE else None,
+                    "error": self.error}
+
+def upload_not_found(upload_id):
+    return 404, {"message": "Không tìm thấy upload (có thể đã hết hạn)", "details": [upload_id]}
+
+def upload_meta_path(upload_id):
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.json")
+
+def read_upload_meta(upload_id):
+    try:
+        with open(upload_meta_path(upload_id), "rb") as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def find_upload(upload_id):
+    # Luôn đọc lại file trạng thái: khúc có thể đã tới worker khác; upload do worker khác tạo
+    # (hoặc có từ trước khi server khởi động lại) thì dựng lại phiên từ file đó
+    if not RE_UPLOAD_ID.match(upload_id): return None
+    meta = read_upload_meta(upload_id)
+    with _uploads_lock:
+        if meta is None or time.time() - meta["touched"] > UPLOAD_TTL_SECONDS or not os.path.exists(
+                os.path.join(UPLOAD_DIR, f"{upload_id}.part")):
+            UPLOADS.pop(upload_id, None)
+            return None
+        session = UPLOADS.get(upload_id)
+        if session is None:
+            session = UPLOADS[upload_id] = UploadSession(upload_id, meta["size"], meta["sha256"], meta["filename"])
+    with session.lock:
+        session.merge(meta)
+    return session
+
+def _expire_uploads():
+    now = time.time()
+    with _uploads_lock:
+        for upload_id in [u for u, s in UPLOADS.items() if now - s.touched > UPLOAD_TTL_SECONDS]:
+            del UPLOADS[upload_id]
+        alive = {path for s in UPLOADS.values() for path in (s.path, s.meta_path)}
+    # Dọn cả file spool mồ côi (server khởi động lại) và ảnh tối ưu sẵn quá hạn
+    for folder in (UPLOAD_DIR, MEDIA_CACHE_DIR):
+        try:
+            entries = list(os.scandir(folder))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                if entry.path not in alive and now - entry.stat().st_mtime > UPLOAD_TTL_SECONDS: os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def create_upload(size, sha256, filename):
+    _expire_uploads()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    session = UploadSession(uuid.uuid4().hex, size, sha256, filename)
+    with open(session.path, "wb") as f:
+        f.truncate(size)
+    with session.lock:
+        session.save()
+    with _uploads_lock:
+        UPLOADS[session.upload_id] = session
+    return session
+
+def write_upload_bytes(session, offset, data, digest):
+    with open(session.path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+    digest.update(data)
+
+def receive_upload_range(session, start, end):
+    with session.lock:
+        session.ranges = _add_range(session.ranges, start, end)
+        session.touched = time.time()
+        session.save()
+
+def _read_upload_directory(session):
+    # Chỉ cần đuôi file: vị trí mục lục ZIP nằm trong bản ghi cuối (EOCD); zipfile đọc mục lục mà chưa đụng tới dữ liệu
+    if session.directory is None:
+        with open(session.path, "rb") as f:
+            f.seek(max(0, session.size - UPLOAD_TAIL))
+            tail = f.read()
+        at = tail.rfind(b"PK\x05\x06")
+        if at < 0 or len(tail) - at < 22: raise zipfile.BadZipFile("Không thấy mục lục ZIP")
+        session.directory = struct.unpack("<L", tail[at + 16:at + 20])[0]
+    if session.entries is None and session.covered(session.directory, session.size):
+        with zipfile.ZipFile(session.path) as package:
+            infos = sorted(package.infolist(), key=lambda i: i.header_offset)
+        ends = [i.header_offset for i in infos[1:]] + [session.directory]
+        session.entries = [(i.filename, i.header_offset, end) for i, end in zip(infos, ends)]
+
+def _schedule_media(session):
+    for name, start, end in session.entries:
+        if name in session.usages and name not in session.media and session.covered(start, end):
+            session.media[name] = UPLOAD_PREP_POOL.submit(_prepare_upload_image, session, name, session.usages[name])
+
+def _prepare_upload_image(session, name, displayed):
+    with zipfile.ZipFile(session.path) as package:
+        blob = package.read(name)
+    if not os.path.exists(media_cache_path(blob, displayed)): store_reencoded_image(blob, displayed)
+
+def _preparse_upload(session):
+    # Bản khung: đủ mọi part, ảnh / nhúng để rỗng -> parse + nhận diện đáp án như bản thật
+    skeleton = io.BytesIO()
+    with zipfile.ZipFile(session.path) as package, zipfile.ZipFile(skeleton, "w", zipfile.ZIP_STORED) as out:
+        for info in package.infolist():
+            out.writestr(info.filename, b"" if info.filename.startswith(PAYLOAD_PREFIXES) else package.read(info))
+    doc = Document(io.BytesIO(skeleton.getvalue()))
+    usages, _ = _image_usages(doc.part.package)
+    preview = analyze_preview(doc, None)
+    with session.lock:
+        session.usages = {str(part.partname).lstrip("/"): displayed for part, displayed in usages.items()}
+        session.preview, session.check = preview, {"questions": preview["questions"], "errors": preview["errors"]}
+        session.save()
+        _schedule_media(session)
+        if session.digest: _cache_upload_preview(session)
+
+def _cache_upload_preview(session):
+    # Bản khung cho kết quả xem trước giống hệt file thật -> /api/preview của file này khỏi phân tích lại
+    if session.preview is not None and session.status == "complete":
+        remember_preview(session.digest, dict(session.preview, sha256=session.digest))
+
+def advance_upload(session):
+    # Gọi sau mỗi khúc: đọc mục lục -> phân tích khung -> tối ưu ảnh đã đủ bytes -> kiểm tra sha256 khi đủ file
+    with session.lock:
+        if session.status != "uploading": return
+        try:
+            if session.entries is None and session.covered(max(0, session.size - UPLOAD_TAIL), session.size):
+                _read_upload_directory(session)
+                if session.entries is not None: session.save()
+        except (zipfile.BadZipFile, struct.error, ValueError, OSError) as e:
+            session.status, session.error = "error", f"File không phải .docx hợp lệ ({e})"
+            session.save()
+            return
+        if session.entries is not None and session.preparse is None and all(
+                session.covered(s, e) for name, s, e in session.entries if not name.startswith(PAYLOAD_PREFIXES)):
+            session.preparse = UPLOAD_PREP_POOL.submit(_preparse_upload, session)
+        if session.usages is not None: _schedule_media(session)
+        if session.received() < session.size: return
+        session.status = "verifying"
+
+    digest = hashlib.sha256()
+    with open(session.path, "rb") as f:
+        for block in iter(lambda: f.read(RESULT_CHUNK), b""): digest.update(block)
+    with session.lock:
+        session.digest = digest.hexdigest()
+        if session.sha256 and session.sha256 != session.digest:
+            session.status = "error"
+            session.error = f"sha256 không khớp: khai báo {session.sha256}, nhận được {session.digest}"
+            session.save()
+            return
+        session.status = "complete"
+        session.save()
+        _cache_upload_preview(session)
+    # Đưa vào kho đề gốc (hard link, không chép) -> các lần trộn sau chỉ cần document_id = sha256
+    if DOCUMENT_STORE: store_document(source_path=session.path)
+
+def upload_content(upload_id):
+    # Trả về (bytes, None) hoặc (None, (status, payload)); đợi phần tối ưu ảnh đang chạy dở để prepare_source dùng lại
+    session = find_upload(upload_id)
+    if session is None: return None, upload_not_found(upload_id)
+    if session.status != "complete":
+        return None, (409, {"message": "Upload chưa hoàn tất", "details": [session.error or f"Đã nhận {session.received()}/{session.size} bytes"]})
+    with session.lock:
+        session.touched = time.time()
+        session.save()
+    if session.preparse is not None: session.preparse.exception()
+    for future in list(session.media.values()): future.exception()
+    with open(session.path, "rb") as f:
+        return f.read(), None
+
+async def source_content(file, upload_id, document_id=""):
+    # Nội dung đề: file gửi kèm request, upload theo khúc đã xong, hoặc đề trong kho (MODULE 19)
+    if file is not None: return await file.read(), None
+    if document_id: return await asyncio.to_thread(document_content, document_id)
+    if not upload_id: return None, (400, {"message": "Thiếu file đề", "details": ["Gửi kèm file, upload_id hoặc document_id"]})
+    return await asyncio.to_thread(upload_content, upload_id)
+
+@app.post("/api/uploads", status_code=201)
+async def create_upload_endpoint(size: int = Form(...), sha256: str = Form(""), filename: str = Form("de.docx")):
+    sha256 = sha256.strip().lower()
+    if size <= 0 or size > UPLOAD_MAX_BYTES:
+        return JSONResponse(status_code=413, content={"message": f"File đề tối đa {UPLOAD_MAX_BYTES // MB} MB", "details": [str(size)]})
+    if sha256 and not RE_SHA256.match(sha256):
+        return JSONResponse(status_code=400, content={"message": "sha256 không hợp lệ", "details": [sha256]})
+    session = await asyncio.to_thread(create_upload, size, sha256, filename)
+    return session.describe()
+
+@app.put("/api/uploads/{upload_id}")
+async def upload_chunk_endpoint(upload_id: str, request: Request, offset: int = 0):
+    session = await asyncio.to_thread(find_upload, upload_id)
+    if session is None:
+        status, payload = upload_not_found(upload_id)
+        return JSONResponse(status_code=status, content=payload)
+    if session.status != "uploading":
+        # Gửi lại khúc cuối sau khi đã xong -> trả trạng thái như cũ
+        return JSONResponse(status_code=422 if session.status == "error" else 200, content=session.describe())
+    if offset < 0 or offset >= session.size:
+        return JSONResponse(status_code=416, content={"message": "offset nằm ngoài file", "details": [offset, session.size]})
+
+    expected = (request.headers.get("x-chunk-sha256") or "").strip().lower()
+    digest, end, disconnected = hashlib.sha256(), offset, False
+    pending, written = [], offset
+    try:
+        async for piece in request.stream():
+            if end + len(piece) > session.size:
+                return JSONResponse(status_code=413, content={"message": "Khúc vượt quá kích thước file đã khai báo",
+                                                              "details": [offset, end + len(piece), session.size]})
+            pending.append(piece)
+            end += len(piece)
+            if end - written >= UPLOAD_WRITE_BUFFER:
+                await asyncio.to_thread(write_upload_bytes, session, written, b"".join(pending), digest)
+                pending, written = [], end
+    except ClientDisconnect:
+        disconnected = True  # giữ phần đã tới (nếu khúc không kèm sha256), client hỏi lại "wanted" rồi gửi tiếp
+    if pending: await asyncio.to_thread(write_upload_bytes, session, written, b"".join(pending), digest)
+    if expected and (disconnected or digest.hexdigest() != expected):
+        return JSONResponse(status_code=422, content={"message": "Khúc bị hỏng (sha256 không khớp), hãy gửi lại khúc này",
+                                                      "details": [offset, end]})
+    if end > offset: await asyncio.to_thread(receive_upload_range, session, offset, end)
+    await asyncio.to_thread(advance_upload, session)
+    return JSONResponse(status_code=422 if session.status == "error" else 200, content=session.describe())
+
+@app.get("/api/uploads/{upload_id}")
+async def upload_status_endpoint(upload_id: str):
+    session = await asyncio.to_thread(find_upload, upload_id)
+    if session is None:
+        status, payload = upload_not_found(upload_id)
+        return JSONResponse(status_code=status, content=payload)
+    return session.describe()
+
+@app.delete("/api/uploads/{upload_id}")
+async def delete_upload_endpoint(upload_id: str):
+    session = await asyncio.to_thread(find_upload, upload_id)
+    with _uploads_lock:
+        UPLOADS.pop(upload_id, None)
+    if session is None:
+        status, payload = upload_not_found(upload_id)
+        return JSONResponse(status_code=status, content=payload)
+    for path in (session.meta_path, session.path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return {"upload_id": upload_id, "status": "deleted"}
+
+# =====================================================================
+# MODULE 19: KHO ĐỀ GỐC (TẢI LÊN 1 LẦN, TRỘN NHIỀU LẦN BẰNG document_id)
+# =====================================================================
+# document_id = sha256 nội dung file -> cùng 1 file gửi bao nhiêu lần cũng chỉ lưu 1 bản; client tự tính sha256,
+# hỏi GET /api/documents/{id} trước: có rồi thì khỏi gửi lại file, chỉ gửi document_id + config.
+# Lưu trên đĩa: {id}.docx (file gốc) + {id}.prep-*.docx (bản đã chuẩn hoá / tối ưu ảnh của prepare_source, dùng chung
+# cho mọi tiến trình con); xem trước (MODULE 15) cache theo đúng sha256 này. Hết hạn theo TTL tính từ lần dùng
+# cuối, vượt dung lượng thì bỏ đề lâu không dùng nhất (LRU theo mtime, được chạm mỗi lần dùng).
+
+DOCUMENT_STORE = os.environ.get("ARENA_DOCUMENT_STORE", "1") == "1"
+DOCUMENT_DIR = os.environ.get("ARENA_DOCUMENT_DIR") or os.path.join(tempfile.gettempdir(), "arena-documents")
+DOCUMENT_TTL_SECONDS = int(os.environ.get("ARENA_DOCUMENT_TTL", str(7 * 86400)))
+DOCUMENT_STORE_BYTES = int(os.environ.get("ARENA_DOCUMENT_STORE_MB", "2048")) * MB
+_documents_lock = threading.Lock()
+
+def document_path(document_id):
+    return os.path.join(DOCUMENT_DIR, f"{document_id}.docx")
+
+def prepared_path(document_id, compact, media):
+    return os.path.join(DOCUMENT_DIR, f"{document_id}.prep-{int(compact)}{int(media)}.docx")
+
+def document_not_found(document_id):
+    return 404, {"message": "Không tìm thấy đề trong kho (có thể đã hết hạn), hãy gửi lại file", "details": [document_id]}
+
+def _touch(path):
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _expire_documents():
+    # Nhóm file theo id: quá TTL thì xoá; tổng dung lượng vượt ngưỡng thì xoá nhóm dùng lâu nhất trước
+    groups = {}
+    try:
+        entries = list(os.scandir(DOCUMENT_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        group = groups.setdefault(entry.name[:64], {"paths": [], "bytes": 0, "used": 0})
+        group["paths"].append(entry.path)
+        group["bytes"] += st.st_size
+        if entry.name == f"{entry.name[:64]}.docx": group["used"] = st.st_mtime  # bản gốc quyết định lần dùng cuối
+    now, total = time.time(), sum(g["bytes"] for g in groups.values())
+    for document_id, group in sorted(groups.items(), key=lambda item: item[1]["used"]):
+        if now - group["used"] <= DOCUMENT_TTL_SECONDS and total <= DOCUMENT_STORE_BYTES: break
+        for path in group["paths"]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= group["bytes"]
+
+def _write_atomic(path, data):
+    tmp = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def store_document(content=None, source_path=None):
+    # Trả về (document_id, đã có sẵn chưa); source_path: file đã nằm trên đĩa (upload theo khúc) -> hard link, không chép
+    if source_path is not None:
+        digest = hashlib.sha256()
+        with open(source_path, "rb") as f:
+            for block in iter(lambda: f.read(RESULT_CHUNK), b""): digest.update(block)
+        document_id = digest.hexdigest()
+    else:
+        document_id = hashlib.sha256(content).hexdigest()
+    path = document_path(document_id)
+    if _touch(path): return document_id, True
+    with _documents_lock:
+        os.makedirs(DOCUMENT_DIR, exist_ok=True)
+        _expire_documents()
+    if source_path is None:
+        _write_atomic(path, content)
+        return document_id, False
+    tmp = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+    try:
+        os.link(source_path, tmp)
+    except OSError:
+        shutil.copyfile(source_path, tmp)
+    os.replace(tmp, path)
+    return document_id, False
+
+def document_content(document_id):
+    # Trả về (bytes, None) hoặc (None, (status, payload)); mỗi lần dùng là 1 lần "chạm" cho LRU
+    path = document_path(document_id)
+    if not RE_SHA256.match(document_id or "") or not _touch(path): return None, document_not_found(document_id)
+    try:
+        with open(path, "rb") as f:
+            return f.read(), None
+    except FileNotFoundError:
+        return None, document_not_found(document_id)
+
+def load_prepared_source(document_id, compact, media):
+    # Bản đã chuẩn bị của đề trong kho: 1 dòng JSON (report) rồi tới bytes .docx
+    try:
+        with open(prepared_path(document_id, compact, media), "rb") as f:
+            report, content = json.loads(f.readline()), f.read()
+    except (OSError, ValueError):
+        return None
+    _touch(document_path(document_id))
+    return content, report
+
+def store_prepared_source(document_id, compact, media, content, report):
+    # Chỉ lưu cho đề có trong kho -> dung lượng đi theo LRU / TTL của kho
+    if not os.path.exists(document_path(document_id)): return
+    _write_atomic(prepared_path(document_id, compact, media), json.dumps(report, ensure_ascii=False).encode("utf-8") + b"\n" + content)
+
+def describe_document(document_id):
+    try:
+        st = os.stat(document_path(document_id))
+    except FileNotFoundError:
+        return None
+    preview = PREVIEW_CACHE.get(document_id)
+    return {"document_id": document_id, "size": st.st_size,
+            "last_used": email.utils.formatdate(st.st_mtime, usegmt=True),
+            "expires_in_s": max(0, int(DOCUMENT_TTL_SECONDS - (time.time() - st.st_mtime))),
+            "prepared": [name for name in ("01", "10", "11") if os.path.exists(os.path.join(DOCUMENT_DIR, f"{document_id}.prep-{name}.docx"))],
+            "check": {"questions": preview["questions"], "errors": preview["errors"]} if preview else None}
+
+@app.post("/api/documents", status_code=201)
+async def create_document_endpoint(file: UploadFile = File(...)):
+    content = await file.read()
+    if len(content) > UPLOAD_MAX_BYTES:
+        return JSONResponse(status_code=413, content={"message": f"File đề tối đa {UPLOAD_MAX_BYTES // MB} MB", "details": [len(content)]})
+    if not zipfile.is_zipfile(io.BytesIO(content)):
+        status, payload = invalid_docx_error()
+        return JSONResponse(status_code=status, content=payload)
+    document_id, existed = await asyncio.to_thread(store_document, content)
+    return dict(describe_document(document_id) or {"document_id": document_id}, existed=existed)
+
+@app.api_route("/api/documents/{document_id}", methods=["GET", "HEAD"])
+async def document_status_endpoint(document_id: str, request: Request):
+    info = describe_document(document_id) if RE_SHA256.match(document_id) else None
+    if info is None:
+        status, payload = document_not_found(document_id)
+        return JSONResponse(status_code=status, content=payload) if request.method == "GET" else Response(status_code=status)
+    if request.method == "HEAD": return Response(status_code=200)
+    return info
+
+@app.delete("/api/documents/{document_id}")
+async def delete_document_endpoint(document_id: str):
+    if not RE_SHA256.match(document_id) or not os.path.exists(document_path(document_id)):
+        status, payload = document_not_found(document_id)
+        return JSONResponse(status_code=status, content=payload)
+    for name in os.listdir(DOCUMENT_DIR):
+        if name.startswith(document_id):
+            try:
+                os.remove(os.path.join(DOCUMENT_DIR, name))
+            except FileNotFoundError:
+                pass
+    return {"document_id": document_id, "status": "deleted"}
+
+# Chạy với gunicorn --preload: warm-up ngay khi import ở tiến trình master, trước khi fork worker
+if os.environ.get("ARENA_PRELOAD") == "1":
+    warm_up()
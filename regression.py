@@ -0,0 +1,121 @@
+# =====================================================================
+# KIỂM TRA HỒI QUY: CÁC TỐI ƯU KHÔNG ĐƯỢC ĐỔI KẾT QUẢ NHÌN THẤY
+# =====================================================================
+# Chạy:  python regression.py
+# Mỗi mục dựng 1 đề nhỏ đúng kiểu gây lỗi cũ, chạy qua main.py và so với kết quả mong đợi; in OK / LỖI từng mục,
+# thoát với mã 1 nếu có mục lỗi.
+
+import asyncio
+import io
+import json
+import sys
+
+from docx import Document
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+from starlette.datastructures import UploadFile
+from starlette.requests import Request
+
+import main as arena
+
+# =====================================================================
+# 1. ĐỀ MẪU
+# =====================================================================
+
+def bold_split_option_exam():
+    # Phương án in đậm, nhãn và chữ nằm ở 2 run cùng định dạng (Word hay tách run theo rsid khi sửa đề)
+    doc = Document()
+    doc.add_paragraph("PHẦN I. Câu trắc nghiệm nhiều phương án lựa chọn")
+    doc.add_paragraph("Câu 1: Chọn phương án in đậm")
+    for label in "ABCD":
+        p = doc.add_paragraph()
+        if label == "B": p.add_run("*")
+        p.add_run(f"{label}.").bold = True
+        p.add_run(f" Phương án {label} in đậm").bold = True
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def bold_option_texts(docx):
+    # Chữ của phương án -> các đoạn chữ KHÔNG in đậm (bỏ qua nhãn do main.py chèn lại)
+    out = {}
+    body = Document(io.BytesIO(docx)).element.body
+    for p in body.iter(qn('w:p')):  # gồm cả đoạn trong bảng dàn phương án
+        for run in Paragraph(p, None).runs:
+            if "Phương án" in run.text: out.setdefault(run.text.strip(), bool(run.bold))
+    return out
+
+def long_p3_answer_keys():
+    # Đáp án P3 dạng chữ dài hơn 16 ký tự (độ rộng cố định cũ của mảng chuỗi khi chấm)
+    return {"101": [{"q_num": 1, "ans": "quang-hop-o-luc-lap", "score": "0.5", "zone": "P3"},
+                    {"q_num": 2, "ans": "ho-hap-te-bao-ti-the", "score": "0.5", "zone": "P3"}]}
+
+# =====================================================================
+# 2. CÁC MỤC KIỂM TRA
+# =====================================================================
+
+def check_compaction_keeps_bold_options():
+    content = bold_split_option_exam()
+    results = []
+    for compact in (False, True):
+        source, _ = arena.prepare_source(content, compact, False)
+        docx, _, errors, _ = arena.render_variant(source, {"soDe": 1}, "101", {})
+        if errors: return False, errors
+        results.append(bold_option_texts(docx))
+    plain = [text for text, bold in results[1].items() if not bold]
+    return results[0] == results[1] and not plain, {"không gộp": results[0], "gộp run": results[1]}
+
+def check_grading_keeps_long_p3_answers():
+    rows = [["SBD", "Mã đề", "1", "2"],
+            ["dung", "101", "quang-hop-o-luc-lap", "ho-hap-te-bao-ti-the"],
+            ["sai-duoi", "101", "quang-hop-o-luc-lax", "ho-hap-te-bao-ti-thx"]]  # chỉ khác sau ký tự thứ 16
+    results = {r["sbd"]: r["P3"] for r in arena.grade_responses(long_p3_answer_keys(), rows)}
+    try:
+        arena.grade_responses(long_p3_answer_keys(), rows + [["dai", "101", "x" * (arena.RESPONSE_MAX_WIDTH + 1), ""]])
+        rejected = False
+    except ValueError:
+        rejected = True
+    return results == {"dung": 1.0, "sai-duoi": 0.0} and rejected, {"P3": results, "từ chối ô quá dài": rejected}
+
+def mix_request():
+    # Request tối thiểu cho mix_docx_endpoint; client không bao giờ ngắt kết nối
+    async def receive():
+        await asyncio.Event().wait()
+    return Request({"type": "http", "method": "POST", "path": "/api/mix-docx", "headers": [], "query_string": b""}, receive)
+
+async def _cancel_leader_then_retry():
+    content = bold_split_option_exam()
+    config = json.dumps({"soDe": 40, "nonce": "regression-huy-leader"})
+    mix = lambda: arena.mix_docx_endpoint(mix_request(), UploadFile(io.BytesIO(content), filename="de.docx"), "", "", config)
+    leader = asyncio.create_task(mix())
+    while arena.MIX_FLIGHTS.describe()["inflight"] == 0: await asyncio.sleep(0.005)
+    await asyncio.sleep(0.2)  # job đang chạy dở
+    leader.cancel()
+    try:
+        await leader
+    except asyncio.CancelledError:
+        pass
+    after_cancel = arena.MIX_FLIGHTS.describe()
+    retry = await asyncio.wait_for(mix(), 120)
+    return after_cancel, retry.status_code
+
+def check_cancelled_leader_frees_flight():
+    # Leader bị huỷ phải công bố kết quả và giải phóng khoá; yêu cầu giống hệt sau đó chạy lại, không treo
+    try:
+        after_cancel, status = asyncio.run(_cancel_leader_then_retry())
+    except asyncio.TimeoutError:
+        return False, "yêu cầu gửi lại bị treo"
+    return after_cancel["inflight"] == 0 and status == 200, {"sau khi huỷ": after_cancel, "gửi lại": status}
+
+CHECKS = [check_compaction_keeps_bold_options, check_grading_keeps_long_p3_answers, check_cancelled_leader_frees_flight]
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        ok, detail = check()
+        print(f"[{'OK' if ok else 'LỖI'}] {check.__name__}" + ("" if ok else f": {detail}"))
+        failed += not ok
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+# =====================================================================
+# UPLOAD: GỬI ĐỀ THEO KHÚC, TỰ NỐI LẠI KHI RỚT MẠNG, RỒI TRỘN BẰNG document_id
+# =====================================================================
+# Chạy:  python upload.py de.docx --url http://127.0.0.1:8000
+#        python upload.py de.docx --config config.json --out De_Thi.zip
+#        python upload.py de.docx --resume 3f2a...   (tiếp tục upload cũ sau khi tắt máy / rớt mạng)
+# Khúc gửi theo "wanted" của server (mục lục ZIP + document.xml trước, ảnh sau) để server phân tích đề trong lúc
+# ảnh còn đang tải; đề đã có trong kho đề gốc của server (cùng sha256) thì không gửi lại. Chỉ dùng thư viện chuẩn.
+
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import sys
+import time
+import uuid
+from urllib.parse import urlparse
+
+# =====================================================================
+# 1. HTTP (KẾT NỐI MỚI MỖI YÊU CẦU -> RỚT MẠNG CHỈ MẤT 1 KHÚC)
+# =====================================================================
+
+def request(base_url, method, path, body=None, headers=None, timeout=120):
+    url = urlparse(base_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        return resp.status, resp.getheader("Content-Type", ""), resp.read()
+    finally:
+        conn.close()
+
+def encode_form(fields):
+    boundary = uuid.uuid4().hex
+    body = b"".join(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+                    for name, value in fields.items()) + f"--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+def call_json(base_url, method, path, body=None, headers=None):
+    status, _, data = request(base_url, method, path, body, headers)
+    return status, json.loads(data or b"{}")
+
+# =====================================================================
+# 2. GỬI KHÚC THEO "wanted", THỬ LẠI KHI LỖI MẠNG
+# =====================================================================
+
+def upload(base_url, path, resume=None, retries=20):
+    # Trả về document_id (sha256) của đề trên server
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    if not resume and request(base_url, "HEAD", f"/api/documents/{sha256}")[0] == 200:
+        print(f"Đề đã có trên server (document_id {sha256}), không cần gửi lại", flush=True)
+        return sha256
+    if resume:
+        status, state = call_json(base_url, "GET", f"/api/uploads/{resume}")
+    else:
+        body, headers = encode_form({"size": size, "sha256": sha256, "filename": os.path.basename(path)})
+        status, state = call_json(base_url, "POST", "/api/uploads", body, headers)
+    if status >= 400: raise RuntimeError(state.get("message", status))
+    upload_id, failures, shown = state["upload_id"], 0, None
+    print(f"upload_id: {upload_id} ({size} bytes)", flush=True)
+
+    with open(path, "rb") as f:
+        while state["status"] == "uploading":
+            start, end = state["wanted"][0]
+            end = min(end, start + state["chunk_size"])
+            f.seek(start)
+            chunk = f.read(end - start)
+            try:
+                status, state = call_json(base_url, "PUT", f"/api/uploads/{upload_id}?offset={start}", chunk,
+                                          {"Content-Type": "application/octet-stream",
+                                           "X-Chunk-Sha256": hashlib.sha256(chunk).hexdigest()})
+                failures = 0
+            except (OSError, http.client.HTTPException) as e:
+                failures += 1
+                if failures > retries: raise
+                print(f"  rớt mạng ({e}), thử lại sau {min(30, 2 ** failures)} giây", flush=True)
+                time.sleep(min(30, 2 ** failures))
+                status, state = call_json(base_url, "GET", f"/api/uploads/{upload_id}")
+                continue
+            if status >= 400 and "upload_id" not in state:
+                # Khúc hỏng trên đường truyền (422) ...: hỏi lại trạng thái rồi gửi lại
+                print(f"  {status}: {state.get('message')}", flush=True)
+                status, state = call_json(base_url, "GET", f"/api/uploads/{upload_id}")
+                continue
+            if state.get("check") and state["check"] != shown:
+                shown = state["check"]
+                print(f"  server đã phân tích đề: {shown['questions']} câu, {len(shown['errors'])} lỗi", flush=True)
+                for message in shown["errors"]: print(f"    - {message}", flush=True)
+            print(f"  {state.get('received', 0)}/{size} bytes", flush=True)
+    if state["status"] != "complete": raise RuntimeError(state.get("error") or state.get("message"))
+    return state["document_id"] or sha256
+
+# =====================================================================
+# 3. CHẠY
+# =====================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload đề theo khúc (nối lại được) rồi trộn bằng document_id")
+    parser.add_argument("file")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--resume", help="upload_id của lần upload dở trước")
+    parser.add_argument("--config", help="File JSON cấu hình (giống config của /api/mix-docx); bỏ trống = chỉ upload")
+    parser.add_argument("--out", default="De_Thi.zip")
+    args = parser.parse_args()
+
+    document_id = upload(args.url, args.file, args.resume)
+    if not args.config: return 0
+    with open(args.config, encoding="utf-8") as f:
+        config = f.read()
+    body, headers = encode_form({"document_id": document_id, "config": config})
+    t0 = time.perf_counter()
+    status, content_type, data = request(args.url, "POST", "/api/mix-docx", body, headers, timeout=3600)
+    if status != 200:
+        print(f"Lỗi {status}: {data.decode('utf-8', 'replace')}")
+        return 1
+    with open(args.out, "wb") as f:
+        f.write(data)
+    print(f"Đã trộn sau {time.perf_counter() - t0:.1f} giây -> {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())